@@ -0,0 +1,164 @@
+# Backfill NWM products for an explicit period, e.g. after an outage
+# longer than the real-time processing window. Work is spread over
+# several processes, each running its own ingest engine. Every item
+# goes through the same completion ledger and work leases as the
+# real-time runs, so a backfill and live ingest never process the
+# same file twice. The processes run at lower CPU priority and with
+# a shared download rate limit, so real-time ingest keeps priority.
+# Upstream keeps only the last couple of days. Anything older is
+# reported as unavailable.
+
+# Usage:
+#   python backfill_Inspector.py --start 2017081500 --end 2017081623 --range short_range
+#   python backfill_Inspector.py --start 2017081500 --end 2017081600 --products medium_land \
+#          --workers 4 --max-mbps 20
+#   python backfill_Inspector.py --start 2017081500 --end 2017081623 --shared-dir /shared/inspector --node n1
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import os
+import sys
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+# Import custom libraries for this workflow
+import catalogMod
+import engineMod
+import inspectorMod
+import ledgerMod
+import leaseMod
+import metricsMod
+
+def parseCycle(value):
+   try:
+      return datetime.datetime.strptime(value,'%Y%m%d%H')
+   except ValueError:
+      raise argparse.ArgumentTypeError('Expected YYYYMMDDHH: ' + value)
+
+def backfillItems(products,dStart,dEnd):
+   # Items in the period not yet complete in the ledger, oldest first.
+   ledger = ledgerMod.Ledger(catalogMod.config['ledgerPath'],journalMode=catalogMod.config['ledgerJournal'])
+   items = []
+   for order,product in enumerate(products):
+      cycles = engineMod.rangeCycles(product,dStart,dEnd)
+      if len(cycles) == 0:
+         continue
+      done = ledger.completed(product['name'],ledgerMod.cycleStr(cycles[0]),ledgerMod.cycleStr(cycles[-1]))
+      for dCycle in cycles:
+         for fHour in product['hours']:
+            if (ledgerMod.cycleStr(dCycle),fHour) not in done:
+               items.append((dCycle,order,fHour,product['name']))
+   ledger.close()
+   items.sort()
+   return [(name,dCycle,fHour) for dCycle,order,fHour,name in items]
+
+def runWorker(workerId,keys,tag,maxRate,niceness):
+   # Process one share of the backfill in its own engine. Returns
+   # (published, failure messages).
+   if niceness > 0:
+      os.nice(niceness)
+   metricsMod.metrics.job = 'backfill_Inspector_' + tag + '_' + str(workerId)
+   errTitle = 'Error_Backfill_Inspector_' + tag
+   warningTitle = 'Warning_Backfill_Inspector_' + tag
+   email = catalogMod.config['email']
+   pid = os.getpid()
+   lockFile = catalogMod.config['lockDir'] + '/Backfill_Inspector_' + tag + '_' + str(pid) + '.LOCK'
+   inspectorMod.createLock(lockFile,pid,warningTitle,email)
+   items = [engineMod.WorkItem(catalogMod.products[name],dCycle,fHour) for name,dCycle,fHour in keys]
+   products = [catalogMod.products[name] for name in sorted(set([key[0] for key in keys]))]
+   engine = engineMod.IngestEngine(products,errTitle,lockFile,email)
+   engine.maxRate = maxRate
+   try:
+      if workerId == 0:
+         engine.collectGarbage()
+      nDone = engine.runItems(items)
+   finally:
+      engine.close()
+   inspectorMod.deleteFile(lockFile,errTitle,email,lockFile)
+   return nDone,engine.failures
+
+def workerMain(args):
+   return runWorker(*args)
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser(description='Backfill NWM products for hydroInspector over a period.')
+   parser.add_argument('--start',required=True,type=parseCycle,help='First cycle, YYYYMMDDHH (UTC).')
+   parser.add_argument('--end',required=True,type=parseCycle,help='Last cycle, YYYYMMDDHH (UTC).')
+   parser.add_argument('--products',default=None,help='Comma separated product names.')
+   parser.add_argument('--range',default=None,dest='rangeName',choices=sorted(catalogMod.ranges.keys()))
+   parser.add_argument('--stream',default=None,choices=sorted(catalogMod.streams.keys()))
+   parser.add_argument('--workers',type=int,default=2,help='Number of worker processes.')
+   parser.add_argument('--max-mbps',type=float,default=None,dest='maxMbps',\
+                       help='Download rate limit in MB/s shared by all workers.')
+   parser.add_argument('--nice',type=int,default=10,help='CPU niceness of the workers.')
+   parser.add_argument('--tag',default='Backfill',help='Name used for lock files and email titles.')
+   parser.add_argument('--shared-dir',default=None,dest='sharedDir',\
+                       help='Ledger and leases directory shared with other ingest nodes.')
+   parser.add_argument('--node',default=None,help='Name of this ingest node (default: host name).')
+   args = parser.parse_args()
+
+   # Set before the workers are forked, so they inherit it.
+   if args.sharedDir is not None:
+      catalogMod.useSharedDir(args.sharedDir)
+   if args.node is not None:
+      catalogMod.config['nodeId'] = args.node
+
+   if args.end < args.start:
+      parser.error('--end is before --start')
+   names = None
+   if args.products is not None:
+      names = [name.strip() for name in args.products.split(',') if name.strip() != '']
+   try:
+      products = catalogMod.selectProducts(names,rangeName=args.rangeName,stream=args.stream)
+   except KeyError as e:
+      parser.error(str(e))
+
+   logging.basicConfig(level=logging.INFO,format='%(asctime)s %(process)d %(levelname)s %(message)s')
+
+   # Clear leases and worker lock files left behind by crashed runs.
+   leaseMod.LeaseManager(catalogMod.config['leaseDir'],node=catalogMod.config['nodeId']).clean()
+   inspectorMod.cleanLocks(catalogMod.config['lockDir'] + '/Backfill_Inspector_' + args.tag + '_*.LOCK')
+
+   keys = backfillItems(products,args.start,args.end)
+   logging.info('%d item(s) to backfill between %s and %s',len(keys),\
+                ledgerMod.cycleStr(args.start),ledgerMod.cycleStr(args.end))
+   if len(keys) == 0:
+      sys.exit(0)
+
+   # Whole cycles go to the same worker so its listings are reused,
+   # dealt out round robin so every worker starts with the oldest data.
+   cycleKeys = []
+   for key in keys:
+      if len(cycleKeys) == 0 or cycleKeys[-1][0][:2] != key[:2]:
+         cycleKeys.append([])
+      cycleKeys[-1].append(key)
+   nWorkers = max(1,min(args.workers,len(cycleKeys)))
+   shares = [[] for count in range(nWorkers)]
+   for index,group in enumerate(cycleKeys):
+      shares[index % nWorkers].extend(group)
+   maxRate = None
+   if args.maxMbps is not None:
+      maxRate = args.maxMbps*1e6/nWorkers
+
+   pool = multiprocessing.Pool(nWorkers)
+   try:
+      results = pool.map(workerMain,[(workerId,share,args.tag,maxRate,args.nice) \
+                                     for workerId,share in enumerate(shares)])
+   finally:
+      pool.close()
+      pool.join()
+
+   nDone = sum([result[0] for result in results])
+   failures = [failure for result in results for failure in result[1]]
+   logging.info('Backfill published %d of %d item(s), %d failure(s)',nDone,len(keys),len(failures))
+   if len(failures) > 0:
+      msg = 'ERROR: Backfill ' + ledgerMod.cycleStr(args.start) + '-' + ledgerMod.cycleStr(args.end) + \
+            ' had ' + str(len(failures)) + ' failure(s):\n' + '\n'.join(failures)
+      inspectorMod.sendEmail(msg,'Error_Backfill_Inspector_' + args.tag,catalogMod.config['email'])
@@ -0,0 +1,17 @@
+#!/bin/sh
+
+# Top level script that calls Python to backfill hydro-inspector
+# products over an explicit period with several worker processes.
+# Arguments (e.g. --start 2017081500 --end 2017081623) are passed through.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# Source bash environment
+. $HOME/.profile
+
+cd /d4/karsten/NWM_INSPECTOR/inspector_processing
+python backfill_Inspector.py "$@"
+
+exit 0
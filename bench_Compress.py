@@ -0,0 +1,106 @@
+# Benchmark suite for the compression stage. Runs
+# compressMod.compressNWM over every product type (and
+# compressV11Forcing over a v1.1 forcing file), one variable
+# at a time, recording encode/decode throughput, compression
+# ratio, peak memory and maximum quantization error. Results
+# are saved as JSON so runs can be compared between commits.
+
+# Usage:
+#   python bench_Compress.py --out bench_output.json
+#   python bench_Compress.py --complevel 1,2,4 --scale-factor SNEQV=0.01
+#   python bench_Compress.py --input land=/path/raw.nc:/path/meta.nc
+#   python bench_Compress.py --compare old.json new.json
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+allProducts = ['land','terrain_rt','channel_rt','reservoir','fe','fe_v11']
+
+parser = argparse.ArgumentParser(description='Benchmark NWM compression per product and variable.')
+parser.add_argument('--products',default=','.join(allProducts),\
+                    help='Comma separated list from: ' + ','.join(allProducts))
+parser.add_argument('--scale',type=float,default=0.1,\
+                    help='Fraction of full CONUS dimensions for synthetic grids (1.0 = full size).')
+parser.add_argument('--complevel',default=None,\
+                    help='Comma separated zlib levels to sweep. Default is compressMod.compLevel.')
+parser.add_argument('--scale-factor',action='append',default=[],dest='scaleFactors',\
+                    help='Override a scale_factor, e.g. SNEQV=0.01. May be repeated.')
+parser.add_argument('--input',action='append',default=[],dest='inputs',\
+                    help='Representative input instead of synthetic: TYPE=RAW.nc[:META.nc]')
+parser.add_argument('--work-dir',default=None,help='Scratch directory. Default is a temporary directory.')
+parser.add_argument('--timeout',type=int,default=3600,help='Per case timeout in seconds.')
+parser.add_argument('--out',default='bench_output.json',help='JSON results file.')
+parser.add_argument('--compare',nargs=2,metavar=('BASE','NEW'),default=None,\
+                    help='Compare two results files instead of running.')
+args = parser.parse_args()
+
+import benchMod
+
+if args.compare is not None:
+   for key,metric,vOld,vNew,change in benchMod.compareResults(args.compare[0],args.compare[1]):
+      if change is None:
+         changeStr = 'n/a'
+      else:
+         changeStr = '%+.1f%%' % (100.0*change)
+      print('%-60s %-12s %12.4g %12.4g %8s' % ('/'.join([str(k) for k in key]),metric,vOld,vNew,changeStr))
+   sys.exit(0)
+
+productList = [p.strip() for p in args.products.split(',') if p.strip() != '']
+for product in productList:
+   if product not in allProducts:
+      parser.error('Unknown product: ' + product)
+
+complevels = None
+if args.complevel is not None:
+   complevels = [int(c) for c in args.complevel.split(',')]
+
+scaleOverrides = {}
+for override in args.scaleFactors:
+   varName,value = override.split('=')
+   scaleOverrides[varName] = float(value)
+
+inputs = {}
+for spec in args.inputs:
+   nwmType,paths = spec.split('=',1)
+   paths = paths.split(':')
+   if len(paths) == 1:
+      paths.append(None)
+   inputs[nwmType] = (paths[0],paths[1])
+
+workDir = args.work_dir
+cleanWork = False
+if workDir is None:
+   workDir = tempfile.mkdtemp(prefix='bench_compress_')
+   cleanWork = True
+
+try:
+   summary = benchMod.runSuite(productList,workDir,scale=args.scale,complevels=complevels,\
+                               scaleOverrides=scaleOverrides,timeout=args.timeout,inputs=inputs)
+finally:
+   if cleanWork:
+      shutil.rmtree(workDir,ignore_errors=True)
+
+benchMod.writeResults(summary,args.out)
+
+for result in summary['results']:
+   if 'error' in result:
+      print('%-12s %-14s %s' % (result['nwmType'],result['variable'],result['error']))
+      continue
+   print('%-12s %-14s ratio=%-8s enc=%-8s dec=%-8s rss=%-8s err=%s' % \
+         (result['nwmType'],result['variable'],\
+          '%.2f' % result['ratio'] if 'ratio' in result else '-',\
+          '%.1f' % result['encodeMBps'] if 'encodeMBps' in result else '-',\
+          '%.1f' % result['decodeMBps'] if 'decodeMBps' in result else '-',\
+          '%.0f' % result['peakRssMB'] if 'peakRssMB' in result else '-',\
+          result.get('maxAbsError','-')))
+print('Results written to: ' + args.out)
@@ -0,0 +1,132 @@
+# Maintenance of the completion ledger (lib/ledgerMod.py) used by
+# the ingest engine: import existing .COMPLETE flag files, report
+# what is missing in the current processing window, compact old
+# entries, summarize its contents, show learned publication
+# latencies, report upstream-to-live freshness, and show which
+# ingest node holds or has completed which items.
+
+# Usage:
+#   python ledger_Admin.py migrate [--remove-flags]
+#   python ledger_Admin.py missing --range short_range --stream prod
+#   python ledger_Admin.py compact --days 14
+#   python ledger_Admin.py status
+#   python ledger_Admin.py latency --products medium_land
+#   python ledger_Admin.py freshness --days 7 [--json freshness.json]
+#   python ledger_Admin.py leases [--shared-dir /shared/inspector]
+#   python ledger_Admin.py nodes --days 1
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+# Import custom libraries for this workflow
+import catalogMod
+import engineMod
+import latencyMod
+import leaseMod
+import ledgerMod
+
+parser = argparse.ArgumentParser(description='Manage the hydroInspector completion ledger.')
+parser.add_argument('command',choices=['migrate','missing','compact','status','latency','freshness',\
+                                       'leases','nodes'])
+parser.add_argument('--ledger',default=None,help='Ledger path (default from the catalog config).')
+parser.add_argument('--shared-dir',default=None,dest='sharedDir',\
+                    help='Ledger and leases directory shared by several ingest nodes.')
+parser.add_argument('--products',default=None,help='Comma separated product names.')
+parser.add_argument('--range',default=None,dest='rangeName',choices=sorted(catalogMod.ranges.keys()))
+parser.add_argument('--stream',default=None,choices=sorted(catalogMod.streams.keys()))
+parser.add_argument('--remove-flags',action='store_true',dest='removeFlags',\
+                    help='migrate: delete flag files once imported.')
+parser.add_argument('--days',type=int,default=None,\
+                    help='compact: days of cycles to keep (default 14); freshness: days to report (default 7); ' + \
+                         'nodes: days of completions (default 1).')
+parser.add_argument('--json',default=None,help='freshness: also write the report to this JSON file.')
+args = parser.parse_args()
+
+if args.sharedDir is not None:
+   catalogMod.useSharedDir(args.sharedDir)
+if args.ledger is None:
+   args.ledger = catalogMod.config['ledgerPath']
+
+names = None
+if args.products is not None:
+   names = [name.strip() for name in args.products.split(',') if name.strip() != '']
+try:
+   products = catalogMod.selectProducts(names,rangeName=args.rangeName,stream=args.stream)
+except KeyError as e:
+   parser.error(str(e))
+
+ledger = ledgerMod.Ledger(args.ledger,journalMode=catalogMod.config['ledgerJournal'])
+
+if args.command == 'migrate':
+   nFlags = ledgerMod.migrateFlags(ledger,products,removeFlags=args.removeFlags)
+   print('Imported ' + str(nFlags) + ' flag file(s) into ' + args.ledger)
+elif args.command == 'missing':
+   dNow = datetime.datetime.utcnow()
+   for product in products:
+      cycles = [ledgerMod.cycleStr(dCycle) for dCycle in engineMod.cycleWindow(product,dNow)]
+      missing = ledger.missing(product['name'],cycles,product['hours'])
+      total = len(cycles)*len(product['hours'])
+      print('%-22s %5d of %5d missing' % (product['name'],len(missing),total))
+      for cycle,fHour in missing:
+         print('   %s f%03d' % (cycle,fHour))
+elif args.command == 'compact':
+   days = args.days or 14
+   nDel = ledger.compact(days)
+   print('Removed ' + str(nDel) + ' entries older than ' + str(days) + ' days')
+elif args.command == 'latency':
+   model = latencyMod.LatencyModel(ledger)
+   for product in products:
+      offsets = model.learn(product)
+      if len(offsets) == 0:
+         print('%-22s no history' % product['name'])
+         continue
+      print('%-22s %s' % (product['name'],' '.join(['f%03d:%.0fm' % (fHour,offsets[fHour]/60.0) \
+                                                   for fHour in sorted(offsets.keys())])))
+elif args.command == 'freshness':
+   report = latencyMod.freshness(ledger,products,days=args.days or 7)
+   print('Minutes from upstream publication (total), to detection (detect) and')
+   print('from detection to live on the web host (process).')
+   print('%-28s %-8s %6s %7s %7s %7s %7s' % ('product/group','leg','count','p50','p90','p99','max'))
+   for key in sorted(report.keys()):
+      for leg in ['total','detect','process']:
+         stats = report[key][leg]
+         if stats['count'] == 0:
+            continue
+         print('%-28s %-8s %6d %7.1f %7.1f %7.1f %7.1f' % (key,leg,stats['count'],stats['p50']/60.0,\
+               stats['p90']/60.0,stats['p99']/60.0,stats['max']/60.0))
+   if args.json is not None:
+      with open(args.json,'w') as fh:
+         json.dump(report,fh,indent=1,sort_keys=True)
+elif args.command == 'leases':
+   leases = leaseMod.LeaseManager(catalogMod.config['leaseDir'])
+   active = leases.active()
+   print('%-22s %-10s %4s  %-12s %-20s %7s %6s %s' % ('product','cycle','hour','node','host','pid','age','state'))
+   for (product,cycle,fHour),owner,age,stale in active:
+      print('%-22s %-10s f%03d  %-12s %-20s %7s %5dm %s' % (product,cycle,fHour,owner.get('node','-'),\
+            owner.get('host','-'),owner.get('pid','-'),age/60,'STALE' if stale else 'held'))
+   print(str(len(active)) + ' lease(s), ' + str(len([lease for lease in active if lease[3]])) + ' stale')
+elif args.command == 'nodes':
+   days = args.days or 1
+   since = time.time() - days*86400
+   print('Items completed per ingest node in the last ' + str(days) + ' day(s).')
+   print('%-20s %8s %10s %-20s' % ('node','items','MB','last'))
+   for node,nItems,nBytes,last in ledger.progress(since):
+      print('%-20s %8d %10.1f %-20s' % (node,nItems,(nBytes or 0)/1e6,\
+            datetime.datetime.utcfromtimestamp(last).strftime('%Y-%m-%d %H:%M:%S')))
+else:
+   print('%-22s %-10s %8s %-10s %-10s' % ('product','state','items','first','last'))
+   for row in ledger.summary():
+      print('%-22s %-10s %8d %-10s %-10s' % row)
+
+ledger.close()
@@ -0,0 +1,489 @@
+# Benchmark routines for the compression stage. Synthetic (or
+# user supplied) NWM output files are pushed through
+# compressMod.compressNWM and compressMod.compressV11Forcing one
+# variable at a time so encode/decode throughput, compression
+# ratio, peak memory and quantization error can be recorded
+# per variable and compared between commits.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import time
+
+import netCDF4
+import numpy as np
+
+import compressMod
+
+# Full CONUS dimensions of each NWM v1.1 output type. Synthetic
+# grids are built from these, multiplied by the requested scale.
+fullDims = {'land':(3840,4608),'terrain_rt':(15360,18432),'fe':(3840,4608),\
+            'channel_rt':(2729077,),'reservoir':(1506,)}
+
+# Representative physical ranges (low, high) used when generating
+# synthetic fields. These sit well inside validRange so the packed
+# integers never overflow.
+synthRanges = {'SNOWH':(0.0,2.5),'SNEQV':(0.0,800.0),'FSNO':(0.0,1.0),\
+               'ACCET':(0.0,900.0),'SOILSAT_TOP':(0.05,1.0),'SOILSAT':(0.05,1.0),\
+               'SNOWT_AVG':(230.0,290.0),'SFCRNOFF':(0.0,150.0),'T2D':(240.0,310.0),\
+               'SOIL_M':(0.05,0.5),'sfcheadsubrt':(0.0,400.0),'zwattablrt':(0.0,2.0),\
+               'streamflow':(0.0,2500.0),'nudge':(-50.0,50.0),'q_lateral':(0.0,40.0),\
+               'velocity':(0.0,4.0),'inflow':(0.0,1500.0),'outflow':(0.0,1500.0),\
+               'elevation':(150.0,2500.0),'RAINRATE':(0.0,0.01),'LWDOWN':(150.0,450.0),\
+               'U2D':(-20.0,20.0)}
+
+# Variables written into each synthetic product. A couple of the
+# variables compressMod skips are included so the skip path is
+# exercised, but only the kept ones are benchmarked individually.
+synthVars = {'land':['SNOWH','SNEQV','FSNO','ACCET','SOILSAT_TOP','SOILSAT',\
+                     'SNOWT_AVG','SFCRNOFF','T2D','SOIL_M'],\
+             'terrain_rt':['sfcheadsubrt','zwattablrt'],\
+             'channel_rt':['streamflow','nudge','q_lateral','velocity'],\
+             'reservoir':['inflow','outflow','elevation'],\
+             'fe':['RAINRATE','T2D','LWDOWN','U2D']}
+
+# Raw fill values each type carries (matches compressMod.main).
+synthFill = {'land':-1.0e+33,'terrain_rt':-8.9999998e+15,'fe':9.96921E36,\
+             'channel_rt':None,'reservoir':None}
+
+# Fraction of grid cells set to the fill value (water/outside domain).
+fillFraction = 0.3
+
+esriString = 'PROJCS["Lambert_Conformal_Conic",GEOGCS["GCS_Sphere",' + \
+             'DATUM["D_Sphere",SPHEROID["Sphere",6370000.0,0.0]],' + \
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],' + \
+             'PROJECTION["Lambert_Conformal_Conic"],PARAMETER["false_easting",0.0],' + \
+             'PARAMETER["false_northing",0.0],PARAMETER["central_meridian",-97.0],' + \
+             'PARAMETER["standard_parallel_1",30.0],PARAMETER["standard_parallel_2",60.0],' + \
+             'PARAMETER["latitude_of_origin",40.0000076294],UNIT["Meter",1.0]]'
+
+def scaledDims(nwmType,scale):
+   # Shrink the full CONUS dimensions of a product by scale.
+   return tuple([max(8,int(round(n*scale))) for n in fullDims[nwmType]])
+
+def synthField(shape,varName,fillValue,seed):
+   # Generate a smooth field with some small scale noise, roughly
+   # resembling model output so compression ratios are meaningful.
+   # Fill values are placed in contiguous blocks, as water/no-data
+   # regions are in the real grids.
+   rng = np.random.RandomState(seed)
+   low,high = synthRanges[varName]
+   if len(shape) == 1:
+      # Point data (channel/reservoir) is heavy tailed and unsorted.
+      field = rng.lognormal(0.0,1.5,shape)
+      field = field/field.max()
+   else:
+      ny,nx = shape
+      yy = np.linspace(0.0,4.0*np.pi,ny)[:,None]
+      xx = np.linspace(0.0,6.0*np.pi,nx)[None,:]
+      field = 0.5 + 0.25*np.sin(yy + rng.uniform(0,np.pi))*np.cos(xx + rng.uniform(0,np.pi)) + \
+              0.2*np.sin(0.37*xx*yy/np.pi) + 0.05*rng.standard_normal(shape)
+      field = np.clip(field,0.0,1.0)
+   field = (low + (high - low)*field).astype(np.float32)
+   if fillValue is not None and len(shape) == 2:
+      ny,nx = shape
+      nFill = int(fillFraction*nx)
+      field[:,nx-nFill:] = fillValue
+   return field
+
+def makeMetaFile(nwmType,metaPath,shape):
+   # Create a minimal geospatial metadata template with the pieces
+   # compressMod reads: x/y (or latitude/longitude), the coordinate
+   # system variable and the WRF-Hydro GIS Source_Software tag.
+   idOut = netCDF4.Dataset(metaPath,'w',format='NETCDF4')
+   idOut.Conventions = 'CF-1.5'
+   if nwmType in ['land','terrain_rt','fe']:
+      idOut.Source_Software = 'WRF-Hydro GIS Pre-processor'
+      ny,nx = shape
+      idOut.createDimension('x',nx)
+      idOut.createDimension('y',ny)
+      xVar = idOut.createVariable('x','f8',('x',))
+      yVar = idOut.createVariable('y','f8',('y',))
+      xVar.standard_name = 'projection_x_coordinate'
+      yVar.standard_name = 'projection_y_coordinate'
+      res = 1000.0*fullDims[nwmType][1]/nx
+      xVar[:] = -2303999.25 + res*np.arange(nx)
+      yVar[:] = -1919999.625 + res*np.arange(ny)[::-1]
+      crsVar = idOut.createVariable('ProjectionCoordinateSystem','S1')
+      crsVar.grid_mapping_name = 'lambert_conformal_conic'
+      crsVar.esri_pe_string = esriString
+   else:
+      # Point templates follow the non-GIS layout (station dimension),
+      # as the channel_point_netcdf template used operationally does.
+      nPts = shape[0]
+      dimName = 'station'
+      idOut.createDimension(dimName,nPts)
+      idOut.esri_pe_string = esriString
+      idOut.proj4 = '+proj=longlat +a=6370000 +b=6370000 +no_defs'
+      idOut.featureType = 'timeSeries'
+      rng = np.random.RandomState(42)
+      latVar = idOut.createVariable('latitude','f4',(dimName,))
+      lonVar = idOut.createVariable('longitude','f4',(dimName,))
+      latVar[:] = rng.uniform(25.0,50.0,nPts)
+      lonVar[:] = rng.uniform(-125.0,-67.0,nPts)
+   idOut.close()
+
+def makeSyntheticFile(nwmType,outPath,shape,varList,seed=0):
+   # Create a synthetic raw NWM output file of the given type that
+   # compressMod.compressNWM accepts.
+   idOut = netCDF4.Dataset(outPath,'w',format='NETCDF4')
+   fillValue = synthFill[nwmType]
+   idOut.createDimension('time',1)
+   timeVar = idOut.createVariable('time','i4',('time',))
+   timeVar.units = 'minutes since 1970-01-01 00:00:00 UTC'
+   timeVar[:] = 25000000
+   if nwmType == 'land':
+      dims = ('time','south_north','west_east')
+      idOut.createDimension('south_north',shape[0])
+      idOut.createDimension('west_east',shape[1])
+   elif nwmType == 'terrain_rt':
+      dims = ('time','y','x')
+      idOut.createDimension('y',shape[0])
+      idOut.createDimension('x',shape[1])
+   elif nwmType == 'fe':
+      dims = ('time','ncl0','ncl1')
+      idOut.createDimension('ncl0',shape[0])
+      idOut.createDimension('ncl1',shape[1])
+   else:
+      dims = ('station',)
+      idOut.createDimension('station',shape[0])
+      if nwmType == 'channel_rt':
+         idName = 'station_id'
+      else:
+         idName = 'lake_id'
+      idVar = idOut.createVariable(idName,'i4',('station',))
+      idVar[:] = np.arange(1,shape[0] + 1,dtype=np.int32)
+   if nwmType != 'fe':
+      idOut.missing_value = -9999.0
+   for count,varName in enumerate(varList):
+      ncVar = idOut.createVariable(varName,'f4',dims)
+      ncVar.long_name = varName
+      ncVar.units = '-'
+      field = synthField(shape,varName,fillValue,seed + count)
+      if len(dims) == 3:
+         ncVar[0,:,:] = field
+      else:
+         ncVar[:] = field
+   idOut.close()
+
+def subsetFile(srcPath,outPath,keepVars):
+   # Copy a raw NWM file keeping dimensions, integer/coordinate
+   # variables and global attributes, but only the floating point
+   # data variables listed in keepVars. Used to isolate a single
+   # variable (or none, for the fixed overhead baseline).
+   idIn = netCDF4.Dataset(srcPath,'r')
+   idOut = netCDF4.Dataset(outPath,'w',format='NETCDF4')
+   for dimName,dim in idIn.dimensions.items():
+      idOut.createDimension(dimName,len(dim))
+   for varName,ncVar in idIn.variables.items():
+      if ncVar.dtype.kind == 'f' and varName not in keepVars:
+         continue
+      varOut = idOut.createVariable(varName,ncVar.dtype,ncVar.dimensions)
+      varOut.setncatts(ncVar.__dict__)
+      ncVar.set_auto_maskandscale(False)
+      varOut.set_auto_maskandscale(False)
+      varOut[:] = ncVar[:]
+   idOut.setncatts(idIn.__dict__)
+   idIn.close()
+   idOut.close()
+
+def dataVars(srcPath):
+   # Return the floating point data variables in a raw file that
+   # compressMod would keep.
+   idIn = netCDF4.Dataset(srcPath,'r')
+   varList = [varName for varName,ncVar in idIn.variables.items() \
+              if ncVar.dtype.kind == 'f' and varName not in compressMod.varsSkip]
+   idIn.close()
+   return varList
+
+def resetPeakRss():
+   # Reset the kernel's high water mark so VmHWM reflects only the
+   # work done after this call. Linux only, silently ignored elsewhere.
+   try:
+      with open('/proc/self/clear_refs','w') as fh:
+         fh.write('5')
+      return True
+   except (IOError,OSError):
+      return False
+
+def peakRssMB():
+   # Peak resident set size of the current process in MB.
+   try:
+      with open('/proc/self/status','r') as fh:
+         for line in fh:
+            if line.startswith('VmHWM:'):
+               return float(line.split()[1])/1024.0
+   except (IOError,OSError):
+      pass
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def readRaw(path,varName):
+   # Read the raw floating point values of a variable, unmasked.
+   idIn = netCDF4.Dataset(path,'r')
+   ncVar = idIn.variables[varName]
+   ncVar.set_auto_maskandscale(False)
+   data = np.array(ncVar[:],dtype=np.float64)
+   idIn.close()
+   return data
+
+def decodeVar(path,varName):
+   # Time a full decode (unpack + mask) of a compressed variable.
+   tStart = time.time()
+   idIn = netCDF4.Dataset(path,'r')
+   data = idIn.variables[varName][:]
+   idIn.close()
+   return data,time.time() - tStart
+
+def quantError(rawData,decoded,fillValue,varName):
+   # Maximum absolute difference between the original values and
+   # the decoded compressed values, over valid points only. RAINRATE
+   # is converted from mm/s to mm/hr by the compressor.
+   valid = np.isfinite(rawData)
+   if fillValue is not None:
+      valid &= rawData != np.float32(fillValue)
+   expected = rawData
+   if varName == 'RAINRATE':
+      expected = rawData*3600.0
+   decodedArr = np.ma.filled(np.ma.asarray(decoded).astype(np.float64),np.nan)
+   diff = np.abs(decodedArr[valid] - expected[valid])
+   nLost = int(np.isnan(diff).sum())
+   diff = diff[~np.isnan(diff)]
+   if diff.size == 0:
+      return None,nLost
+   return float(diff.max()),nLost
+
+def runCase(case,queue):
+   # Child process entry point. Runs a single compression case so
+   # peak memory is attributable to that case alone, then pushes the
+   # result dictionary onto the queue.
+   result = dict(case)
+   try:
+      compressMod.compLevel = case['complevel']
+      compressMod.varScaleFactors.update(case['scaleOverrides'])
+      resetPeakRss()
+      rssStart = peakRssMB()
+      tStart = time.time()
+      if case['function'] == 'compressNWM':
+         compressMod.compressNWM(case['inPath'],case['outPath'],case['nwmType'],case['metaPath'],\
+                                 'BENCH','',case['lockFile'],initTime=case['initTime'],\
+                                 validTime=case['validTime'])
+      else:
+         compressMod.compressV11Forcing(case['outPath'],'BENCH','',case['lockFile'])
+      result['encodeSec'] = time.time() - tStart
+      result['peakRssMB'] = peakRssMB()
+      result['peakRssDeltaMB'] = result['peakRssMB'] - rssStart
+      result['compressedBytes'] = os.path.getsize(case['outPath'])
+   except BaseException as e:
+      result['error'] = '%s: %s' % (type(e).__name__,e)
+   queue.put(result)
+
+def runIsolated(case,timeout):
+   # Run a case in a child process, returning its result dictionary.
+   queue = multiprocessing.Queue()
+   proc = multiprocessing.Process(target=runCase,args=(case,queue))
+   proc.start()
+   result = None
+   try:
+      result = queue.get(timeout=timeout)
+   except Exception:
+      result = dict(case)
+      result['error'] = 'Timed out after %d seconds' % timeout
+   proc.join(5)
+   if proc.is_alive():
+      proc.terminate()
+      proc.join()
+   return result
+
+def rates(result,nBytes):
+   # Add throughput figures (MB/s of raw float32 data) to a result.
+   mb = nBytes/1.0e6
+   if result.get('encodeSec'):
+      result['encodeMBps'] = mb/result['encodeSec']
+   if result.get('decodeSec'):
+      result['decodeMBps'] = mb/result['decodeSec']
+
+def benchProduct(nwmType,workDir,scale,complevel,scaleOverrides,timeout,inPath=None,metaPath=None):
+   # Benchmark every kept variable of one product type with
+   # compressNWM, plus the whole file. Returns a list of results.
+   results = []
+   shape = scaledDims(nwmType,scale)
+   if inPath is None:
+      inPath = os.path.join(workDir,nwmType + '.RAW.nc')
+      makeSyntheticFile(nwmType,inPath,shape,synthVars[nwmType])
+   if metaPath is None:
+      metaPath = os.path.join(workDir,nwmType + '.META.nc')
+      makeMetaFile(nwmType,metaPath,shape)
+   dInit = datetime.datetime(2018,1,1,0)
+   baseCase = {'function':'compressNWM','nwmType':nwmType,'metaPath':metaPath,\
+               'complevel':complevel,'scaleOverrides':scaleOverrides,\
+               'lockFile':os.path.join(workDir,'BENCH.LOCK'),'initTime':dInit,'validTime':dInit + datetime.timedelta(seconds=3600)}
+
+   # Fixed overhead: no data variables, only dimensions and coordinates.
+   basePath = os.path.join(workDir,nwmType + '.BASE.nc')
+   subsetFile(inPath,basePath,[])
+   case = dict(baseCase,variable=None,inPath=basePath,outPath=basePath + '.OUT')
+   baseline = runIsolated(case,timeout)
+   overheadBytes = baseline.get('compressedBytes',0)
+   baseline['variable'] = '__overhead__'
+   results.append(baseline)
+
+   varList = dataVars(inPath)
+   for varName in varList + ['__all__']:
+      if varName == '__all__':
+         varPath = inPath
+         keep = varList
+      else:
+         varPath = os.path.join(workDir,nwmType + '.' + varName + '.nc')
+         subsetFile(inPath,varPath,[varName])
+         keep = [varName]
+      case = dict(baseCase,variable=varName,inPath=varPath,outPath=varPath + '.OUT')
+      result = runIsolated(case,timeout)
+      rawBytes = 0
+      rawData = {}
+      for keepVar in keep:
+         rawData[keepVar] = readRaw(varPath,keepVar)
+         rawBytes += rawData[keepVar].size*4
+      result['rawBytes'] = rawBytes
+      result['scaleFactor'] = dict(compressMod.varScaleFactors,**scaleOverrides).get(varName)
+      result['dtype'] = compressMod.vardTypeComp.get(varName)
+      if 'error' not in result:
+         result['payloadBytes'] = result['compressedBytes'] - overheadBytes
+         if result['payloadBytes'] > 0:
+            result['ratio'] = float(rawBytes)/result['payloadBytes']
+         decodeSec = 0.0
+         errors = []
+         nLost = 0
+         for keepVar in keep:
+            decoded,dt = decodeVar(case['outPath'],keepVar)
+            decodeSec += dt
+            err,lost = quantError(rawData[keepVar],decoded,synthFill.get(nwmType),keepVar)
+            nLost += lost
+            if err is not None:
+               errors.append(err)
+         result['decodeSec'] = decodeSec
+         if len(errors) > 0:
+            result['maxAbsError'] = max(errors)
+         result['lostValidPoints'] = nLost
+         rates(result,rawBytes)
+      results.append(result)
+      if varName != '__all__':
+         os.remove(varPath)
+      if os.path.isfile(case['outPath']):
+         os.remove(case['outPath'])
+   for path in [basePath,basePath + '.OUT']:
+      if os.path.isfile(path):
+         os.remove(path)
+   return results
+
+def benchV11Forcing(workDir,scale,timeout,inPath=None):
+   # Benchmark compressV11Forcing, which rescales RAINRATE in place
+   # on an already post-processed v1.1 forcing file.
+   shape = scaledDims('fe',scale)
+   if inPath is None:
+      inPath = os.path.join(workDir,'fe_v11.RAW.nc')
+      idOut = netCDF4.Dataset(inPath,'w',format='NETCDF4')
+      idOut.createDimension('time',1)
+      idOut.createDimension('y',shape[0])
+      idOut.createDimension('x',shape[1])
+      ncVar = idOut.createVariable('RAINRATE','f4',('time','y','x'),zlib=True,complevel=2)
+      ncVar.units = 'mm s^-1'
+      ncVar[0,:,:] = synthField(shape,'RAINRATE',None,7)
+      idOut.close()
+   workPath = inPath + '.OUT'
+   shutil.copyfile(inPath,workPath)
+   rawData = readRaw(inPath,'RAINRATE')
+   case = {'function':'compressV11Forcing','nwmType':'fe_v11','variable':'RAINRATE',\
+           'inPath':inPath,'outPath':workPath,'complevel':compressMod.compLevel,\
+           'scaleOverrides':{},'lockFile':os.path.join(workDir,'BENCH.LOCK')}
+   result = runIsolated(case,timeout)
+   result['rawBytes'] = rawData.size*4
+   if 'error' not in result:
+      result['ratio'] = float(os.path.getsize(inPath))/result['compressedBytes']
+      decoded,result['decodeSec'] = decodeVar(workPath,'RAINRATE')
+      result['maxAbsError'],result['lostValidPoints'] = quantError(rawData,decoded,None,'RAINRATE')
+      rates(result,result['rawBytes'])
+   os.remove(workPath)
+   return [result]
+
+def gitCommit():
+   # Commit the benchmark was run against, if this is a git checkout.
+   try:
+      with open(os.devnull,'w') as devNull:
+         commit = subprocess.check_output(['git','rev-parse','HEAD'],stderr=devNull)
+      return commit.decode('ascii').strip()
+   except (OSError,subprocess.CalledProcessError):
+      return None
+
+def runSuite(productList,workDir,scale=0.1,complevels=None,scaleOverrides=None,\
+             timeout=3600,inputs=None):
+   # Run the full suite. inputs optionally maps a product type to a
+   # (rawPath,metaPath) tuple of representative files to use instead
+   # of synthetic ones.
+   if complevels is None:
+      complevels = [compressMod.compLevel]
+   if scaleOverrides is None:
+      scaleOverrides = {}
+   if inputs is None:
+      inputs = {}
+   if not os.path.isdir(workDir):
+      os.makedirs(workDir)
+   results = []
+   for complevel in complevels:
+      for nwmType in productList:
+         inPath,metaPath = inputs.get(nwmType,(None,None))
+         if nwmType == 'fe_v11':
+            results += benchV11Forcing(workDir,scale,timeout,inPath=inPath)
+            continue
+         results += benchProduct(nwmType,workDir,scale,complevel,scaleOverrides,timeout,\
+                                 inPath=inPath,metaPath=metaPath)
+   for result in results:
+      # Timestamps and scratch paths are noise when diffing runs.
+      for key in ['initTime','validTime','inPath','outPath','metaPath','lockFile']:
+         result.pop(key,None)
+   summary = {'created':datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),\
+              'commit':gitCommit(),'host':platform.node(),\
+              'python':platform.python_version(),'numpy':np.__version__,\
+              'netCDF4':netCDF4.__version__,'scale':scale,\
+              'complevels':complevels,'scaleOverrides':scaleOverrides,\
+              'results':results}
+   return summary
+
+def writeResults(summary,outPath):
+   # Save results as JSON for later comparison.
+   with open(outPath,'w') as fh:
+      json.dump(summary,fh,indent=1,sort_keys=True)
+
+def resultKey(result):
+   return (result.get('function'),result.get('nwmType'),result.get('variable'),\
+           result.get('complevel'))
+
+def compareResults(basePath,newPath):
+   # Compare two saved result files, returning rows of
+   # (key, metric, base, new, relative change).
+   with open(basePath,'r') as fh:
+      base = dict([(resultKey(r),r) for r in json.load(fh)['results']])
+   with open(newPath,'r') as fh:
+      new = dict([(resultKey(r),r) for r in json.load(fh)['results']])
+   rows = []
+   for key in sorted(new.keys(),key=str):
+      if key not in base:
+         continue
+      for metric in ['ratio','encodeMBps','decodeMBps','peakRssMB','maxAbsError']:
+         vOld = base[key].get(metric)
+         vNew = new[key].get(metric)
+         if vOld is None or vNew is None:
+            continue
+         change = None
+         if vOld != 0:
+            change = (vNew - vOld)/abs(vOld)
+         rows.append((key,metric,vOld,vNew,change))
+   return rows
@@ -0,0 +1,188 @@
+# Declarative catalog of the NWM products pulled for hydroInspector.
+# Each entry describes where a product lives upstream, which
+# cycles/forecast hours exist, how files are named locally and on
+# hydro-c1-web, and which post-processing steps run before it is
+# published. The generic ingest engine (engineMod) works only from
+# this table, replacing the per-product process_*_Inspector drivers.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# Workflow settings shared by every product.
+config = {'email':'karsten@ucar.edu',
+          'lockDir':'/home/karsten/tmp',
+          'baseDir':'/d4/karsten/NWM_INSPECTOR',
+          'webHost':'hydro-c1-web',
+          'webUser':'karsten',
+          'ftpHost':'ftp.ncep.noaa.gov',
+          'metaDir':'/d4/karsten/NWM_INSPECTOR/geospatialMetaData',
+          'ledgerPath':'/d4/karsten/NWM_INSPECTOR/ledger/inspector_ledger.db',
+          'listingCache':'/d4/karsten/NWM_INSPECTOR/ledger/listings.json',
+          'manifestDir':'/d4/karsten/NWM_INSPECTOR/manifests',
+          'leaseDir':'/home/karsten/tmp/leases',
+          'nodeId':None,
+          'ledgerJournal':'WAL',
+          'metricsDir':'/d4/karsten/NWM_INSPECTOR/metrics',
+          'pipelineDepth':2,
+          'streamPublish':True,
+          'keepLocalCopy':False,
+          'webTransport':'ssh',
+          'webRoot':None,
+          'dedupStreams':['para'],
+          'partialFetch':False,
+          'decodeInMemory':False,
+          'spillBytes':256*1024*1024,
+          'spillDir':None,
+          'asIsStats':True,
+          'spatialIndex':True,
+          'indexDir':'/d4/karsten/NWM_INSPECTOR/spatialIndex',
+          'webIndexDir':'/d2/hydroinspector_data/tmp/conus/spatial_index',
+          'seriesStore':True,
+          'seriesDir':'/d4/karsten/NWM_INSPECTOR/series',
+          'seriesVars':['streamflow','velocity'],
+          'seriesFlushHours':8,
+          'seriesDays':3}
+
+# Geospatial metadata templates used by the compressNWM step.
+metaFiles = {'land':config['metaDir'] + '/WRF_Hydro_NWM_v1.1_geospatial_data_template_land_GIS.nc',
+             'channel_rt':config['metaDir'] + '/WRF_Hydro_NWM_v1.1_geospatial_data_template_channel_point_netcdf.nc',
+             'terrain_rt':config['metaDir'] + '/WRF_Hydro_NWM_v1.1_geospatial_data_template_terrain_GIS.nc',
+             'fe':config['metaDir'] + '/WRF_Hydro_NWM_v1.1_geospatial_data_template_land_GIS.nc'}
+
+# Upstream sources. Production output comes from NCEP's FTP server,
+# parallel (beta) output from the para NOMADS HTTP server. Directory
+# templates are filled in with the cycle date.
+streams = {'prod':{'source':'ftp',
+                   'remoteRoot':'/pub/data/nccf/com/nwm/prod/nwm.{ymd}',
+                   'dirSuffix':'',
+                   'webDirTmp':'/d2/karsten/INSPECTOR_TMP'},
+           'para':{'source':'http',
+                   'remoteRoot':'http://para.nomads.ncep.noaa.gov/pub/data/nccf/com/nwm/para/nwm.{ymd}',
+                   'dirSuffix':'_Para',
+                   'webDirTmp':'/d2/karsten/INSPECTOR_PARA_TMP'}}
+
+# Model ranges. cycles are the UTC cycle hours issued, hours the
+# forecast hours published for each cycle. The processing window
+# covers cycles from hoursBack to hoursLag hours before now.
+ranges = {'short_range':{'cycles':range(0,24),
+                         'hours':range(1,19),
+                         'hoursBack':24,
+                         'hoursLag':1,
+                         'localDir':'Short',
+                         'webDir':'short_range'},
+          'medium_range':{'cycles':[0,6,12,18],
+                          'hours':range(3,243,3),
+                          'hoursBack':36,
+                          'hoursLag':5,
+                          'localDir':'Medium',
+                          'webDir':'medium_range'},
+          'analysis_assim':{'cycles':range(0,24),
+                            'hours':[0],
+                            'hoursBack':24,
+                            'hoursLag':0,
+                            'localDir':'AAC',
+                            'webDir':'analysis_assimilation'}}
+
+# Short names used for each range in product names.
+rangeAbbrev = {'short_range':'short','medium_range':'medium','analysis_assim':'aac'}
+
+# Output kinds. forcing files are named 'fe' in flags and compressed
+# file names, and have RAINRATE rescaled by compressV11Forcing.
+kinds = {'channel_rt':{'nwmType':'channel_rt','steps':[]},
+         'land':{'nwmType':'land','steps':[]},
+         'terrain_rt':{'nwmType':'terrain_rt','steps':[]},
+         'forcing':{'nwmType':'fe','steps':['compressV11Forcing']}}
+
+# Short names used for each kind in product names.
+kindAbbrev = {'channel_rt':'channel','land':'land','terrain_rt':'terrain','forcing':'forcing'}
+
+# Per product overrides of the defaults above.
+overrides = {'short_forcing_para':{'hoursBack':26}}
+
+def nwmProduct(rangeName,kind,stream):
+   # Build the catalog entry for one range/kind/stream combination.
+   # Name templates are filled with: cyc (cycle hour, HH), ymd
+   # (cycle date), ymdh (cycle date and hour) and fhr (forecast
+   # hour, zero padded to three digits).
+   rangeInfo = ranges[rangeName]
+   streamInfo = streams[stream]
+   name = rangeAbbrev[rangeName] + '_' + kindAbbrev[kind]
+   if stream != 'prod':
+      name = name + '_' + stream
+
+   nwmType = kinds[kind]['nwmType']
+   if kind == 'forcing':
+      remoteDir = streamInfo['remoteRoot'] + '/forcing_' + rangeName
+      fileCompress = 'nwm.{ymd}_t{cyc}_f{fhr}.fe_' + rangeName + '.conus.COMPRESS.nc'
+   else:
+      remoteDir = streamInfo['remoteRoot'] + '/' + rangeName
+      fileCompress = 'nwm.{ymd}_t{cyc}_f{fhr}.' + rangeName + '.' + kind + '.conus.COMPRESS.nc'
+   if rangeName == 'analysis_assim':
+      remoteFile = 'nwm.t{cyc}z.' + rangeName + '.' + kind + '.tm00.conus.nc'
+   else:
+      remoteFile = 'nwm.t{cyc}z.' + rangeName + '.' + kind + '.f{fhr}.conus.nc'
+
+   product = {'name':name,
+              'range':rangeName,
+              'kind':kind,
+              'stream':stream,
+              'nwmType':nwmType,
+              'source':streamInfo['source'],
+              'remoteDir':remoteDir,
+              'remoteFile':remoteFile,
+              'fileCompress':fileCompress,
+              'completeFlag':'nwm.t{cyc}z.' + rangeName + '.' + nwmType + \
+                             '.tm00.conus_{ymdh}_f{fhr}.COMPLETE',
+              'completeDir':config['baseDir'] + '/' + rangeInfo['localDir'] + streamInfo['dirSuffix'],
+              'webDirTmp':streamInfo['webDirTmp'],
+              'webDirFinal':'/d2/hydroinspector_data/tmp/conus/' + stream + '/' + rangeInfo['webDir'],
+              'metaPath':metaFiles.get(nwmType),
+              'cycles':list(rangeInfo['cycles']),
+              'hours':list(rangeInfo['hours']),
+              'hoursBack':rangeInfo['hoursBack'],
+              'hoursLag':rangeInfo['hoursLag'],
+              'steps':list(kinds[kind]['steps'])}
+   product.update(overrides.get(name,{}))
+   return product
+
+# Full catalog, keyed by product name (e.g. short_land, medium_forcing_para,
+# aac_channel). Order matters: products sharing an upstream directory are
+# adjacent so listings are reused while still warm.
+productOrder = []
+products = {}
+for rangeName in ['analysis_assim','short_range','medium_range']:
+   for stream in ['prod','para']:
+      for kind in ['channel_rt','land','terrain_rt','forcing']:
+         entry = nwmProduct(rangeName,kind,stream)
+         productOrder.append(entry['name'])
+         products[entry['name']] = entry
+
+def useSharedDir(sharedDir):
+   # Keep the ledger, leases, listing cache and manifests under a
+   # directory shared by several ingest nodes (e.g. on NFS, or a local
+   # directory for nodes on one host).
+   config['ledgerPath'] = sharedDir + '/ledger/inspector_ledger.db'
+   config['listingCache'] = sharedDir + '/ledger/listings.json'
+   config['leaseDir'] = sharedDir + '/leases'
+   config['manifestDir'] = sharedDir + '/manifests'
+   config['ledgerJournal'] = 'DELETE'
+
+def selectProducts(names=None,rangeName=None,stream=None):
+   # Return catalog entries, in catalog order, matching an optional
+   # list of product names, range and stream.
+   selected = []
+   if names is not None:
+      for name in names:
+         if name not in products:
+            raise KeyError('Unknown product: ' + name)
+   for name in productOrder:
+      product = products[name]
+      if names is not None and name not in names:
+         continue
+      if rangeName is not None and product['range'] != rangeName:
+         continue
+      if stream is not None and product['stream'] != stream:
+         continue
+      selected.append(product)
+   return selected
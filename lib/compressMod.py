@@ -6,12 +6,19 @@
 # National Center for Atmospheric Research
 # Research Applications Laboratory
 
-import netCDF4
-import numpy as np
-from inspectorMod import *
+# netCDF4 and numpy are imported inside the functions that use them,
+# so drivers that never compress do not pay for loading them.
+from inspectorMod import errOut
+import json
+import os
 import re
+import time
+
+from metricsMod import metrics
 
 outNCType = 'NETCDF4'
+# zlib deflate level applied to every compressed output variable.
+compLevel = 2
 
 # Establish dictionary containing compression attributes needed.
 varOffsets = {'FSA':0.0,'FIRA':0.0,'GRDFLX':0.0,'HFX':0.0,'LH':0.0,\
@@ -23,7 +30,8 @@ varOffsets = {'FSA':0.0,'FIRA':0.0,'GRDFLX':0.0,'HFX':0.0,'LH':0.0,\
               'SOILICE':0.0,'SOILSAT_TOP':0.0,'SOILSAT':0.0,\
               'SNOWT':0.0,'zwattablrt':0.0,'sfcheadsubrt':0.0,\
               'streamflow':0.0,'nudge':0.0,'q_lateral':0.0,\
-              'velocity':0.0,'T2D':100.0,'U2D':0.0,'V2D':0.0,\
+              'velocity':0.0,'inflow':0.0,'outflow':0.0,\
+              'elevation':0.0,'T2D':100.0,'U2D':0.0,'V2D':0.0,\
               'SWDOWN':0.0,'LWDOWN':0.0,'Q2D':0.0,\
               'PSFC':0.0,'RAINRATE':0.0}
                   # Define scale_factor values to be used in compression.
@@ -37,7 +45,8 @@ varScaleFactors = {'FSA':0.1,'FIRA':0.1,'GRDFLX':0.1,'HFX':0.1,'LH':0.1,\
                    'SOILICE':0.01,'SOILSAT_TOP':0.001,'SOILSAT':0.001,\
                    'SNOWT':0.1,'zwattablrt':0.1,'sfcheadsubrt':1.0,\
                    'streamflow':0.1,'nudge':0.1,'q_lateral':0.1,\
-                   'velocity':0.01,'T2D':0.01,'U2D':0.001,'V2D':0.001,\
+                   'velocity':0.01,'inflow':0.01,'outflow':0.01,\
+                   'elevation':0.01,'T2D':0.01,'U2D':0.001,'V2D':0.001,\
                    'SWDOWN':0.001,'LWDOWN':0.001,'Q2D':0.000001,\
                    'PSFC':0.1,'RAINRATE':0.01}
                # For most variables, the output type will be 4-byte unsigned
@@ -52,40 +61,116 @@ vardTypeComp = {'FSA':u'i4','FIRA':u'i4','GRDFLX':u'i4','HFX':u'i4',\
                 'SOILSAT_TOP':u'i4','SOILSAT':u'i4','SNOWT_AVG':u'i4',\
                 'zwattablrt':u'i4','sfcheadsubrt':u'i4','streamflow':u'i4',
                 'nudge':u'i4','q_lateral':u'i4','velocity':u'i4',\
+                'inflow':u'i4','outflow':u'i4','elevation':u'i4',\
                 'T2D':u'i4','U2D':u'i4','V2D':u'i4','SWDOWN':u'i4',\
                 'LWDOWN':u'i4','Q2D':u'i4','PSFC':u'i4','RAINRATE':u'i4'}
              # Note that this is the valid range AFTER conversion to integer
-             # values.
-validRange = {'FSA':np.array((-1500,1500)),'FIRA':np.array((-1500,1500)),\
-              'GRDFLX':np.array((-1500,1500)),'HFX':np.array((-1500,1500)),
-              'LH':np.array((-1500,1500)),'UGDRNOFF':np.array((-5,30000)),\
-              'ACCECAN':np.array((-5,30000)),'ACCEDIR':np.array((-5,30000)),\
-              'ACCETRAN':np.array((-5,30000)),'SNOWT_AVG':np.array((0,400)),\
-              'SFCRNOFF':np.array((0,30000)),'TRAD':np.array((0,400)),\
-              'SNLIQ':np.array((0,30000)),'SOIL_T':np.array((0,400)),\
-              'SOIL_M':np.array((0,1)),'SNOWH':np.array((0,100000)),\
-              'SNEQV':np.array((0,100000)),'ISNOW':np.array((-10,10)),\
-              'FSNO':np.array((0,1)),'ACSNOM':np.array((0,100000)),\
-              'ACCET':np.array((-1000,100000)),'CANWAT':np.array((-5,30000)),\
-              'SOILICE':np.array((0,1)),'SOILSAT_TOP':np.array((0,1)),\
-              'SOILSAT':np.array((0,1)),'SNOWT':np.array((0,400)),\
-              'zwattablrt':np.array((0,10)),'sfcheadsubrt':np.array((0,1000000)),\
-              'streamflow':np.array((0,500000)),'nudge':np.array((-500000,500000)),\
-              'q_lateral':np.array((0,50000)),'velocity':np.array((0,10000)),\
-              'T2D':np.array((0,400)),'U2D':np.array((-100,100)),\
-              'V2D':np.array((-100,100)),'SWDOWN':np.array((-5000,5000)),\
-              'LWDOWN':np.array((-5000,5000)),'Q2D':np.array((0.0,1)),\
-              'PSFC':np.array((0,1000000)),'RAINRATE':np.array((0.0,100.0))}
+             # values. Kept as tuples so numpy is not needed at import time.
+validRange = {'FSA':(-1500,1500),'FIRA':(-1500,1500),\
+              'GRDFLX':(-1500,1500),'HFX':(-1500,1500),
+              'LH':(-1500,1500),'UGDRNOFF':(-5,30000),\
+              'ACCECAN':(-5,30000),'ACCEDIR':(-5,30000),\
+              'ACCETRAN':(-5,30000),'SNOWT_AVG':(0,400),\
+              'SFCRNOFF':(0,30000),'TRAD':(0,400),\
+              'SNLIQ':(0,30000),'SOIL_T':(0,400),\
+              'SOIL_M':(0,1),'SNOWH':(0,100000),\
+              'SNEQV':(0,100000),'ISNOW':(-10,10),\
+              'FSNO':(0,1),'ACSNOM':(0,100000),\
+              'ACCET':(-1000,100000),'CANWAT':(-5,30000),\
+              'SOILICE':(0,1),'SOILSAT_TOP':(0,1),\
+              'SOILSAT':(0,1),'SNOWT':(0,400),\
+              'zwattablrt':(0,10),'sfcheadsubrt':(0,1000000),\
+              'streamflow':(0,500000),'nudge':(-500000,500000),\
+              'q_lateral':(0,50000),'velocity':(0,10000),\
+              'inflow':(0,500000),'outflow':(0,500000),\
+              'elevation':(-500,10000),\
+              'T2D':(0,400),'U2D':(-100,100),\
+              'V2D':(-100,100),'SWDOWN':(-5000,5000),\
+              'LWDOWN':(-5000,5000),'Q2D':(0.0,1),\
+              'PSFC':(0,1000000),'RAINRATE':(0.0,100.0)}
 varsSkip = ['T2D','LWDOWN','SWDOWN','Q2D','U2D','V2D','PSFC',\
             'FSA','GRDFLX','HFX','LH','UGDRNOFF','ACCECAN','ACCEDIR',\
             'ACCETRAN','TRAD','SNLIQ','SOIL_T','SOIL_M','ISNOW',\
             'ACSNOM','CANWAT','SOILICE','FIRA']
 
+# Quantiles reported in the per-variable statistics (see valueStats).
+statsQuantiles = [0.02,0.1,0.25,0.5,0.75,0.9,0.98]
+
+def valueStats(values):
+   # Count, min, max, mean and quantiles of a 1-D float64 array of valid
+   # values, or None if it is empty. The quantiles are exact (linearly
+   # interpolated between ranks, as np.percentile), found by a partial
+   # sort (np.partition) rather than a full one.
+   import numpy as np
+   if len(values) == 0:
+      return None
+   stats = {'min':float(values.min()),
+            'max':float(values.max()),
+            'mean':float(values.mean(dtype='float64')),
+            'count':int(len(values))}
+   quantiles = np.percentile(values,[q*100.0 for q in statsQuantiles])
+   stats['quantiles'] = dict([('%g' % q,float(value)) for q,value in zip(statsQuantiles,quantiles)])
+   return stats
+
+def varStats(varname,values,var=None):
+   # Statistics of a variable's valid values (a numpy, possibly masked,
+   # array in physical units), also set as stats_* attributes on var,
+   # an output netCDF4 variable, when given.
+   import numpy as np
+   valid = np.ma.compressed(np.ma.masked_invalid(np.ma.asarray(values,dtype='float64')))
+   stats = valueStats(valid)
+   if stats is not None and var is not None:
+      var.setncattr('stats_min',stats['min'])
+      var.setncattr('stats_max',stats['max'])
+      var.setncattr('stats_mean',stats['mean'])
+      var.setncattr('stats_count',stats['count'])
+      var.setncattr('stats_quantile_levels',np.array(statsQuantiles))
+      var.setncattr('stats_quantiles',np.array([stats['quantiles']['%g' % q] for q in statsQuantiles]))
+   return stats
+
+def fileStats(source):
+   # Statistics of every variable with a valid range (see validRange)
+   # in a WRF-Hydro output file as downloaded, for products published
+   # without compression. source is as given to openInput.
+   idIn = openInput(source)
+   try:
+      stats = {}
+      for varname,ncvar in idIn.variables.items():
+         if varname not in validRange:
+            continue
+         varStat = varStats(varname,ncvar[:])
+         if varStat is not None:
+            stats[varname] = varStat
+      return stats
+   finally:
+      idIn.close()
+
+def statsJson(fileName,stats):
+   # Contents of the statistics sidecar (<file>.stats.json) of a file.
+   return json.dumps({'file':fileName,'variables':stats},sort_keys=True).encode('utf-8')
+
+def openInput(source):
+   # Open a WRF-Hydro output file for reading. source is a path, or a
+   # (name, buffer) pair for a file already held in memory (any object
+   # with the buffer interface: bytes, bytearray, numpy.memmap).
+   import netCDF4
+   if isinstance(source,tuple):
+      return netCDF4.Dataset(source[0],'r',memory=source[1])
+   return netCDF4.Dataset(source,'r')
+
+def inputSize(source):
+   # Size in bytes of an input given to openInput.
+   if isinstance(source,tuple):
+      return len(source[1])
+   return os.path.getsize(source)
+
 def test_metadata_input(in_nc, in_type, test_nc, errTitle, emailAddy, lockFile):
    '''Function for testing consistency between WRF-Hydro output type given and
       the spatial metadata file provided. Dimension names and lengths are used as
       comparison to ensure the correct domain is used by matching dimension sizes.'''
 
+   import netCDF4
+
    # Initiate test results
    test_results = False                                                        # Assume an inconsistency
    geogrid = False                                                             # Assume input is not a GEOGRID file
@@ -93,7 +178,7 @@ def test_metadata_input(in_nc, in_type, test_nc, errTitle, emailAddy, lockFile):
 
    # Open Dataset objects on input spatial metadata file and WRF output file
    rootgrp = netCDF4.Dataset(in_nc, 'r')                                       # Open spatial metadata file for reading
-   rootgrp2 = netCDF4.Dataset(test_nc, 'r')                                    # Open a WRF-Hydro output file for reading
+   rootgrp2 = openInput(test_nc)                                               # Open a WRF-Hydro output file for reading
 
    # Start comparing dimension sizes
    if in_type == 'land':
@@ -170,11 +255,20 @@ def test_metadata_input(in_nc, in_type, test_nc, errTitle, emailAddy, lockFile):
    return test_results, geogrid, gis_file
 
 def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,validTime,\
-         isGEOGRID=False, isGIS=False, isCompress=False):
+         isGEOGRID=False, isGIS=False, isCompress=False, memory=None, stats=None):
     '''This method will read each input file and write a new netCDF (NETCDF4_CLASSIC)
     file to the output directory. This can save substantial amounts of time because
     writing NETCDF4_CLASSIC variable attributes is very much faster using this method
-    than trying to edit or write to a NETCDF3 file.'''
+    than trying to edit or write to a NETCDF3 file. If memory (an initial buffer size
+    in bytes) is given, the output is built in memory instead of on disk and the
+    contents of the last file are returned. Entries of filesList may also be
+    (name, buffer) pairs of files held in memory (see openInput). Statistics of
+    each variable with a valid range are computed while its values are in memory
+    and set as stats_* attributes; if stats (a dictionary) is given, it is filled
+    with those of the last file, keyed by variable.'''
+
+    import netCDF4
+    import numpy as np
 
     # Open spatial metadata file for reading
     geo_nc = netCDF4.Dataset(in_nc, 'r')
@@ -252,8 +346,11 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
         # Open WRF output file for reading
 
         # WARNING - NetCDF3 is very slow! This script converts all outputs to NETCDF4
-        rootgrp1 = netCDF4.Dataset(wrf_file, 'r')                               # Open a netCDF4 write object on the output file
-        rootgrp2 = netCDF4.Dataset(newfile, 'w', format=outNCType)              # Open a write object on the output file. , format=rootgrp1.data_model
+        rootgrp1 = openInput(wrf_file)                                          # Open a netCDF4 write object on the output file
+        if memory is None:
+            rootgrp2 = netCDF4.Dataset(newfile, 'w', format=outNCType)          # Open a write object on the output file. , format=rootgrp1.data_model
+        else:
+            rootgrp2 = netCDF4.Dataset(newfile, 'w', format=outNCType, memory=memory)   # In-memory output, nothing written to disk
         rootgrp2.set_fill_on
 
         # Copy dimensions from WRF-Hydro output file, omitting variables that will be changed
@@ -291,7 +388,7 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
             if ncvar.dtype == 'int32':
 
                 if isCompress:
-                    var = rootgrp2.createVariable(varname, ncvar.dtype, varDims, zlib = True, complevel = 2) # Already integer, simply apply compression
+                    var = rootgrp2.createVariable(varname, ncvar.dtype, varDims, zlib = True, complevel = compLevel) # Already integer, simply apply compression
                 else:
                     var = rootgrp2.createVariable(varname, ncvar.dtype, varDims)
 
@@ -300,7 +397,7 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
                 if isCompress:
                     # Note that a default fill value of -9999 is chosen. However, like valid_range, this needs to be convered using the scale_factor
                     # in order for NetCDF libraries to properly maksk out values. 
-                    var = rootgrp2.createVariable(varname, vardTypeComp[varname], varDims, fill_value=-9999/varScaleFactors[varname], zlib = True, complevel = 2)
+                    var = rootgrp2.createVariable(varname, vardTypeComp[varname], varDims, fill_value=-9999/varScaleFactors[varname], zlib = True, complevel = compLevel)
                 else:
                     var = rootgrp2.createVariable(varname, ncvar.dtype, varDims, fill_value=fillValue)
 
@@ -337,12 +434,17 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
             var = rootgrp2.variables[varname]
             if isCompress:
                 if ncvar.dtype == 'int32':
-                    var[:] = ncvar[:]
+                    varTmp = ncvar[:]
+                    var[:] = varTmp
+                    if varname in validRange:
+                        varStat = varStats(varname, varTmp, var)          # Already packed, netCDF4 unpacks on read
+                        if stats is not None and varStat is not None:
+                            stats[varname] = varStat
                 else:
                     # Apply scale_factor and add_offset, except where floating point output has been specified above. 
                     varTmp = ncvar[:]
                     indNdv = np.where(varTmp == fillValue)
-                    indValid = np.where(varTmp != fillValue)
+                    indValid = np.where(np.ma.filled(varTmp != fillValue,False))   # Masked cells still hold the raw fill
                     varTmp[indNdv] = -9999/varScaleFactors[varname]
                     if vardTypeComp[varname] != 'f4':
                         # Special conversion for RAINRATE from mm/sec to mm/hour
@@ -357,9 +459,16 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
                     if vardTypeComp[varname] != 'f4':
                         var.scale_factor = varScaleFactors[varname]
                         var.add_offset = varOffsets[varname]
+                    # Statistics of the values as published, i.e. after packing
+                    varValid = np.ma.asarray(varTmp)[indValid]
+                    if vardTypeComp[varname] != 'f4':
+                        varValid = varValid*varScaleFactors[varname] + varOffsets[varname]
+                    varStat = varStats(varname, varValid, var)
+                    if stats is not None and varStat is not None:
+                        stats[varname] = varStat
                 # Set valid_range attributes
                 if varname in validRange:
-                    var.valid_range = validRange[varname]/varScaleFactors[varname]
+                    var.valid_range = np.array(validRange[varname])/varScaleFactors[varname]
             else:
                 var[:] = ncvar[:]                                                   # Copy the variable data into the newly created variable
         for varname in addVars:
@@ -377,24 +486,63 @@ def main(in_nc,filetype,out_path,filesList,errTitle,emailAddy,lockFile,initTime,
 
         # Close files
         rootgrp1.close()
-        rootgrp2.close()
-
-def compressNWM(fileIn,fileOut,nwmType,metaFile,errTitle,emailAddy,lockFile,initTime=None,validTime=None):
+        outBuffer = rootgrp2.close()
+
+    return outBuffer
+
+def hdf5Length(buf):
+   # Length of the HDF5 file at the start of buf, read from the
+   # end-of-file address in its superblock. In-memory netCDF buffers
+   # are allocated in larger steps than the file they hold.
+   import struct
+   head = bytearray(buf[:64])
+   if head[:8] != bytearray(b'\x89HDF\r\n\x1a\n'):
+      return len(buf)
+   if head[8] < 2:
+      sizeOffsets = head[13]
+      start = 24 if head[8] == 0 else 28
+   else:
+      sizeOffsets = head[9]
+      start = 12
+   fmt = {4:'<I',8:'<Q'}[sizeOffsets]
+   base = struct.unpack(fmt,bytes(head[start:start + sizeOffsets]))[0]
+   eof = struct.unpack(fmt,bytes(head[start + 2*sizeOffsets:start + 3*sizeOffsets]))[0]
+   return min(len(buf),base + eof)
+
+def compressNWM(fileIn,fileOut,nwmType,metaFile,errTitle,emailAddy,lockFile,initTime=None,validTime=None,\
+                inMemory=False,stats=None):
+   # Compress fileIn to fileOut. With inMemory, nothing is written to
+   # fileOut and the compressed file contents are returned instead,
+   # ready to be streamed to the web host. fileIn may be a (name,
+   # buffer) pair to read the input from memory (see openInput). stats,
+   # if given, is filled with per-variable statistics (see main).
    files_list = []
    files_list.append(fileIn)
 
    test_results, geogrid, gis_file = test_metadata_input(metaFile, nwmType, files_list[0],\
                                                          errTitle,emailAddy,lockFile)
-   main(metaFile,nwmType,fileOut,files_list,errTitle,emailAddy,lockFile,initTime,validTime,\
-        isGEOGRID=geogrid,isGIS=gis_file,isCompress=True)
-
-def compressV11Forcing(fileIn,errTitle,emailAddy,lockFile):
+   memory = None
+   if inMemory:
+      # Starting size only; the netCDF library grows the buffer as needed.
+      memory = inputSize(fileIn)
+   with metrics.timer('compress_nwm',nwmType) as timer:
+      outBuffer = main(metaFile,nwmType,fileOut,files_list,errTitle,emailAddy,lockFile,initTime,validTime,\
+                       isGEOGRID=geogrid,isGIS=gis_file,isCompress=True,memory=memory,stats=stats)
+      timer.bytes = inputSize(fileIn)
+   if inMemory:
+      return outBuffer[:hdf5Length(outBuffer)]
+
+def compressV11Forcing(fileIn,errTitle,emailAddy,lockFile,stats=None):
 	# This is a function for handling new v11 or higher forcing files. Most files now come
 	# post-processed. However, RAINRATE in the forcing files are not compressed. This 
-	# function converts them to mm/hr and adds a scale_factor / add_offset.
+	# function converts them to mm/hr and adds a scale_factor / add_offset. Statistics
+	# of the converted RAINRATE are set as stats_* attributes, and added to stats
+	# (a dictionary) if given.
 
 	from netCDF4 import Dataset
 
+	tStart = time.time()
+
 	# Open file into append mode
 	idIn = Dataset(fileIn,'a')
 
@@ -402,9 +550,17 @@ def compressV11Forcing(fileIn,errTitle,emailAddy,lockFile):
 	idIn.variables['RAINRATE'].scale_factor = 1.0
 	idIn.variables['RAINRATE'].add_offset = 0.0
 	# Convert mm/s to mm/hr and apply 
-	idIn.variables['RAINRATE'][:,:,:] = idIn.variables['RAINRATE'][:,:,:]*3600.0
+	rainRate = idIn.variables['RAINRATE'][:,:,:]*3600.0
+	idIn.variables['RAINRATE'][:,:,:] = rainRate
 	idIn.variables['RAINRATE'].units = 'mm hr^-1'
 
+	# Statistics for colorbars and legends
+	varStat = varStats('RAINRATE',rainRate,idIn.variables['RAINRATE'])
+	if stats is not None and varStat is not None:
+		stats['RAINRATE'] = varStat
+
 	# Close file
 	idIn.close()
+
+	metrics.record('compress_v11_forcing',time.time() - tStart,os.path.getsize(fileIn))
 	
@@ -0,0 +1,122 @@
+# Upstream discovery. Instead of asking, for every product, cycle and
+# forecast hour, whether a file exists, each upstream directory in
+# the products' windows is listed once per pass and compared with
+# the previous listing. Only names not seen before are matched
+# against the products' file name templates and turned into work
+# items, so discovery costs scale with new files, not with
+# products x cycles x forecast hours.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import logging
+import re
+
+import engineMod
+from metricsMod import metrics
+
+log = logging.getLogger('inspector')
+
+# Regular expressions for the catalog template fields.
+templateFields = {'cyc':r'\d{2}','fhr':r'\d{3}','ymd':r'\d{8}','ymdh':r'\d{10}'}
+
+def templatePattern(template):
+   # Compiled regular expression matching file names built from a
+   # catalog name template, with a named group per field.
+   parts = re.split(r'\{(\w+)\}',template)
+   regex = ''
+   used = set()
+   for index,part in enumerate(parts):
+      if index % 2 == 0:
+         regex += re.escape(part)
+      elif part in used:
+         regex += '(?P=' + part + ')'
+      else:
+         regex += '(?P<' + part + '>' + templateFields[part] + ')'
+         used.add(part)
+   return re.compile('^' + regex + '$')
+
+class Discovery(object):
+
+   def __init__(self):
+      # Names listed in each directory by the previous crawl.
+      self.seen = {}
+      self.patterns = {}
+
+   def pattern(self,product):
+      if product['name'] not in self.patterns:
+         self.patterns[product['name']] = templatePattern(product['remoteFile'])
+      return self.patterns[product['name']]
+
+   def routes(self,products,dNow):
+      # {(source type, remote dir): [(product, {cycle hour: cycle datetime})]}
+      # for every directory in the products' windows.
+      routes = {}
+      for product in products:
+         byDir = {}
+         for dCycle in engineMod.cycleWindow(product,dNow):
+            remoteDir = engineMod.WorkItem(product,dCycle,product['hours'][0]).remoteDir.rstrip('/')
+            byDir.setdefault(remoteDir,{})[dCycle.strftime('%H')] = dCycle
+         for remoteDir,cycles in byDir.items():
+            routes.setdefault((product['source'],remoteDir),[]).append((product,cycles))
+      return routes
+
+   def route(self,name,targets):
+      # (work items, deferred) for a newly listed file name. deferred is
+      # True if the name is a product's file whose cycle is not in the
+      # product's window (yet), so it must be routed again later.
+      items = []
+      deferred = False
+      for product,cycles in targets:
+         match = self.pattern(product).match(name)
+         if match is None:
+            continue
+         fields = match.groupdict()
+         dCycle = cycles.get(fields.get('cyc'))
+         if dCycle is None:
+            deferred = True
+            continue
+         fHour = int(fields['fhr']) if 'fhr' in fields else product['hours'][0]
+         if fHour in product['hours']:
+            items.append(engineMod.WorkItem(product,dCycle,fHour))
+      return items,deferred
+
+   def crawl(self,source,products,dNow):
+      # List each directory once and return work items for the files
+      # that appeared since the last crawl, oldest cycle first.
+      # source(kind) returns the upstream source of a type. Names
+      # deferred by route are not marked seen, so they are routed again
+      # once their cycle enters the window. A directory that cannot be
+      # listed is skipped and tried again on the next crawl.
+      routes = self.routes(products,dNow)
+      items = []
+      with metrics.timer('discovery'):
+         for (kind,remoteDir),targets in routes.items():
+            try:
+               listing = source(kind).listDir(remoteDir)
+            except IOError as e:
+               log.warning('Skipping %s this crawl: %s',remoteDir,e)
+               continue
+            seen = self.seen.get(remoteDir,set())
+            new = listing - seen
+            # Names that have left the listing are forgotten.
+            seen = seen & listing
+            for name in new:
+               routed,deferred = self.route(name,targets)
+               items.extend(routed)
+               if not deferred:
+                  seen.add(name)
+            self.seen[remoteDir] = seen
+      # Forget directories that have left every window.
+      remoteDirs = set([remoteDir for kind,remoteDir in routes.keys()])
+      for remoteDir in list(self.seen.keys()):
+         if remoteDir not in remoteDirs:
+            del self.seen[remoteDir]
+      order = dict([(product['name'],count) for count,product in enumerate(products)])
+      items.sort(key=lambda item: (item.dCycle,item.fHour,order[item.product['name']]))
+      return items
+
+   def reset(self):
+      # Treat every file as new on the next crawl.
+      self.seen = {}
@@ -0,0 +1,1012 @@
+# Generic ingest engine. Works through any subset of the products
+# in catalogMod within a single process: one connection per
+# upstream source, one listing per upstream directory per pass,
+# and a single schedule across all products (oldest cycles first).
+# The last completed stage of every item in progress is journaled in
+# the ledger, so a run that dies part way resumes where it stopped
+# instead of downloading again.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import calendar
+import datetime
+import logging
+import os
+import threading
+import time
+import zlib
+
+import catalogMod
+import inspectorMod
+import latencyMod
+import leaseMod
+import ledgerMod
+import pipelineMod
+import publishMod
+import seriesMod
+import sinkMod
+import sourceMod
+import spatialMod
+import transportMod
+from metricsMod import metrics
+
+log = logging.getLogger('inspector')
+
+class WorkItem(object):
+   # One product/cycle/forecast hour, with every path derived from
+   # the catalog name templates.
+
+   def __init__(self,product,dCycle,fHour):
+      self.product = product
+      self.dCycle = dCycle
+      self.fHour = fHour
+      fields = {'cyc':dCycle.strftime('%H'),
+                'ymd':dCycle.strftime('%Y%m%d'),
+                'ymdh':dCycle.strftime('%Y%m%d%H'),
+                'fhr':str(fHour).zfill(3)}
+      self.cycle = fields['ymdh']
+      self.remoteDir = product['remoteDir'].format(**fields)
+      self.remoteFile = product['remoteFile'].format(**fields)
+      self.fileCompress = product['fileCompress'].format(**fields)
+      self.localPath = os.path.join(product['completeDir'],self.remoteFile)
+      self.compressPath = os.path.join(product['completeDir'],self.fileCompress)
+      # Downloaded file contents, when held in memory instead of at
+      # localPath (see sinkMod.BufferSink).
+      self.rawData = None
+      # Compressed file contents, when built in memory instead of at
+      # compressPath.
+      self.compressData = None
+      # Download size and start time, for the ledger.
+      self.nBytes = None
+      self.tStart = None
+      # Upstream publication time and when the file was found upstream.
+      self.published = None
+      self.seen = None
+      # Content key of the upstream file, once it has been read.
+      self.digest = None
+      # Journal stage an interrupted run left the item at, when resumed.
+      self.resumed = None
+      # Per-variable statistics computed by the compression steps.
+      self.stats = None
+      # Hour to add to the item's time-series store, a path or (name,
+      # buffer) pair, when the download stage staged the item itself
+      # (streamed or deduplicated); the publish stage adds it.
+      self.seriesSource = None
+
+   def key(self):
+      return (self.product['name'],self.cycle,self.fHour)
+
+   def validTime(self):
+      return self.dCycle + datetime.timedelta(seconds=self.fHour*3600)
+
+   def __repr__(self):
+      return '%s %s f%03d' % (self.product['name'],self.cycle,self.fHour)
+
+def cycleWindow(product,dNow):
+   # Cycle datetimes inside a product's processing window, oldest first.
+   dHour = dNow.replace(minute=0,second=0,microsecond=0)
+   cycles = []
+   for hourBack in range(product['hoursBack'],product['hoursLag'],-1):
+      dCycle = dHour - datetime.timedelta(seconds=hourBack*3600)
+      if dCycle.hour in product['cycles']:
+         cycles.append(dCycle)
+   return cycles
+
+def workItems(product,dNow):
+   # Every item in a product's processing window.
+   items = []
+   for dCycle in cycleWindow(product,dNow):
+      for fHour in product['hours']:
+         items.append(WorkItem(product,dCycle,fHour))
+   return items
+
+def rangeCycles(product,dStart,dEnd):
+   # Cycle datetimes of a product between two datetimes (inclusive),
+   # oldest first, for backfilling an explicit period.
+   dCycle = dStart.replace(minute=0,second=0,microsecond=0)
+   cycles = []
+   while dCycle <= dEnd:
+      if dCycle.hour in product['cycles']:
+         cycles.append(dCycle)
+      dCycle = dCycle + datetime.timedelta(seconds=3600)
+   return cycles
+
+def contentKey(product,hexDigest):
+   # Key under which published files are deduplicated. The same
+   # upstream bytes put through the same post-processing give the
+   # same published file.
+   return '+'.join([product['nwmType']] + product['steps']) + ':' + hexDigest
+
+def parseShard(text):
+   # 'I/N' (1 <= I <= N) from the command line as a 0 based
+   # (index, count) for IngestEngine.shard.
+   try:
+      index,count = [int(part) for part in text.split('/')]
+   except ValueError:
+      raise ValueError('Shard must be I/N, e.g. 1/3: ' + text)
+   if count < 1 or index < 1 or index > count:
+      raise ValueError('Shard must be I/N with 1 <= I <= N: ' + text)
+   return index - 1,count
+
+def stepCompressV11Forcing(engine,item):
+   # Rescale RAINRATE in place on a v1.1 forcing file.
+   import compressMod
+   item.stats = {}
+   compressMod.compressV11Forcing(item.localPath,engine.errTitle,engine.email,engine.lockFile,stats=item.stats)
+
+def stepCompressNWM(engine,item):
+   # Full compression against the geospatial metadata template.
+   # Reads the download from memory when it was kept there, writes the
+   # compressed file (in memory when streaming to the web host) and
+   # discards the raw download.
+   import compressMod
+   product = item.product
+   fileIn = item.localPath
+   if item.rawData is not None:
+      fileIn = (item.localPath,item.rawData)
+   item.stats = {}
+   data = compressMod.compressNWM(fileIn,item.compressPath,product['nwmType'],product['metaPath'],\
+                                  engine.errTitle,engine.email,engine.lockFile,\
+                                  initTime=item.dCycle,validTime=item.validTime(),\
+                                  inMemory=catalogMod.config['streamPublish'],stats=item.stats)
+   if data is not None:
+      item.compressData = data
+   engine.discardRaw(item)
+
+# Post-processing steps a catalog entry may list, applied in order
+# to the downloaded file before it is published.
+steps = {'compressV11Forcing':stepCompressV11Forcing,
+         'compressNWM':stepCompressNWM}
+
+# Steps able to read the download from memory. compressV11Forcing
+# edits the file in place, which netCDF4 cannot do in memory (writing
+# a new file instead recompresses every variable, far slower). No
+# product in the current catalog uses compressNWM, so decodeInMemory
+# is off by default (see smoke_Ingest.py).
+memorySteps = ['compressNWM']
+
+# Steps editing the download in place. An item interrupted in one of
+# them cannot resume from its download.
+inPlaceSteps = ['compressV11Forcing']
+
+# Suffixes of the sidecars published next to a compressed file.
+sidecarSuffixes = ['.lookup.json','.stats.json']
+
+class IngestEngine(object):
+
+   def __init__(self,products,errTitle,lockFile,email=None,ledger=None,leases=None):
+      self.products = products
+      self.errTitle = errTitle
+      self.lockFile = lockFile
+      self.email = email or catalogMod.config['email']
+      if ledger is None:
+         ledger = ledgerMod.Ledger(catalogMod.config['ledgerPath'],journalMode=catalogMod.config['ledgerJournal'])
+      self.ledger = ledger
+      self.latency = latencyMod.LatencyModel(ledger)
+      if leases is None:
+         leases = leaseMod.LeaseManager(catalogMod.config['leaseDir'],node=catalogMod.config['nodeId'])
+      self.leases = leases
+      self.sources = {}
+      self.transport = None
+      self.batch = None
+      self.staged = {}
+      self.publishLock = threading.RLock()
+      self.nPublished = 0
+      # Optional download rate limit (bytes per second), see throttle.
+      self.maxRate = None
+      self.rateBytes = 0
+      self.rateStart = time.time()
+      self.failures = []
+      self.stopRequested = False
+      # Optional discoveryMod.Discovery driving the passes instead of
+      # the product windows, and the discovered items not yet complete.
+      self.discovery = None
+      self.carried = {}
+      # (index, count) when several nodes share the work: this node
+      # takes the items of its shard first, then helps with the rest.
+      self.shard = None
+      # (index path, digest) of the spatial index of each template
+      # published in this run (see prepareIndexes), and the templates
+      # found missing.
+      self.indexes = {}
+      self.missingTemplates = set()
+      # seriesMod.SeriesWriter for the per-reach time-series stores.
+      self.series = None
+      # Whether h5py, needed for partial downloads, is usable; None
+      # until first checked (see rangeSupport).
+      self.h5pyUsable = None
+
+   def source(self,kind):
+      # Shared, lazily created source per upstream type.
+      if kind not in self.sources:
+         if kind == 'ftp':
+            self.sources[kind] = sourceMod.FtpSource(catalogMod.config['ftpHost'])
+         elif kind == 'http':
+            self.sources[kind] = sourceMod.HttpSource()
+            self.sources[kind].seedIndexes(sourceMod.loadListingCache(catalogMod.config['listingCache']))
+         else:
+            raise ValueError('Unknown source type: ' + kind)
+      return self.sources[kind]
+
+   def isComplete(self,item):
+      return self.ledger.isComplete(*item.key())
+
+   def pendingItems(self,dNow):
+      # Items not yet complete, across all products, scheduled oldest
+      # cycle first so a backlog drains in order. One ledger query per
+      # product covers its whole window. Items the latency model says
+      # cannot be published yet are left out.
+      pending = []
+      now = calendar.timegm(dNow.timetuple())
+      for order,product in enumerate(self.products):
+         cycles = cycleWindow(product,dNow)
+         if len(cycles) == 0:
+            continue
+         done = self.ledger.completed(product['name'],ledgerMod.cycleStr(cycles[0]),\
+                                      ledgerMod.cycleStr(cycles[-1]))
+         for item in workItems(product,dNow):
+            if (item.cycle,item.fHour) in done:
+               continue
+            if self.latency.plausible(product,item.cycle,item.fHour,now):
+               pending.append((item.dCycle,item.fHour,order,item))
+      pending.sort(key=lambda entry: entry[:3])
+      return [entry[3] for entry in pending]
+
+   def available(self,item):
+      return self.source(item.product['source']).exists(item.remoteDir,item.remoteFile)
+
+   def download(self,item):
+      source = self.source(item.product['source'])
+      if self.partial(item):
+         import compressMod
+         nBytes = source.fetchPartial(item.remoteDir,item.remoteFile,item.localPath,compressMod.varsSkip)
+         if nBytes is not None:
+            return nBytes
+      if self.inMemory(item):
+         sinks = []
+         def openBuffer():
+            sinks[:] = [sinkMod.BufferSink(catalogMod.config['spillBytes'],catalogMod.config['spillDir'])]
+            return sinks[0]
+         nBytes = source.fetchTo(item.remoteDir,item.remoteFile,self.hashing(item,openBuffer))
+         item.rawData = sinks[0].buffer
+         return nBytes
+      return source.fetchTo(item.remoteDir,item.remoteFile,\
+                            self.hashing(item,lambda: sinkMod.FileSink(item.localPath)))
+
+   def inMemory(self,item):
+      # Keep the download in memory (or a memory mapped spill file)
+      # when every step can read it from there, saving a write and
+      # read of the raw file on the shared disk.
+      product = item.product
+      return catalogMod.config.get('decodeInMemory',False) and len(product['steps']) > 0 and \
+             len([name for name in product['steps'] if name not in memorySteps]) == 0
+
+   def discardRaw(self,item):
+      # Drop an item's raw download, in memory or on disk.
+      item.rawData = None
+      if os.path.isfile(item.localPath):
+         os.remove(item.localPath)
+
+   def partial(self,item):
+      # Items compressed with compressNWM never read the variables in
+      # compressMod.varsSkip, so HTTP sources may leave their data out
+      # of the download.
+      return catalogMod.config.get('partialFetch',False) and 'compressNWM' in item.product['steps'] and \
+             hasattr(self.source(item.product['source']),'fetchPartial') and self.rangeSupport()
+
+   def rangeSupport(self):
+      # True if h5py 2.10 or later, which rangeMod reads the remote
+      # file structure with, can be imported. Checked once per run;
+      # without it items are downloaded whole, and the reason logged.
+      if self.h5pyUsable is None:
+         try:
+            import h5py
+            if not hasattr(h5py.h5d.DatasetID,'get_num_chunks'):
+               raise ImportError('h5py ' + h5py.version.version + ' cannot list chunks, 2.10 or later is needed')
+            self.h5pyUsable = True
+         except Exception as e:
+            log.warning('Partial downloads disabled, downloading files whole: %s',e)
+            self.h5pyUsable = False
+      return self.h5pyUsable
+
+   def hashing(self,item,openSink):
+      # Wrap openSink so the upstream content is hashed as it is read,
+      # setting item.digest once a download commits. Each block read
+      # counts as progress on the item's lease.
+      def onClose(hexDigest):
+         item.digest = contentKey(item.product,hexDigest)
+      return lambda: sinkMod.HashSink(openSink(),onClose,lambda: self.leases.touch(item.key()))
+
+   def transform(self,item):
+      # Run the product's post-processing steps, leaving the final
+      # file at item.compressPath or in item.compressData.
+      if len([name for name in item.product['steps'] if name in inPlaceSteps]) > 0:
+         self.ledger.clearJournal(*item.key())
+      for stepName in item.product['steps']:
+         steps[stepName](self,item)
+      if item.compressData is None and os.path.isfile(item.localPath):
+         os.rename(item.localPath,item.compressPath)
+      if item.compressData is None and os.path.isfile(item.compressPath):
+         self.journal(item,ledgerMod.stageTransformed,item.compressPath)
+         if self.wantsStats(item):
+            self.asIsStats(item,item.compressPath)
+
+   def journal(self,item,stage,path,nBytes=None):
+      # Record the stage an item has reached. Local files are recorded
+      # with their size, so a resume can tell a complete file.
+      if nBytes is None:
+         nBytes = os.path.getsize(path)
+      self.ledger.journal(item.product['name'],item.cycle,item.fHour,stage,path,nBytes)
+
+   def resume(self,item):
+      # Pick an item up from the stage an interrupted run journaled:
+      # an upload is staged again, a local download or post-processed
+      # file goes on through the pipeline (item.resumed says where).
+      # Returns True if the item was resumed. Journal entries whose
+      # file is gone or incomplete are dropped, and the item starts over.
+      entry = self.ledger.journalEntry(*item.key())
+      if entry is None:
+         return False
+      stage,path,nBytes = entry
+      product = item.product
+      item.tStart = time.time()
+      if stage == ledgerMod.stageUploaded:
+         if self.webTransport().sizes([path]).get(path) == nBytes:
+            batchEntry = self.publishBatch().entry(item.fileCompress,nBytes,product['webDirTmp'],\
+                                                   product['webDirFinal'],\
+                                                   {'product':product['name'],'cycle':item.cycle,\
+                                                    'fhour':item.fHour,'resumed':stage})
+            if batchEntry['tmpPath'] == path:
+               log.info('Resuming %s from its upload',item)
+               metrics.record('resume',time.time() - item.tStart,nBytes,product['name'])
+               self.staging(item,batchEntry,nBytes,None)
+               return True
+      elif os.path.isfile(path) and os.path.getsize(path) == nBytes:
+         log.info('Resuming %s from %s file %s',item,stage,path)
+         metrics.record('resume',time.time() - item.tStart,nBytes,product['name'])
+         item.resumed = stage
+         item.nBytes = nBytes
+         return True
+      log.info('Journal entry of %s is stale, starting over',item)
+      self.ledger.clearJournal(*item.key())
+      return False
+
+   def outputKey(self,patterns,fileName):
+      # Ledger key of the item a compressed file, or one of its sidecars,
+      # belongs to. patterns is [(product, fileCompress pattern)]; None
+      # if the name matches none of them.
+      if fileName.endswith('.part'):
+         fileName = fileName[:-len('.part')]
+      for suffix in sidecarSuffixes:
+         if fileName.endswith(suffix):
+            fileName = fileName[:-len(suffix)]
+      for product,pattern in patterns:
+         match = pattern.match(fileName)
+         if match is None:
+            continue
+         fields = match.groupdict()
+         cycle = fields['ymdh'] if 'ymdh' in fields else fields['ymd'] + fields['cyc']
+         return product['name'],cycle,int(fields['fhr'])
+      return None
+
+   def collectGarbage(self,maxAge=3600):
+      # Remove files left behind by runs that died: partial downloads,
+      # raw and post-processed files in the products' completeDir and
+      # uploads in their webDirTmp that no journal entry can resume
+      # from. Only files older than maxAge seconds are touched, so the
+      # files of runs in progress are left alone. The webDirTmp
+      # directories are shared with other runs, nodes and the legacy
+      # drivers, so there only the products' compressed files and their
+      # sidecars are collected, and only if no live lease is held on
+      # their item. Time-series stores past their retention
+      # (seriesDays) go too. Returns the number of files removed.
+      from discoveryMod import templatePattern
+      keep = self.ledger.journalPaths()
+      cutoff = time.time() - maxAge
+      byDir = {}
+      for product in self.products:
+         byDir.setdefault(product['completeDir'],[]).append(product)
+      nRemoved = 0
+      for completeDir,products in byDir.items():
+         if not os.path.isdir(completeDir):
+            continue
+         rawPatterns = [templatePattern(product['remoteFile']) for product in products]
+         outPatterns = [templatePattern(product['fileCompress']) for product in products]
+         for fileName in os.listdir(completeDir):
+            path = os.path.join(completeDir,fileName)
+            if path in keep or not os.path.isfile(path) or os.path.getmtime(path) > cutoff:
+               continue
+            partial = fileName.endswith('.part')
+            if partial:
+               fileName = fileName[:-len('.part')]
+            isOut = len([pattern for pattern in outPatterns if pattern.match(fileName)]) > 0
+            isRaw = len([pattern for pattern in rawPatterns if pattern.match(fileName)]) > 0
+            if catalogMod.config['keepLocalCopy'] and isOut and not partial:
+               continue
+            if partial or isOut or isRaw:
+               os.remove(path)
+               nRemoved += 1
+      byTmpDir = {}
+      for product in self.products:
+         byTmpDir.setdefault(product['webDirTmp'],[]).append(product)
+      try:
+         for tmpDir,products in sorted(byTmpDir.items()):
+            patterns = [(product,templatePattern(product['fileCompress'])) for product in products]
+            orphans = []
+            for path in self.webTransport().stale(tmpDir,maxAge):
+               key = self.outputKey(patterns,path.split('/')[-1])
+               if path in keep or key is None or self.leases.live(key):
+                  continue
+               orphans.append(path)
+            self.webTransport().remove(orphans)
+            nRemoved += len(orphans)
+      except Exception:
+         log.exception('Unable to clean temporary directories on the web host')
+      if catalogMod.config.get('seriesStore',False):
+         nStores = seriesMod.prune(catalogMod.config['seriesDir'],catalogMod.config['seriesDays'])
+         if nStores > 0:
+            log.info('Removed %d time-series store(s) past retention',nStores)
+      if nRemoved > 0:
+         log.info('Removed %d orphaned file(s)',nRemoved)
+      return nRemoved
+
+   def openOutput(self,item,openSink):
+      # Sink for an item's published file, also writing a local copy
+      # to completeDir when configured.
+      if catalogMod.config['keepLocalCopy']:
+         return sinkMod.TeeSink([openSink(),sinkMod.FileSink(item.compressPath)])
+      return openSink()
+
+   def streamable(self,item):
+      # Products without post-processing go straight from upstream to
+      # the web host when streaming is enabled, unless they are
+      # deduplicated (which needs the content before uploading).
+      return catalogMod.config['streamPublish'] and len(item.product['steps']) == 0 and \
+             not self.dedups(item)
+
+   def dedups(self,item):
+      # Streams whose files are first checked against content already
+      # published (e.g. para, which often mirrors prod).
+      return item.product['stream'] in (catalogMod.config.get('dedupStreams') or [])
+
+   def publishDuplicate(self,item):
+      # If a file with the same content is already on the web host,
+      # stage a copy of it made there instead of transforming and
+      # uploading the download. Returns True if the item was staged.
+      if item.digest is None:
+         # Partial downloads are not hashed.
+         return False
+      found = self.ledger.findContent(item.digest)
+      if found is None:
+         return False
+      path,nBytes = found
+      product = item.product
+      tmpDir = product['webDirTmp']
+      tStart = time.time()
+      try:
+         self.webTransport().copy(path,tmpDir + '/' + item.fileCompress)
+      except Exception:
+         log.warning('Unable to copy %s for %s, publishing it normally',path,item)
+         return False
+      metrics.record('dedup',time.time() - tStart,nBytes,product['name'])
+      if self.wantsStats(item):
+         self.asIsStats(item,item.localPath if item.rawData is None else (item.remoteFile,item.rawData))
+      if self.seriesItem(item):
+         # The raw download is kept for the publish stage (see addQueuedSeries).
+         if item.rawData is not None:
+            item.seriesSource = (item.remoteFile,item.rawData)
+         else:
+            item.seriesSource = item.localPath
+      else:
+         self.discardRaw(item)
+      entry = self.publishBatch().entry(item.fileCompress,nBytes,tmpDir,product['webDirFinal'],\
+                                        {'product':product['name'],'cycle':item.cycle,'fhour':item.fHour,\
+                                         'copiedFrom':path})
+      self.staging(item,entry,item.nBytes,time.time() - item.tStart)
+      return True
+
+   def webTransport(self):
+      # Shared transport to hydro-c1-web, one SSH session for the run.
+      with self.publishLock:
+         if self.transport is None:
+            self.transport = transportMod.webTransport(catalogMod.config)
+            self.transport.connect()
+         return self.transport
+
+   def publishBatch(self):
+      with self.publishLock:
+         if self.batch is None:
+            self.batch = publishMod.PublishBatch(self.webTransport(),catalogMod.config['manifestDir'])
+         return self.batch
+
+   def staging(self,item,entry,nBytes,seconds):
+      # Add an uploaded item to the batch, remembering it until the
+      # batch is promoted.
+      with self.publishLock:
+         self.publishBatch().add(entry)
+         self.staged[entry['tmpPath']] = (item,nBytes,seconds)
+      self.ledger.setState(item.product['name'],item.cycle,item.fHour,ledgerMod.stateStaged,nBytes,seconds,\
+                           published=item.published,seen=item.seen,node=self.leases.node)
+      self.journal(item,ledgerMod.stageUploaded,entry['tmpPath'],entry['bytes'])
+      try:
+         self.stageSidecars(item)
+      except Exception:
+         log.exception('Unable to stage the sidecars of %s',item)
+      log.info('Staged %s',item)
+
+   def prepareIndexes(self):
+      # Build (if needed) and publish the spatial index of every
+      # product's geospatial template before a pass starts, so the
+      # pipeline stages only look them up. The index is published to
+      # webIndexDir if the web host's copy differs. A template that is
+      # missing or fails is tried again on the next pass.
+      if not catalogMod.config.get('spatialIndex',False):
+         return
+      for product in self.products:
+         metaPath = product.get('metaPath')
+         if metaPath is None or metaPath in self.indexes:
+            continue
+         if not os.path.isfile(metaPath):
+            if metaPath not in self.missingTemplates:
+               log.warning('No geospatial template %s, not indexing it',metaPath)
+               self.missingTemplates.add(metaPath)
+            continue
+         try:
+            indexPath = spatialMod.ensureIndex(metaPath,product['nwmType'],catalogMod.config['indexDir'])
+            webPath = catalogMod.config['webIndexDir'] + '/' + os.path.basename(indexPath)
+            transport = self.webTransport()
+            if transport.sizes([webPath]).get(webPath) != os.path.getsize(indexPath):
+               transport.publish(indexPath,product['webDirTmp'],catalogMod.config['webIndexDir'])
+               log.info('Published spatial index %s',webPath)
+            self.indexes[metaPath] = (indexPath,spatialMod.fileDigest(indexPath))
+         except Exception:
+            log.exception('Unable to prepare the spatial index of %s, retrying next pass',metaPath)
+
+   def spatialIndex(self,product):
+      # (path, digest) of the spatial index of a product's geospatial
+      # template, or None if it is not ready (see prepareIndexes).
+      return self.indexes.get(product['metaPath'])
+
+   def wantsStats(self,item):
+      # Products published as downloaded get their statistics from the
+      # download; compressors compute them for the others.
+      return catalogMod.config.get('asIsStats',False) and len(item.product['steps']) == 0
+
+   def asIsStats(self,item,source):
+      # Set item.stats from an item published as downloaded. source is
+      # a path or (name, buffer) pair. A failure only costs the item
+      # its statistics sidecar.
+      import compressMod
+      try:
+         with metrics.timer('stats',item.product['name']):
+            item.stats = compressMod.fileStats(source)
+      except Exception:
+         log.exception('Unable to compute the statistics of %s',item)
+
+   def stageSidecars(self,item):
+      # Stage the sidecars of an item with it, so they appear on the web
+      # host in the same promotion: the spatial lookup sidecar, and the
+      # per-variable statistics (see asIsStats for items not compressed).
+      product = item.product
+      if catalogMod.config.get('spatialIndex',False) and product.get('metaPath') is not None:
+         index = self.spatialIndex(product)
+         if index is not None:
+            self.stageSidecar(item,item.fileCompress + '.lookup.json',\
+                              spatialMod.sidecar(item.fileCompress,product['nwmType'],index[0],index[1],\
+                                                 initTime=item.dCycle,validTime=item.validTime()))
+      if item.stats:
+         import compressMod
+         self.stageSidecar(item,item.fileCompress + '.stats.json',compressMod.statsJson(item.fileCompress,item.stats))
+
+   def stageSidecar(self,item,fileName,data):
+      # Stage a small file published next to an item. It is journaled
+      # with the item, so it is not collected before the item is
+      # promoted.
+      product = item.product
+      self.ledger.journalFile(product['name'],item.cycle,item.fHour,product['webDirTmp'] + '/' + fileName)
+      def produce(openSink):
+         sink = openSink()
+         try:
+            sink.write(data)
+         except Exception:
+            sink.abort()
+            raise
+         return sink.close()
+      self.publishBatch().stageStream(fileName,product['webDirTmp'],\
+                                      product['webDirFinal'],produce,\
+                                      {'product':product['name'],'cycle':item.cycle,'fhour':item.fHour,\
+                                       'sidecarOf':item.fileCompress})
+
+   def seriesItem(self,item):
+      # Items whose hours also go into the reach-major time-series
+      # stores (see seriesMod).
+      return catalogMod.config.get('seriesStore',False) and item.product['nwmType'] == 'channel_rt'
+
+   def addSeries(self,item,source):
+      # Queue an item's hour for its cycle's time-series store. source
+      # is a path or (name, buffer) pair. A failure here only costs the
+      # store that hour, so it does not fail the item.
+      try:
+         if self.series is None:
+            config = catalogMod.config
+            self.series = seriesMod.SeriesWriter(config['seriesDir'],config['seriesVars'],\
+                                                 config['seriesFlushHours'])
+         self.series.add(item.product,item.cycle,item.fHour,source)
+      except Exception:
+         log.exception('Unable to add %s to its time-series store',item)
+
+   def addQueuedSeries(self,item):
+      # Add the hour of an item the download stage staged itself to its
+      # time-series store, then drop the raw download. Done in the
+      # publish stage, so the stores are only used from one thread.
+      self.addSeries(item,item.seriesSource)
+      item.seriesSource = None
+      self.discardRaw(item)
+
+   def flushSeries(self):
+      # Write the hours queued for the time-series stores.
+      if self.series is None:
+         return
+      try:
+         self.series.flush()
+      except Exception:
+         log.exception('Unable to write the time-series stores')
+
+   def publish(self,item,nBytes=None,seconds=None):
+      # Upload the file to the temporary directory on hydro-c1-web. It
+      # is moved into the directory hydroInspector reads when the
+      # batch is promoted (see promote).
+      product = item.product
+      info = {'product':product['name'],'cycle':item.cycle,'fhour':item.fHour}
+      if self.seriesItem(item):
+         if item.compressData is not None:
+            self.addSeries(item,(item.fileCompress,item.compressData))
+         else:
+            self.addSeries(item,item.compressPath)
+      if item.compressData is not None:
+         data = item.compressData
+         item.compressData = None
+         def produce(openSink):
+            sink = self.openOutput(item,openSink)
+            try:
+               sink.write(data)
+            except Exception:
+               sink.abort()
+               raise
+            return sink.close()
+         entry = self.publishBatch().uploadStream(item.fileCompress,product['webDirTmp'],product['webDirFinal'],\
+                                                  produce,info)
+      else:
+         entry = self.publishBatch().upload(item.compressPath,product['webDirTmp'],product['webDirFinal'],info)
+         if not catalogMod.config['keepLocalCopy']:
+            os.remove(item.compressPath)
+      self.staging(item,entry,nBytes,seconds)
+
+   def publishStream(self,item):
+      # Stream an item from upstream straight into the temporary
+      # directory on hydro-c1-web, never touching local disk unless a
+      # local copy is kept. Items going into the time-series stores, or
+      # getting statistics, are also kept in memory on the way; the
+      # former in item.seriesSource.
+      product = item.product
+      source = self.source(product['source'])
+      buffers = []
+      def openOutput(openSink):
+         sink = self.openOutput(item,openSink)
+         if not self.seriesItem(item) and not self.wantsStats(item):
+            return sink
+         buffers[:] = [sinkMod.BufferSink(catalogMod.config['spillBytes'],catalogMod.config['spillDir'])]
+         return sinkMod.TeeSink([sink,buffers[0]])
+      tStart = time.time()
+      entry = self.publishBatch().uploadStream(item.fileCompress,product['webDirTmp'],product['webDirFinal'],\
+                                               lambda openSink: source.fetchTo(item.remoteDir,item.remoteFile,\
+                                                  self.hashing(item,lambda: openOutput(openSink))),\
+                                               {'product':product['name'],'cycle':item.cycle,'fhour':item.fHour})
+      if len(buffers) > 0 and self.wantsStats(item):
+         self.asIsStats(item,(item.remoteFile,buffers[0].buffer))
+      self.staging(item,entry,entry['bytes'],time.time() - tStart)
+      if len(buffers) > 0 and self.seriesItem(item):
+         item.seriesSource = (item.remoteFile,buffers[0].buffer)
+      return entry['bytes']
+
+   def promote(self):
+      # Verify and promote every staged file at once, then record the
+      # promoted items as complete. Items failing verification are
+      # retried on a later pass.
+      with self.publishLock:
+         if len(self.staged) == 0:
+            return 0
+         staged = self.staged
+         self.staged = {}
+         try:
+            with metrics.timer('promote'):
+               good,bad = self.batch.promote()
+         except Exception as e:
+            log.exception('Failed to promote %d staged file(s)',len(staged))
+            self.failures.append('Promotion of %d staged file(s) failed: %s' % (len(staged),e))
+            try:
+               self.webTransport().remove(list(staged.keys()))
+            except Exception:
+               pass
+            for item,nBytes,seconds in staged.values():
+               self.ledger.clearJournal(*item.key())
+               self.leases.release(item.key())
+            return 0
+      live = time.time()
+      # Sidecars are promoted with their files but not tracked.
+      good = [entry for entry in good if entry['tmpPath'] in staged]
+      bad = [entry for entry in bad if entry['tmpPath'] in staged]
+      for entry in good:
+         item,nBytes,seconds = staged[entry['tmpPath']]
+         self.complete(item,nBytes,seconds,live)
+         if item.digest is not None:
+            self.ledger.recordContent(item.digest,entry['finalDir'] + '/' + entry['file'],entry['bytes'],live)
+         self.leases.release(item.key())
+         log.info('Published %s',item)
+      for entry in bad:
+         item = staged[entry['tmpPath']][0]
+         self.failures.append('%s: staged file failed verification' % item)
+         self.ledger.clearJournal(*item.key())
+         self.leases.release(item.key())
+      with self.publishLock:
+         self.nPublished += len(good)
+      return len(good)
+
+   def complete(self,item,nBytes=None,seconds=None,live=None):
+      self.ledger.markComplete(item.product['name'],item.cycle,item.fHour,nBytes,seconds,\
+                               published=item.published,seen=item.seen,live=live,node=self.leases.node)
+      self.ledger.clearJournal(*item.key())
+
+   def observe(self,item):
+      # Note when an item was found upstream and when upstream
+      # published it, for freshness tracking.
+      item.seen = time.time()
+      try:
+         item.published = self.source(item.product['source']).modified(item.remoteDir,item.remoteFile)
+      except Exception:
+         item.published = None
+
+   def fail(self,item,e):
+      # Record a failed item and remove its local files.
+      log.exception('Failed %s',item)
+      self.failures.append('%s: %s' % (item,e))
+      item.rawData = None
+      item.compressData = None
+      for path in [item.localPath,item.compressPath]:
+         if os.path.isfile(path):
+            os.remove(path)
+      self.ledger.clearJournal(*item.key())
+      self.leases.release(item.key())
+
+   def newPass(self):
+      # Upstream listings are cached for one pass.
+      for source in self.sources.values():
+         source.resetListings()
+
+   def runOnce(self,dNow=None):
+      # One pass over the window of every product.
+      if dNow is None:
+         dNow = datetime.datetime.utcnow()
+      if self.discovery is not None:
+         return self.runDiscovered(dNow)
+      self.newPass()
+      return self.runItems(self.pendingItems(dNow),dNow)
+
+   def runDiscovered(self,dNow=None):
+      # One pass over the files that appeared upstream since the last
+      # pass (see discoveryMod), plus discovered items not yet
+      # complete: failed, rejected, or held by another run.
+      if dNow is None:
+         dNow = datetime.datetime.utcnow()
+      self.newPass()
+      candidates = {}
+      for key,item in self.carried.items():
+         cycles = cycleWindow(item.product,dNow)
+         if len(cycles) > 0 and item.dCycle >= cycles[0]:
+            candidates[key] = WorkItem(item.product,item.dCycle,item.fHour)
+      for item in self.discovery.crawl(self.source,self.products,dNow):
+         candidates[item.key()] = item
+      order = dict([(product['name'],count) for count,product in enumerate(self.products)])
+      items = [item for item in candidates.values() if not self.isComplete(item)]
+      items.sort(key=lambda item: (item.dCycle,item.fHour,order[item.product['name']]))
+      log.info('Discovery found %d item(s) to process',len(items))
+      nDone = self.runItems(items,dNow)
+      self.carried = dict([(item.key(),item) for item in items if not self.isComplete(item)])
+      return nDone
+
+   def throttle(self,nBytes):
+      # Sleep as needed to hold the run's download rate to maxRate
+      # bytes per second, so a backfill leaves bandwidth for real-time
+      # ingest.
+      if self.maxRate is None:
+         return
+      self.rateBytes += nBytes or 0
+      ahead = self.rateBytes/float(self.maxRate) - (time.time() - self.rateStart)
+      if ahead > 0:
+         time.sleep(ahead)
+
+   def shardOrder(self,items):
+      # Items of this node's shard first, keeping the order within
+      # each group. Shards are assigned by a stable hash of the item
+      # key, so every node computes the same split.
+      if self.shard is None:
+         return items
+      index,count = self.shard
+      def inShard(item):
+         return (zlib.crc32(('%s/%s/%03d' % item.key()).encode('utf-8')) & 0xffffffff) % count == index
+      return [item for item in items if inShard(item)] + [item for item in items if not inShard(item)]
+
+   def runItems(self,items,dNow=None):
+      # Process a list of items. Items flow through a download ->
+      # transform -> publish pipeline, so the stages of consecutive
+      # files overlap. Failures are collected rather than aborting the
+      # run, so one bad file does not hold up every other product.
+      # Returns the number of items published.
+      if dNow is None:
+         dNow = datetime.datetime.utcnow()
+      now = calendar.timegm(dNow.timetuple())
+      nStart = self.nPublished
+      self.prepareIndexes()
+      items = self.shardOrder(items)
+      # Cycles still being published upstream arrive hour by hour, so
+      # once one hour is missing the later hours are not probed.
+      stalled = set()
+
+      def downloadStage(item):
+         # Upstream sources are only used from this stage's thread.
+         # Items are leased so an overlapping run skips them; the lease
+         # is held until the item is published or fails.
+         cycleKey = (item.product['name'],item.cycle)
+         if cycleKey in stalled:
+            return None
+         if not self.leases.acquire(item.key()):
+            return None
+         if self.isComplete(item):
+            # Finished by another run since the pass was planned.
+            self.leases.release(item.key())
+            return None
+         if self.resume(item):
+            if item.resumed is None:
+               return None
+            return item
+         if not self.available(item):
+            if self.latency.inProgress(item.product,item.cycle,now):
+               stalled.add(cycleKey)
+            self.leases.release(item.key())
+            return None
+         self.observe(item)
+         if self.streamable(item):
+            with metrics.timer('stream',item.product['name']) as timer:
+               timer.bytes = self.publishStream(item)
+            self.throttle(timer.bytes)
+            return queuedSeries(item)
+         item.tStart = time.time()
+         with metrics.timer('download',item.product['name']) as timer:
+            item.nBytes = self.download(item)
+            timer.bytes = item.nBytes
+         self.throttle(item.nBytes)
+         if item.rawData is None and os.path.isfile(item.localPath):
+            self.journal(item,ledgerMod.stageDownloaded,item.localPath)
+         if self.dedups(item) and self.publishDuplicate(item):
+            return queuedSeries(item)
+         return item
+
+      def queuedSeries(item):
+         # Items staged by this stage only go on if they still have an
+         # hour for the time-series stores.
+         if item.seriesSource is None:
+            return None
+         return item
+
+      def transformStage(item):
+         if item.resumed == ledgerMod.stageTransformed or item.seriesSource is not None:
+            return item
+         with metrics.timer('transform',item.product['name']):
+            self.transform(item)
+         return item
+
+      def publishStage(item):
+         if item.seriesSource is not None:
+            self.addQueuedSeries(item)
+            return None
+         with metrics.timer('publish',item.product['name']):
+            self.publish(item,item.nBytes,time.time() - item.tStart)
+         if self.batch.full():
+            self.promote()
+         # Items staged earlier wait on the batch, which is progressing.
+         with self.publishLock:
+            waiting = [entry[0].key() for entry in self.staged.values()]
+         for key in waiting:
+            self.leases.touch(key)
+         return None
+
+      def progressing(stage):
+         # Count an item entering and leaving a stage as progress on
+         # its lease, so the heartbeat keeps renewing it.
+         def run(item):
+            self.leases.touch(item.key())
+            try:
+               return stage(item)
+            finally:
+               self.leases.touch(item.key())
+         return run
+
+      # Upstream connections and netCDF/HDF5 are not thread safe, so
+      # each stage has a single worker. The time-series stores are only
+      # used from the publish stage.
+      stages = [('download',progressing(downloadStage),1),('transform',progressing(transformStage),1),\
+                ('publish',progressing(publishStage),1)]
+      pipeline = pipelineMod.Pipeline(stages,depth=catalogMod.config['pipelineDepth'],onError=self.fail)
+      self.leases.start()
+      try:
+         pipeline.run(items,stop=lambda: self.stopRequested)
+         # Publish everything staged in this pass together.
+         self.promote()
+      finally:
+         self.leases.stop()
+      self.flushSeries()
+      self.saveListings()
+      metrics.export(catalogMod.config['metricsDir'])
+      return self.nPublished - nStart
+
+   def saveListings(self):
+      # Keep this pass's upstream listings for the dry-run planner.
+      listings = {}
+      indexes = {}
+      for source in self.sources.values():
+         listings.update(source.listings)
+         indexes.update(getattr(source,'indexes',{}))
+      if len(listings) == 0:
+         return
+      try:
+         sourceMod.saveListingCache(catalogMod.config['listingCache'],listings,indexes)
+      except (IOError,OSError):
+         log.exception('Unable to save listing cache')
+
+   def serve(self,interval=60,reportInterval=3600):
+      # Daemon loop. Stays resident, keeping connections, HTTP
+      # sessions and the ledger open, and polls upstream every
+      # interval seconds. A pass that published something is followed
+      # immediately by another, since files of a cycle arrive in quick
+      # succession. Failure summaries are emailed, and orphaned files
+      # collected, at most once per reportInterval seconds.
+      self.collectGarbage()
+      lastReport = time.time()
+      while not self.stopRequested:
+         tStart = time.time()
+         for source in self.sources.values():
+            source.keepAlive()
+         if self.transport is not None:
+            self.transport.keepAlive()
+         # Reclaim leases of dead or hung runs, on any node.
+         self.leases.clean()
+         nDone = self.runOnce()
+         if time.time() - lastReport >= reportInterval:
+            self.reportFailures()
+            self.collectGarbage()
+            lastReport = time.time()
+         if nDone > 0:
+            continue
+         # Sleep in short steps so a stop request is honored promptly.
+         while not self.stopRequested and time.time() - tStart < interval:
+            time.sleep(1)
+      self.reportFailures()
+
+   def reportFailures(self):
+      # Email a single summary of every failure in this run.
+      if len(self.failures) == 0:
+         return
+      msg = 'ERROR: ' + str(len(self.failures)) + ' item(s) failed:\n' + '\n'.join(self.failures)
+      inspectorMod.sendEmail(msg,self.errTitle,self.email)
+      self.failures = []
+
+   def close(self):
+      for source in self.sources.values():
+         source.close()
+      self.sources = {}
+      if self.transport is not None:
+         self.transport.close()
+         self.transport = None
+      self.ledger.close()
@@ -5,19 +5,16 @@
 # National Center for Atmospheric Research
 # Research Applications Laboratory
 
-# Import necessary libraries
-import multiprocessing
+# Import necessary libraries. Heavier modules (ftplib, smtplib,
+# email, multiprocessing, requests, urllib) are imported inside
+# the functions that need them, so a run that finds nothing to do
+# does not pay for loading them.
 import os
 import sys
 import time
-import smtplib
-from ftplib import FTP
-from email.mime.text import MIMEText
 import glob
-import subprocess
-from bs4 import BeautifulSoup
-import requests
-import urllib
+
+from metricsMod import metrics
 
 def fetchFTP(ftp,cmd,outDir,fileDownload,errTitle,emailAddy,lockFile):
 	fetchStatus = False
@@ -31,7 +28,10 @@ def fetchFTP(ftp,cmd,outDir,fileDownload,errTitle,emailAddy,lockFile):
 			if fetchTries > 10:
 				errOutQuiet(lockFile)
 
-def errOut(msgContent,emailTitle,emailRec,lockFile):
+def sendEmail(msgContent,emailTitle,emailRec):
+   # Send a plain text email through the local SMTP server.
+   import smtplib
+   from email.mime.text import MIMEText
    msg = MIMEText(msgContent)
    msg['Subject'] = emailTitle
    msg['From'] = emailRec
@@ -39,6 +39,9 @@ def errOut(msgContent,emailTitle,emailRec,lockFile):
    s = smtplib.SMTP('localhost')
    s.sendmail(emailRec,[emailRec],msg.as_string())
    s.quit()
+
+def errOut(msgContent,emailTitle,emailRec,lockFile):
+   sendEmail(msgContent,emailTitle,emailRec)
    # Remove lock file
    os.remove(lockFile)
    sys.exit(1)
@@ -50,25 +53,75 @@ def errOutQuiet(lockFile):
 	sys.exit(1)
 
 def warningOut(msgContent,emailTitle,emailRec):
-   msg = MIMEText(msgContent)
-   msg['Subject'] = emailTitle
-   msg['From'] = emailRec
-   msg['To'] = emailRec
-   s = smtplib.SMTP('localhost')
-   s.sendmail(emailRec,[emailRec],msg.as_string())
-   s.quit()
+   sendEmail(msgContent,emailTitle,emailRec)
    sys.exit(1)
 
+def lockOwner(lockFile):
+   # PID written in a lock file ('' while it is being written), or None
+   # if the file is gone.
+   try:
+      with open(lockFile,'r') as fileLock:
+         return fileLock.readline().strip()
+   except (IOError,OSError):
+      return None
+
+def breakLock(lockFile):
+   # Remove a lock file whose owner has died. Returns True if it was
+   # removed. As in leaseMod.LeaseManager.breakLease, the file is
+   # renamed aside first so only one of several runs removes it, then
+   # checked again: if another run took the lock over in between, the
+   # renamed file holds a live PID and is linked back.
+   from leaseMod import pidAlive
+   brokenPath = lockFile + '.broken.' + str(os.getpid())
+   try:
+      os.rename(lockFile,brokenPath)
+   except OSError:
+      return False
+   pidLock = lockOwner(brokenPath)
+   stale = pidLock is not None and pidLock != '' and not pidAlive(pidLock)
+   if not stale:
+      try:
+         os.link(brokenPath,lockFile)
+      except OSError:
+         pass
+   os.remove(brokenPath)
+   return stale
+
+def cleanLocks(pattern):
+   # Remove the lock files matching a glob pattern left behind by runs
+   # that died without deleting them.
+   from leaseMod import pidAlive
+   for lockFile in glob.glob(pattern):
+      pidLock = lockOwner(lockFile)
+      if pidLock and not pidAlive(pidLock):
+         breakLock(lockFile)
+
 def createLock(lockFile,pid,warningTitle,emailAddy):
-   if os.path.isfile(lockFile):
-      fileLock = open(lockFile,'r')
-      pid = fileLock.readline()
-      warningMsg =  "WARNING: Another Pull Program Running. PID: " + pid
-      warningOut(warningMsg,warningTitle,emailAddy)
-   else:
-      fileLock = open(lockFile,'w')
+   # Take the lock, unless another live process holds it. A lock left
+   # behind by a process that no longer exists is taken over.
+   from leaseMod import pidAlive
+   for attempt in range(3):
+      try:
+         fd = os.open(lockFile,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0o644)
+      except OSError:
+         pidLock = lockOwner(lockFile)
+         if pidLock is None:
+            # Removed since, try again.
+            continue
+         if pidLock == '' or pidAlive(pidLock):
+            warningMsg =  "WARNING: Another Pull Program Running. PID: " + pidLock
+            warningOut(warningMsg,warningTitle,emailAddy)
+         breakLock(lockFile)
+         continue
+      fileLock = os.fdopen(fd,'w')
       fileLock.write(str(pid))
       fileLock.close()
+      # Write this run's stage metrics when it exits.
+      import metricsMod
+      metricsMod.enableExport()
+      return
+   warningMsg = "WARNING: Unable to take over stale lock file: " + lockFile
+   warningOut(warningMsg,warningTitle,emailAddy)
 
 def checkFile(fileCheck,errTitle,emailAddy,lockFile):
    # Generic routine to check for existence of file
@@ -110,6 +163,8 @@ def cleanOutDir(outDir,errTitle,emailAddy,lockFile):
 def downloadNWM(ftpDir,outDir,fileDownload,fileTmp,errTitle,emailAddy,lockFile):
 	# Download NWM output from NCEP FTP, then proceed to unzip the files
 	# to a specified directory.
+	import multiprocessing
+	from ftplib import FTP
 
    # Create FTP instance
 	ftpConnectTries = 0
@@ -132,13 +187,15 @@ def downloadNWM(ftpDir,outDir,fileDownload,fileTmp,errTitle,emailAddy,lockFile):
 	check = 0
 	while not dirChStatus:  
 		try:
-			ftp.cwd(ftpDir)
-			dirChStatus = True
-			fileList = ftp.nlst()
+			with metrics.timer('ftp_list'):
+				ftp.cwd(ftpDir)
+				dirChStatus = True
+				fileList = ftp.nlst()
 			for file in fileList:
 				if file == fileDownload:
 					check = 1
 		except:
+			metrics.retry('ftp_list')
 			dirChTries = dirChTries + 1
 			if dirChTries > 10:
 				errOutQuiet(lockFile)
@@ -149,12 +206,14 @@ def downloadNWM(ftpDir,outDir,fileDownload,fileTmp,errTitle,emailAddy,lockFile):
 	# Download gzip file
 	downloadTries = 0
 	downloadStatus = False
+	tStart = time.time()
 	while not downloadStatus:
 		cmd = "RETR " + fileDownload
 		p = multiprocessing.Process(target=fetchFTP,args=(ftp,cmd,outDir,fileDownload,errTitle,emailAddy,lockFile,))
 		p.start()
 		p.join(300)
 		if p.is_alive():
+			metrics.retry('ftp_fetch')
 			downloadTries = downloadTries + 1
 			p.terminate()
 			p.join()
@@ -163,6 +222,8 @@ def downloadNWM(ftpDir,outDir,fileDownload,fileTmp,errTitle,emailAddy,lockFile):
 		else:
 			# File was sucessfully downloaded
 			downloadStatus = True
+			if os.path.isfile(outDir + "/" + fileDownload):
+				metrics.record('ftp_fetch',time.time() - tStart,os.path.getsize(outDir + "/" + fileDownload))
 
 	# Quit FTP
 	ftpDisconnectTries = 0
@@ -186,12 +247,20 @@ def downloadNWM(ftpDir,outDir,fileDownload,fileTmp,errTitle,emailAddy,lockFile):
 
 def downloadNwmHTTP(httpDir,outDir,fileDownload,fileOut,errTitle,emailAddy,lockFile):
 	# Download NWM files from an HTTP NOMADS server.
-	# First list files in the directory.
-	ext = 'nc'
+	# First list files in the directory. The parsed listing is kept
+	# for the rest of the run and revalidated with a conditional
+	# request, so repeated calls for the same directory do not
+	# re-read and re-parse the page.
+	import urllib
+	import sourceMod
 	try:
-		page = requests.get(httpDir).text
-		soup = BeautifulSoup(page,'html.parser')
-		dirFiles = [httpDir + '/' + node.get('href') for node in soup.find_all('a') if node.get('href').endswith(ext)]
+		with metrics.timer('http_list'):
+			index = sourceMod.fetchIndex(httpSession(),httpDir,httpIndexes.get(httpDir))
+		if index is None:
+			dirFiles = set()
+		else:
+			httpIndexes[httpDir] = index
+			dirFiles = set(index['entries'].keys())
 	except:
 		errMsg = "ERROR: Unable to connect to: " + httpDir + " and retrieve listing"
 		errOut(errMsg,errTitle,emailAddy,lockFile)
@@ -200,19 +269,30 @@ def downloadNwmHTTP(httpDir,outDir,fileDownload,fileOut,errTitle,emailAddy,lockF
 	# Establish full path to expected file.
 	downloadPath = httpDir + '/' + fileDownload
 	outPath = outDir + "/" + fileOut
-	if len(dirFiles) != 0:
-		for fileCheck in dirFiles:
-			if fileCheck == downloadPath:
-				# Download the file
-				try:
-					objHandle = urllib.urlretrieve(fileCheck,outPath)
-					returnStatus = 1
-				except:
-					errMsg = "ERROR: Unable to retrieve file: " + fileCheck
-					errOut(errMsg,errTitle,emailAddy,lockFile)
+	if fileDownload in dirFiles:
+		# Download the file
+		try:
+			with metrics.timer('http_fetch') as timer:
+				objHandle = urllib.urlretrieve(downloadPath,outPath)
+				timer.bytes = os.path.getsize(outPath)
+			returnStatus = 1
+		except:
+			errMsg = "ERROR: Unable to retrieve file: " + downloadPath
+			errOut(errMsg,errTitle,emailAddy,lockFile)
 
 	return returnStatus
 
+# HTTP session and parsed directory indexes shared by the calls to
+# downloadNwmHTTP within a run.
+httpIndexes = {}
+httpSessions = []
+
+def httpSession():
+	import requests
+	if len(httpSessions) == 0:
+		httpSessions.append(requests.Session())
+	return httpSessions[0]
+
 def renameFile(fileIn,fileOut,errTitle,emailAddy,lockFile):
 	# Rename a file.
 	try:
@@ -221,11 +301,25 @@ def renameFile(fileIn,fileOut,errTitle,emailAddy,lockFile):
 		errMsg = "ERROR: Failure to rename file from: " + fileIn + " to: " + fileOut
 		errOut(errMsg,errTitle,emailAddy,lockFile)
 
+# Transport to hydro-c1-web shared by every copy/move in this
+# process, so a driver publishing many files opens one SSH session.
+webTransport = None
+
+def getWebTransport():
+   global webTransport
+   if webTransport is None:
+      import catalogMod
+      import transportMod
+      webTransport = transportMod.webTransport(catalogMod.config)
+      webTransport.connect()
+   return webTransport
+
 def copyToWeb(fileCopy,webDir,errTitle,emailAddy,lockFile):
    # Copy file to directory on web server
-   cmd = 'scp -q -o LogLevel=QUIET ' + fileCopy + ' hydro-c1-web:' + webDir
    try:
-      subprocess.call(cmd,shell=True)
+      with metrics.timer('upload') as timer:
+         getWebTransport().put(fileCopy,webDir)
+         timer.bytes = os.path.getsize(fileCopy)
    except:
       errMsg = "ERROR: Failure to Copy: " + fileCopy + " To: " + webDir
       errOut(errMsg,errTitle,emailAddy,lockFile)
@@ -233,22 +327,20 @@ def copyToWeb(fileCopy,webDir,errTitle,emailAddy,lockFile):
 def shuffleFile(fileCompress,webDirFinal,webDirTmp,errTitle,emailAddy,lockFile):
    # Perform final move of data from temporary directory
    # on hydro-c1-web to final directory through atomic move.
-   cmdP = 'ssh karsten@hydro-c1-web chmod 777 ' + webDirTmp + '/' + \
-          fileCompress
-   cmd = 'ssh karsten@hydro-c1-web mv ' + webDirTmp + '/' + \
-         fileCompress + ' ' + webDirFinal
    try:
-      subprocess.call(cmdP,shell=True)
-      subprocess.call(cmd,shell=True)
+      transport = getWebTransport()
+      with metrics.timer('promote'):
+         transport.chmod(webDirTmp + '/' + fileCompress,0o777)
+         transport.move(webDirTmp + '/' + fileCompress,webDirFinal)
    except:
       errMsg = "ERROR: Failure to move: " + fileCompress + " To: " + webDirFinal
       errOut(errMsg,errTitle,emailAddy,lockFile)
 
 def genFlag(completeFlagPath,errTitle,emailAddy,lockFile):
    # Generate empty flag file 
-   cmd = 'touch ' + completeFlagPath
    try:
-      subprocess.call(cmd,shell=True)
+      open(completeFlagPath,'a').close()
+      os.utime(completeFlagPath,None)
    except:
       errMsg = "ERROR: Unable to Generate Flag File: " + completeFlagPath
       errOut(errMsg,errTitle,emailAddy,lockFile)
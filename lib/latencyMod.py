@@ -0,0 +1,144 @@
+# Publication latency model. Learns, from the completion ledger,
+# how long after its cycle time each forecast hour of a product
+# typically becomes available upstream, so the engine only probes
+# cycle/hour pairs that could plausibly be published yet and can
+# tell a cycle still being published from one that has finished.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import calendar
+import datetime
+import time
+
+def cycleEpoch(cycle):
+   # UTC epoch seconds of a ledger cycle key (YYYYMMDDHH).
+   return calendar.timegm(datetime.datetime.strptime(cycle,'%Y%m%d%H').timetuple())
+
+def percentile(values,pct):
+   # Nearest rank percentile of a non-empty list.
+   values = sorted(values)
+   rank = int(round(pct/100.0*(len(values) - 1)))
+   return values[rank]
+
+def fitLine(points):
+   # Least squares intercept and slope through (x, y) points.
+   n = float(len(points))
+   meanX = sum([x for x,y in points])/n
+   meanY = sum([y for x,y in points])/n
+   varX = sum([(x - meanX)**2 for x,y in points])
+   if varX == 0:
+      return meanY,0.0
+   slope = sum([(x - meanX)*(y - meanY) for x,y in points])/varX
+   return meanY - slope*meanX,slope
+
+class LatencyModel(object):
+   # Per product arrival offsets (seconds after cycle time) by
+   # forecast hour, from upstream publication times where recorded and
+   # completion times (an upper bound) otherwise. A low percentile of
+   # the history is used as the earliest plausible arrival, less a
+   # slack that lets the model follow upstream if it starts
+   # publishing sooner. Hours with too
+   # little history are filled in from a straight line fitted to the
+   # others (delay plus per-hour cadence). A product without enough
+   # history is never restricted.
+
+   def __init__(self,ledger,historyDays=7,pct=10,slack=600,minSamples=3,refresh=3600):
+      self.ledger = ledger
+      self.historyDays = historyDays
+      self.pct = pct
+      self.slack = slack
+      self.minSamples = minSamples
+      self.refresh = refresh
+      self.offsets = {}
+      self.loaded = {}
+
+   def learn(self,product,now=None):
+      # (Re)build a product's offsets from the ledger.
+      if now is None:
+         now = time.time()
+      since = datetime.datetime.utcfromtimestamp(now) - datetime.timedelta(days=self.historyDays)
+      samples = {}
+      for cycle,fHour,available in self.ledger.history(product['name'],since.strftime('%Y%m%d%H')):
+         samples.setdefault(fHour,[]).append(available - cycleEpoch(cycle))
+      known = {}
+      for fHour,values in samples.items():
+         if len(values) >= self.minSamples:
+            known[fHour] = percentile(values,self.pct)
+      offsets = {}
+      if len(known) > 0:
+         intercept,slope = fitLine(list(known.items()))
+         for fHour in product['hours']:
+            if fHour in known:
+               offsets[fHour] = known[fHour]
+            elif len(known) > 1:
+               offsets[fHour] = intercept + slope*fHour
+      self.offsets[product['name']] = offsets
+      self.loaded[product['name']] = now
+      return offsets
+
+   def productOffsets(self,product,now):
+      name = product['name']
+      if name not in self.loaded or now - self.loaded[name] >= self.refresh:
+         return self.learn(product,now)
+      return self.offsets[name]
+
+   def expected(self,product,cycle,fHour,now=None):
+      # Earliest plausible arrival (epoch seconds) of an item, or None
+      # when the product has no usable history for that hour.
+      if now is None:
+         now = time.time()
+      offset = self.productOffsets(product,now).get(fHour)
+      if offset is None:
+         return None
+      return cycleEpoch(cycle) + offset - self.slack
+
+   def plausible(self,product,cycle,fHour,now=None):
+      # True if the item may already be published upstream.
+      if now is None:
+         now = time.time()
+      expected = self.expected(product,cycle,fHour,now)
+      return expected is None or now >= expected
+
+   def inProgress(self,product,cycle,now=None):
+      # True while the last forecast hour of a cycle is not expected
+      # yet, i.e. upstream is still publishing it hour by hour.
+      if now is None:
+         now = time.time()
+      expected = self.expected(product,cycle,max(product['hours']),now)
+      return expected is not None and now < expected
+
+   def reset(self):
+      self.offsets = {}
+      self.loaded = {}
+
+def freshness(ledger,products,days=7,pcts=(50,90,99)):
+   # Upstream-to-live latency percentiles (seconds) per product and
+   # per range/stream group, over the last days of cycles. Also
+   # reports the two legs: upstream-to-seen (how quickly we notice a
+   # new file) and seen-to-live (our own processing and publishing).
+   since = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).strftime('%Y%m%d%H')
+   groups = {}
+   for product in products:
+      rows = ledger.freshness(product['name'],since)
+      for key in [product['name'],product['range'] + '/' + product['stream']]:
+         group = groups.setdefault(key,{'total':[],'detect':[],'process':[]})
+         for published,seen,live in rows:
+            if published is not None:
+               group['total'].append(live - published)
+               if seen is not None:
+                  group['detect'].append(seen - published)
+            if seen is not None:
+               group['process'].append(live - seen)
+   report = {}
+   for key,group in groups.items():
+      report[key] = {}
+      for leg,values in group.items():
+         stats = {'count':len(values)}
+         if len(values) > 0:
+            for pct in pcts:
+               stats['p' + str(pct)] = percentile(values,pct)
+            stats['max'] = max(values)
+         report[key][leg] = stats
+   return report
@@ -0,0 +1,226 @@
+# Work leases. Instead of one lock per script, each product/cycle/
+# forecast hour being worked on is claimed with a small lease file,
+# so overlapping runs split the remaining work between them. Leases
+# carry the owner's host and PID and are refreshed by a heartbeat
+# while their item makes progress; a lease whose owner has died, or
+# whose heartbeat has stopped, is taken over, so a crashed or hung run
+# never blocks ingest. With the lease
+# directory on a shared filesystem, several ingest nodes split the
+# work the same way; each lease names the node holding it.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import errno
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+def pidAlive(pid):
+   # True if a process with this PID exists on this host.
+   try:
+      os.kill(int(pid),0)
+   except (OSError,ValueError) as e:
+      return isinstance(e,OSError) and e.errno == errno.EPERM
+   return True
+
+class LeaseManager(object):
+
+   def __init__(self,leaseDir,staleSeconds=900,heartbeat=60,node=None):
+      self.leaseDir = leaseDir
+      self.staleSeconds = staleSeconds
+      self.heartbeat = heartbeat
+      self.host = socket.gethostname()
+      self.node = node or self.host
+      self.pid = os.getpid()
+      self.held = set()
+      # Time each held key last made progress (see touch).
+      self.progress = {}
+      self.lock = threading.Lock()
+      self.thread = None
+      self.stopEvent = threading.Event()
+
+   def path(self,key):
+      # Lease file for a (product, cycle, fhour) key.
+      product,cycle,fHour = key
+      return os.path.join(self.leaseDir,product,'%s_f%03d.lease' % (cycle,fHour))
+
+   def owner(self,leasePath):
+      # Contents of a lease file, or None if it is gone or unreadable
+      # (e.g. still being written).
+      try:
+         with open(leasePath,'r') as fh:
+            return json.load(fh)
+      except (IOError,OSError,ValueError):
+         return None
+
+   def isStale(self,leasePath):
+      # A lease is stale when its owner is a dead process on this host,
+      # or its heartbeat is older than staleSeconds (owners on other
+      # hosts, or a hung process).
+      try:
+         age = time.time() - os.path.getmtime(leasePath)
+      except OSError:
+         return False
+      if age > self.staleSeconds:
+         return True
+      owner = self.owner(leasePath)
+      if owner is None:
+         return False
+      return owner.get('host') == self.host and not pidAlive(owner.get('pid'))
+
+   def create(self,leasePath):
+      # Atomically create a lease file. Returns False if it exists.
+      try:
+         fd = os.open(leasePath,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0o644)
+      except OSError as e:
+         if e.errno == errno.EEXIST:
+            return False
+         raise
+      with os.fdopen(fd,'w') as fh:
+         json.dump({'node':self.node,'host':self.host,'pid':self.pid,'acquired':time.time()},fh)
+      return True
+
+   def breakLease(self,leasePath):
+      # Remove a stale lease. Returns True if it was removed. Renaming
+      # first means only one of several runs noticing the same stale
+      # lease removes it. Another run may have broken the stale lease
+      # and created a fresh one between our check and the rename, so
+      # the renamed file is checked again and, if fresh, linked back
+      # (a link, unlike a rename, never replaces a lease created since).
+      brokenPath = leasePath + '.broken.' + self.host + '.' + str(self.pid)
+      try:
+         os.rename(leasePath,brokenPath)
+      except OSError:
+         return False
+      stale = self.isStale(brokenPath)
+      if not stale:
+         try:
+            os.link(brokenPath,leasePath)
+         except OSError:
+            pass
+      os.remove(brokenPath)
+      return stale
+
+   def acquire(self,key):
+      # Claim a work item. Returns False if another live run holds it.
+      leasePath = self.path(key)
+      leaseDir = os.path.dirname(leasePath)
+      if not os.path.isdir(leaseDir):
+         try:
+            os.makedirs(leaseDir)
+         except OSError as e:
+            if e.errno != errno.EEXIST:
+               raise
+      if not self.create(leasePath):
+         if not self.isStale(leasePath):
+            return False
+         self.breakLease(leasePath)
+         if not self.create(leasePath):
+            return False
+      with self.lock:
+         self.held.add(key)
+         self.progress[key] = time.time()
+      return True
+
+   def touch(self,key):
+      # Note that the work on a held key is progressing. Only leases
+      # touched within staleSeconds are renewed by the heartbeat, so
+      # the leases of a hung run go stale and are taken over.
+      with self.lock:
+         if key in self.held:
+            self.progress[key] = time.time()
+
+   def live(self,key):
+      # True if some run, on any node, holds a lease on a key that is
+      # not stale.
+      leasePath = self.path(key)
+      return os.path.isfile(leasePath) and not self.isStale(leasePath)
+
+   def release(self,key):
+      with self.lock:
+         if key not in self.held:
+            return
+         self.held.discard(key)
+         self.progress.pop(key,None)
+      try:
+         os.remove(self.path(key))
+      except OSError:
+         pass
+
+   def renew(self):
+      # Refresh the heartbeat of every lease held whose work has made
+      # progress within staleSeconds.
+      now = time.time()
+      with self.lock:
+         held = [key for key in self.held if now - self.progress.get(key,0) < self.staleSeconds]
+      for key in held:
+         try:
+            os.utime(self.path(key),None)
+         except OSError:
+            pass
+
+   def beat(self):
+      while not self.stopEvent.wait(self.heartbeat):
+         self.renew()
+
+   def start(self):
+      # Start the heartbeat thread.
+      if self.thread is None:
+         self.stopEvent.clear()
+         self.thread = threading.Thread(target=self.beat,name='lease-heartbeat')
+         self.thread.daemon = True
+         self.thread.start()
+
+   def stop(self):
+      # Stop the heartbeat and release every lease still held.
+      if self.thread is not None:
+         self.stopEvent.set()
+         self.thread.join()
+         self.thread = None
+      with self.lock:
+         held = list(self.held)
+      for key in held:
+         self.release(key)
+
+   def active(self):
+      # Every lease present, as (key, owner, heartbeat age in seconds,
+      # stale), for reporting who is working on what.
+      leases = []
+      if not os.path.isdir(self.leaseDir):
+         return leases
+      for product in sorted(os.listdir(self.leaseDir)):
+         productDir = os.path.join(self.leaseDir,product)
+         if not os.path.isdir(productDir):
+            continue
+         for fileName in sorted(os.listdir(productDir)):
+            match = re.match(r'^(\d{10})_f(\d{3})\.lease$',fileName)
+            if match is None:
+               continue
+            leasePath = os.path.join(productDir,fileName)
+            try:
+               age = time.time() - os.path.getmtime(leasePath)
+            except OSError:
+               continue
+            leases.append(((product,match.group(1),int(match.group(2))),self.owner(leasePath) or {},\
+                           age,self.isStale(leasePath)))
+      return leases
+
+   def clean(self):
+      # Remove stale leases left behind by crashed runs. Returns the
+      # number removed.
+      nStale = 0
+      if not os.path.isdir(self.leaseDir):
+         return 0
+      for dirPath,dirNames,fileNames in os.walk(self.leaseDir):
+         for fileName in fileNames:
+            if not fileName.endswith('.lease'):
+               continue
+            leasePath = os.path.join(dirPath,fileName)
+            if self.isStale(leasePath) and self.breakLease(leasePath):
+               nStale += 1
+      return nStale
@@ -0,0 +1,308 @@
+# Completion ledger. Records the state of every product/cycle/
+# forecast hour in a local SQLite database, replacing the per-file
+# .COMPLETE flags: one indexed query answers "what is missing in
+# this window" for a product, old entries are compacted away, and
+# existing flag files can be migrated in. Several ingest nodes may
+# share one ledger on a shared filesystem, opened with
+# journalMode='DELETE' (WAL needs shared memory between the
+# processes, which network filesystems do not provide). A stage
+# journal records how far each item in progress got, so a run that
+# dies part way resumes from the last completed stage.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import calendar
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Item states. Only 'complete' items are skipped by the engine;
+# 'staged' items are uploaded but not yet promoted on the web host.
+stateComplete = 'complete'
+stateStaged = 'staged'
+
+# Journal stages of an item in progress, in order: the download is
+# at its local path, the post-processed file is at its local path,
+# or the file is uploaded to its temporary path on the web host.
+stageDownloaded = 'downloaded'
+stageTransformed = 'transformed'
+stageUploaded = 'uploaded'
+
+schema = ["""CREATE TABLE IF NOT EXISTS items (
+                product TEXT NOT NULL,
+                cycle TEXT NOT NULL,
+                fhour INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL NOT NULL,
+                bytes INTEGER,
+                seconds REAL,
+                published REAL,
+                seen REAL,
+                live REAL,
+                node TEXT,
+                PRIMARY KEY (product, cycle, fhour))""",
+          """CREATE INDEX IF NOT EXISTS items_cycle ON items (cycle)""",
+          """CREATE TABLE IF NOT EXISTS content (
+                digest TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                updated REAL NOT NULL)""",
+          """CREATE TABLE IF NOT EXISTS journal (
+                product TEXT NOT NULL,
+                cycle TEXT NOT NULL,
+                fhour INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                path TEXT NOT NULL,
+                bytes INTEGER,
+                updated REAL NOT NULL,
+                PRIMARY KEY (product, cycle, fhour))""",
+          """CREATE TABLE IF NOT EXISTS journal_files (
+                product TEXT NOT NULL,
+                cycle TEXT NOT NULL,
+                fhour INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (product, cycle, fhour, path))"""]
+
+# Freshness columns added after the first release of the ledger:
+# upstream publication time, when we first found the file upstream
+# and when it went live on the web host (epoch seconds).
+timeColumns = ['published','seen','live']
+# Columns added since, with their types: the ingest node that
+# processed the item.
+addedColumns = [(column,'REAL') for column in timeColumns] + [('node','TEXT')]
+
+def cycleStr(dCycle):
+   # Ledger cycle key (YYYYMMDDHH) for a datetime.
+   return dCycle.strftime('%Y%m%d%H')
+
+class Ledger(object):
+
+   def __init__(self,path,timeout=60,journalMode='WAL'):
+      self.path = path
+      dirName = os.path.dirname(path)
+      if dirName != '' and not os.path.isdir(dirName):
+         os.makedirs(dirName)
+      # One connection shared by the threads of a process, serialized
+      # by a lock. Other processes are handled by SQLite's own locking.
+      self.lock = threading.RLock()
+      self.conn = sqlite3.connect(path,timeout=timeout,check_same_thread=False)
+      self.conn.execute('PRAGMA journal_mode=' + journalMode)
+      self.conn.execute('PRAGMA synchronous=NORMAL')
+      with self.lock:
+         with self.conn:
+            for statement in schema:
+               self.conn.execute(statement)
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(items)')]
+            for column,columnType in addedColumns:
+               if column not in columns:
+                  self.conn.execute('ALTER TABLE items ADD COLUMN ' + column + ' ' + columnType)
+
+   def setState(self,product,cycle,fHour,state,nBytes=None,seconds=None,updated=None,\
+                published=None,seen=None,live=None,node=None):
+      # Record the state of one item in its own transaction.
+      if updated is None:
+         updated = time.time()
+      with self.lock:
+         with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO items (product,cycle,fhour,state,updated,bytes,seconds,' + \
+                              'published,seen,live,node) VALUES (?,?,?,?,?,?,?,?,?,?,?)',\
+                              (product,cycle,fHour,state,updated,nBytes,seconds,published,seen,live,node))
+
+   def markComplete(self,product,cycle,fHour,nBytes=None,seconds=None,published=None,seen=None,live=None,\
+                    node=None):
+      self.setState(product,cycle,fHour,stateComplete,nBytes,seconds,\
+                    published=published,seen=seen,live=live,node=node)
+
+   def getState(self,product,cycle,fHour):
+      with self.lock:
+         row = self.conn.execute('SELECT state FROM items WHERE product=? AND cycle=? AND fhour=?',\
+                                 (product,cycle,fHour)).fetchone()
+      if row is None:
+         return None
+      return row[0]
+
+   def isComplete(self,product,cycle,fHour):
+      return self.getState(product,cycle,fHour) == stateComplete
+
+   def completed(self,product,cycleStart,cycleEnd):
+      # Set of (cycle, fhour) complete for a product between two cycle
+      # keys (inclusive), in a single indexed query.
+      with self.lock:
+         rows = self.conn.execute('SELECT cycle,fhour FROM items WHERE product=? AND state=? ' + \
+                                  'AND cycle BETWEEN ? AND ?',\
+                                  (product,stateComplete,cycleStart,cycleEnd)).fetchall()
+      return set([(row[0],row[1]) for row in rows])
+
+   def missing(self,product,cycles,hours):
+      # (cycle, fhour) pairs in the window formed by cycles x hours
+      # that are not complete, oldest first.
+      if len(cycles) == 0:
+         return []
+      done = self.completed(product,min(cycles),max(cycles))
+      return [(cycle,fHour) for cycle in sorted(cycles) for fHour in hours \
+              if (cycle,fHour) not in done]
+
+   def history(self,product,cycleStart):
+      # (cycle, fhour, availability time) of complete items for a
+      # product from cycleStart onward, used to learn publication
+      # latency. The upstream publication time is used when known,
+      # the completion time otherwise.
+      with self.lock:
+         return self.conn.execute('SELECT cycle,fhour,COALESCE(published,updated) FROM items ' + \
+                                  'WHERE product=? AND state=? AND cycle >= ?',\
+                                  (product,stateComplete,cycleStart)).fetchall()
+
+   def freshness(self,product,cycleStart):
+      # (published, seen, live) of complete items for a product from
+      # cycleStart onward that have freshness times recorded.
+      with self.lock:
+         return self.conn.execute('SELECT published,seen,live FROM items WHERE product=? AND state=? ' + \
+                                  'AND cycle >= ? AND live IS NOT NULL',\
+                                  (product,stateComplete,cycleStart)).fetchall()
+
+   def throughput(self,product,cycleStart):
+      # (items, mean bytes, mean seconds) of complete items for a
+      # product from cycleStart onward that recorded them.
+      with self.lock:
+         return self.conn.execute('SELECT COUNT(*),AVG(bytes),AVG(seconds) FROM items WHERE product=? ' + \
+                                  'AND state=? AND cycle >= ? AND bytes IS NOT NULL AND seconds IS NOT NULL',\
+                                  (product,stateComplete,cycleStart)).fetchone()
+
+   def findContent(self,digest):
+      # (web path, bytes) of the last published file with this content
+      # key, or None.
+      with self.lock:
+         return self.conn.execute('SELECT path,bytes FROM content WHERE digest=?',(digest,)).fetchone()
+
+   def recordContent(self,digest,path,nBytes,updated=None):
+      # Remember where a file with this content key was published.
+      if updated is None:
+         updated = time.time()
+      with self.lock:
+         with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO content (digest,path,bytes,updated) VALUES (?,?,?,?)',\
+                              (digest,path,nBytes,updated))
+
+   def journal(self,product,cycle,fHour,stage,path,nBytes=None):
+      # Record the last completed stage of an item in progress and
+      # where its file is.
+      with self.lock:
+         with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO journal (product,cycle,fhour,stage,path,bytes,updated) ' + \
+                              'VALUES (?,?,?,?,?,?,?)',(product,cycle,fHour,stage,path,nBytes,time.time()))
+
+   def journalEntry(self,product,cycle,fHour):
+      # (stage, path, bytes) of an item in progress, or None.
+      with self.lock:
+         return self.conn.execute('SELECT stage,path,bytes FROM journal WHERE product=? AND cycle=? AND fhour=?',\
+                                  (product,cycle,fHour)).fetchone()
+
+   def journalFile(self,product,cycle,fHour,path):
+      # Record another file an item in progress has put in place (e.g.
+      # a sidecar staged with its upload), kept until the journal of
+      # the item is cleared.
+      with self.lock:
+         with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO journal_files (product,cycle,fhour,path) VALUES (?,?,?,?)',\
+                              (product,cycle,fHour,path))
+
+   def clearJournal(self,product,cycle,fHour):
+      with self.lock:
+         with self.conn:
+            for table in ['journal','journal_files']:
+               self.conn.execute('DELETE FROM ' + table + ' WHERE product=? AND cycle=? AND fhour=?',\
+                                 (product,cycle,fHour))
+
+   def journalPaths(self):
+      # Set of file paths, local or on the web host, that journaled
+      # items may still resume from or still need.
+      with self.lock:
+         return set([row[0] for row in self.conn.execute('SELECT path FROM journal UNION SELECT path FROM journal_files')])
+
+   def compact(self,maxAgeDays,now=None):
+      # Delete entries for cycles older than maxAgeDays, with their
+      # journal entries, and content records not refreshed in that
+      # time, and reclaim the space. Returns the number of item
+      # entries removed.
+      if now is None:
+         now = datetime.datetime.utcnow()
+      cutoff = cycleStr(now - datetime.timedelta(days=maxAgeDays))
+      with self.lock:
+         with self.conn:
+            nDel = self.conn.execute('DELETE FROM items WHERE cycle < ?',(cutoff,)).rowcount
+            self.conn.execute('DELETE FROM journal WHERE cycle < ?',(cutoff,))
+            self.conn.execute('DELETE FROM journal_files WHERE cycle < ?',(cutoff,))
+            self.conn.execute('DELETE FROM content WHERE updated < ?',\
+                              (calendar.timegm(now.timetuple()) - maxAgeDays*86400,))
+         self.conn.execute('VACUUM')
+      return nDel
+
+   def progress(self,since):
+      # (node, items, bytes, last update) of items completed since an
+      # epoch time, per ingest node.
+      with self.lock:
+         return self.conn.execute('SELECT COALESCE(node,\'-\'),COUNT(*),SUM(bytes),MAX(updated) FROM items ' + \
+                                  'WHERE state=? AND updated >= ? GROUP BY node ORDER BY node',\
+                                  (stateComplete,since)).fetchall()
+
+   def summary(self):
+      # Entry counts per product and state.
+      with self.lock:
+         return self.conn.execute('SELECT product,state,COUNT(*),MIN(cycle),MAX(cycle) FROM items ' + \
+                                  'GROUP BY product,state ORDER BY product,state').fetchall()
+
+   def close(self):
+      with self.lock:
+         self.conn.close()
+
+def flagPattern(product):
+   # Compiled regular expression matching a product's .COMPLETE flag
+   # file names, built from its catalog name template.
+   pattern = re.escape(product['completeFlag'])
+   # re.escape also escapes the braces of the template fields.
+   for field,regex in [('cyc','(?P<cyc>\\d{2})'),('ymdh','(?P<ymdh>\\d{10})'),\
+                       ('ymd','(?P<ymd>\\d{8})'),('fhr','(?P<fhr>\\d{3})')]:
+      pattern = re.sub(r'\\?\{' + field + r'\\?\}',lambda m: regex,pattern)
+   return re.compile('^' + pattern + '$')
+
+def migrateFlags(ledger,products,removeFlags=False):
+   # Import existing .COMPLETE flag files into the ledger, using each
+   # flag's modification time as the completion time. Each completion
+   # directory is listed once, however many products share it.
+   # Returns the number of flags imported.
+   byDir = {}
+   for product in products:
+      byDir.setdefault(product['completeDir'],[]).append((product['name'],flagPattern(product)))
+   nFlags = 0
+   for completeDir,patterns in byDir.items():
+      if not os.path.isdir(completeDir):
+         continue
+      rows = []
+      flagPaths = []
+      for fileName in os.listdir(completeDir):
+         if not fileName.endswith('.COMPLETE'):
+            continue
+         for name,pattern in patterns:
+            match = pattern.match(fileName)
+            if match is None:
+               continue
+            flagPath = os.path.join(completeDir,fileName)
+            rows.append((name,match.group('ymdh'),int(match.group('fhr')),stateComplete,\
+                         os.path.getmtime(flagPath)))
+            flagPaths.append(flagPath)
+            break
+      with ledger.lock:
+         with ledger.conn:
+            # Never overwrite an entry the ledger already holds.
+            ledger.conn.executemany('INSERT OR IGNORE INTO items (product,cycle,fhour,state,updated) ' + \
+                                    'VALUES (?,?,?,?,?)',rows)
+      nFlags += len(rows)
+      if removeFlags:
+         for flagPath in flagPaths:
+            os.remove(flagPath)
+   return nFlags
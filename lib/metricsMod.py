@@ -0,0 +1,153 @@
+# Runtime metrics. Records, per stage (list, download, compress,
+# upload, promote, ...) and optionally per product, how many times it
+# ran, how long it took, how many bytes it moved and how often it had
+# to retry or failed. Exported as a Prometheus textfile (for the
+# node_exporter textfile collector) and a JSON run summary.
+# Recording is a dictionary update under a lock, so it stays on in
+# production.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+fields = ['count','seconds','maxSeconds','bytes','retries','errors']
+
+class Timer(object):
+   # Context manager timing one run of a stage. Exceptions count as
+   # errors and are re-raised.
+
+   def __init__(self,registry,stage,product):
+      self.registry = registry
+      self.stage = stage
+      self.product = product
+      self.bytes = 0
+
+   def __enter__(self):
+      self.tStart = time.time()
+      return self
+
+   def __exit__(self,excType,excValue,excTb):
+      self.registry.record(self.stage,time.time() - self.tStart,self.bytes,self.product,\
+                           error=excType is not None and issubclass(excType,Exception))
+      return False
+
+class Metrics(object):
+
+   def __init__(self,job=None):
+      if job is None:
+         job = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+      self.job = job
+      self.started = time.time()
+      self.stages = {}
+      self.lock = threading.Lock()
+      self.exportDir = None
+
+   def entry(self,stage,product):
+      key = (stage,product or '')
+      if key not in self.stages:
+         self.stages[key] = dict([(field,0) for field in fields])
+      return self.stages[key]
+
+   def timer(self,stage,product=None):
+      # with metrics.timer('download','short_land') as t: ... t.bytes = n
+      return Timer(self,stage,product)
+
+   def record(self,stage,seconds,nBytes=0,product=None,error=False):
+      with self.lock:
+         entry = self.entry(stage,product)
+         entry['count'] += 1
+         entry['seconds'] += seconds
+         entry['maxSeconds'] = max(entry['maxSeconds'],seconds)
+         entry['bytes'] += nBytes or 0
+         if error:
+            entry['errors'] += 1
+
+   def retry(self,stage,product=None):
+      with self.lock:
+         self.entry(stage,product)['retries'] += 1
+
+   def snapshot(self):
+      with self.lock:
+         return dict([(key,dict(entry)) for key,entry in self.stages.items()])
+
+   def promText(self):
+      # Prometheus text exposition format.
+      stages = self.snapshot()
+      lines = []
+      series = [('count','inspector_stage_runs_total','counter','Stage executions.'),
+                ('seconds','inspector_stage_seconds_total','counter','Time spent in the stage.'),
+                ('maxSeconds','inspector_stage_seconds_max','gauge','Longest single execution.'),
+                ('bytes','inspector_stage_bytes_total','counter','Bytes moved by the stage.'),
+                ('retries','inspector_stage_retries_total','counter','Retried attempts.'),
+                ('errors','inspector_stage_errors_total','counter','Failed executions.')]
+      for field,name,kind,helpText in series:
+         lines.append('# HELP ' + name + ' ' + helpText)
+         lines.append('# TYPE ' + name + ' ' + kind)
+         for (stage,product),entry in sorted(stages.items()):
+            labels = 'job="%s",stage="%s"' % (self.job,stage)
+            if product != '':
+               labels += ',product="%s"' % product
+            lines.append('%s{%s} %s' % (name,labels,repr(float(entry[field]))))
+      lines.append('# HELP inspector_run_timestamp_seconds Time the metrics were written.')
+      lines.append('# TYPE inspector_run_timestamp_seconds gauge')
+      lines.append('inspector_run_timestamp_seconds{job="%s"} %.3f' % (self.job,time.time()))
+      lines.append('# HELP inspector_run_duration_seconds Time since the process started.')
+      lines.append('# TYPE inspector_run_duration_seconds gauge')
+      lines.append('inspector_run_duration_seconds{job="%s"} %.3f' % (self.job,time.time() - self.started))
+      return '\n'.join(lines) + '\n'
+
+   def summary(self):
+      stages = []
+      for (stage,product),entry in sorted(self.snapshot().items()):
+         item = {'stage':stage,'product':product}
+         item.update(entry)
+         if entry['seconds'] > 0:
+            item['mbPerSecond'] = entry['bytes']/entry['seconds']/1e6
+         stages.append(item)
+      return {'job':self.job,
+              'started':self.started,
+              'finished':time.time(),
+              'seconds':time.time() - self.started,
+              'stages':stages}
+
+   def export(self,outDir=None):
+      # Write <job>.prom and <job>.json into outDir, each replaced
+      # atomically so readers never see a partial file.
+      outDir = outDir or self.exportDir
+      if outDir is None:
+         return
+      if not os.path.isdir(outDir):
+         os.makedirs(outDir)
+      for suffix,text in [('.prom',self.promText()),('.json',json.dumps(self.summary(),indent=1))]:
+         outPath = os.path.join(outDir,'inspector_' + self.job + suffix)
+         with open(outPath + '.tmp','w') as fh:
+            fh.write(text)
+         os.rename(outPath + '.tmp',outPath)
+
+   def exportAtExit(self,outDir):
+      # Export when the process exits, including through errOut.
+      if self.exportDir is None:
+         atexit.register(self.exportQuietly)
+      self.exportDir = outDir
+
+   def exportQuietly(self):
+      try:
+         self.export()
+      except Exception:
+         pass
+
+# Process wide registry used by the workflow libraries.
+metrics = Metrics()
+
+def enableExport():
+   # Export the process wide metrics to config['metricsDir'] at exit.
+   import catalogMod
+   if catalogMod.config.get('metricsDir') is not None:
+      metrics.exportAtExit(catalogMod.config['metricsDir'])
@@ -0,0 +1,105 @@
+# Staged processing pipeline. Each stage runs in its own worker
+# thread(s), connected by bounded queues, so while one file is
+# compressed the next is downloading and the previous one uploading.
+# Throughput approaches that of the slowest stage, and the queue
+# depth bounds how many files (and in-memory buffers) are in flight.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import logging
+import sys
+import threading
+
+try:
+   import queue
+except ImportError:
+   import Queue as queue
+
+log = logging.getLogger('inspector')
+
+# Marks the end of the input on a queue.
+done = object()
+
+# reraise(excType, excValue, excTb) raises an exception saved with
+# sys.exc_info() again, with its original traceback.
+if sys.version_info[0] >= 3:
+   def reraise(excType,excValue,excTb):
+      raise excValue.with_traceback(excTb)
+else:
+   exec('def reraise(excType,excValue,excTb):\n   raise excType, excValue, excTb\n')
+
+class Pipeline(object):
+   # stages is a list of (name, function, workers). Each function
+   # takes an item and returns the item to pass to the next stage,
+   # or None to drop it. onError(item, exception) is called for an
+   # item whose stage raised an Exception; the item is dropped and
+   # the pipeline carries on (an exception from onError itself is
+   # logged, so the stage keeps draining). Anything else (e.g.
+   # SystemExit from errOut) stops the pipeline and is re-raised by
+   # run().
+
+   def __init__(self,stages,depth=2,onError=None):
+      self.stages = stages
+      self.depth = depth
+      self.onError = onError
+      self.fatal = None
+      self.lock = threading.Lock()
+
+   def worker(self,fn,inQueue,outQueue):
+      while True:
+         item = inQueue.get()
+         if item is done:
+            return
+         if self.fatal is not None:
+            continue
+         try:
+            result = fn(item)
+         except Exception as e:
+            if self.onError is not None:
+               try:
+                  self.onError(item,e)
+               except Exception:
+                  log.exception('Error handler failed for %s',item)
+            continue
+         except BaseException:
+            with self.lock:
+               if self.fatal is None:
+                  self.fatal = sys.exc_info()
+            continue
+         if result is not None and outQueue is not None:
+            outQueue.put(result)
+
+   def run(self,items,stop=None):
+      # Push items through every stage and wait for all of them to
+      # finish. stop() is checked before each new item is fed in.
+      queues = [queue.Queue(maxsize=self.depth) for stage in self.stages]
+      groups = []
+      for index,(name,fn,workers) in enumerate(self.stages):
+         outQueue = None
+         if index + 1 < len(queues):
+            outQueue = queues[index + 1]
+         threads = []
+         for count in range(workers):
+            thread = threading.Thread(target=self.worker,args=(fn,queues[index],outQueue),\
+                                      name=name + '-' + str(count))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+         groups.append(threads)
+      try:
+         for item in items:
+            if self.fatal is not None or (stop is not None and stop()):
+               break
+            queues[0].put(item)
+      finally:
+         # Drain stage by stage: a stage is told to finish only once
+         # every worker of the stage before it has exited.
+         for index,threads in enumerate(groups):
+            for thread in threads:
+               queues[index].put(done)
+            for thread in threads:
+               thread.join()
+      if self.fatal is not None:
+         reraise(*self.fatal)
@@ -0,0 +1,62 @@
+# Dry-run planning. Works out what the ingest engine would do now
+# for a set of products, from the completion ledger and the upstream
+# listings saved by the last engine pass, without touching the
+# network or downloading anything: which items are missing, which
+# of those upstream already had, which are not expected yet, and the
+# bytes and time they should take based on past throughput.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import calendar
+import datetime
+
+import engineMod
+import ledgerMod
+
+def plan(products,ledger,latency,listings,dNow=None,historyDays=7):
+   # One entry per product with its missing items split by what the
+   # cached listings say, and estimated bytes/seconds for the work.
+   if dNow is None:
+      dNow = datetime.datetime.utcnow()
+   now = calendar.timegm(dNow.timetuple())
+   since = ledgerMod.cycleStr(dNow - datetime.timedelta(days=historyDays))
+   result = []
+   for product in products:
+      cycles = engineMod.cycleWindow(product,dNow)
+      entry = {'product':product['name'],
+               'window':len(cycles)*len(product['hours']),
+               'missing':[],
+               'available':[],
+               'notYet':[],
+               'unknown':[],
+               'listingAge':None}
+      if len(cycles) > 0:
+         done = ledger.completed(product['name'],ledgerMod.cycleStr(cycles[0]),ledgerMod.cycleStr(cycles[-1]))
+      else:
+         done = set()
+      for item in engineMod.workItems(product,dNow):
+         if (item.cycle,item.fHour) in done:
+            continue
+         key = (item.cycle,item.fHour)
+         entry['missing'].append(key)
+         listing = listings.get(item.remoteDir.rstrip('/'))
+         if listing is not None:
+            age = now - listing['time']
+            if entry['listingAge'] is None or age > entry['listingAge']:
+               entry['listingAge'] = age
+         if listing is not None and item.remoteFile in listing['files']:
+            entry['available'].append(key)
+         elif not latency.plausible(product,item.cycle,item.fHour,now):
+            entry['notYet'].append(key)
+         else:
+            entry['unknown'].append(key)
+      nItems,meanBytes,meanSeconds = ledger.throughput(product['name'],since)
+      entry['meanBytes'] = meanBytes
+      entry['meanSeconds'] = meanSeconds
+      nWork = len(entry['available']) + len(entry['unknown'])
+      entry['estBytes'] = None if meanBytes is None else meanBytes*nWork
+      entry['estSeconds'] = None if meanSeconds is None else meanSeconds*nWork
+      result.append(entry)
+   return result
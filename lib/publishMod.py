@@ -0,0 +1,115 @@
+# Batched publishing to the hydroInspector web host. Files produced
+# during a run are uploaded into the temporary directory as they are
+# finished (staged), then verified and promoted into the directory
+# hydroInspector reads with one remote command per destination, so
+# whole cycles appear at once rather than trickling in file by file.
+# Each batch writes a JSON manifest of what was published.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import datetime
+import json
+import os
+import threading
+
+class PublishBatch(object):
+
+   def __init__(self,transport,manifestDir=None,maxFiles=200):
+      self.transport = transport
+      self.manifestDir = manifestDir
+      self.maxFiles = maxFiles
+      self.entries = []
+      # Files may be staged from several threads.
+      self.lock = threading.Lock()
+
+   def __len__(self):
+      return len(self.entries)
+
+   def full(self):
+      return len(self.entries) >= self.maxFiles
+
+   def upload(self,localPath,tmpDir,finalDir,info=None):
+      # Upload a file into tmpDir and return its batch entry, without
+      # adding it to the batch (see add). info is any JSON serializable
+      # dictionary kept with the entry (product, cycle, ...).
+      fileName = os.path.basename(localPath)
+      nBytes = os.path.getsize(localPath)
+      self.transport.put(localPath,tmpDir)
+      return self.entry(fileName,nBytes,tmpDir,finalDir,info)
+
+   def uploadStream(self,fileName,tmpDir,finalDir,produce,info=None):
+      # Like upload, for a file written directly into tmpDir rather
+      # than uploaded from disk. produce(openSink) writes the file
+      # through a sink from openSink() (calling it again to restart
+      # after a failed attempt) and returns the number of bytes written.
+      nBytes = produce(lambda: self.transport.openSink(tmpDir + '/' + fileName))
+      return self.entry(fileName,nBytes,tmpDir,finalDir,info)
+
+   def entry(self,fileName,nBytes,tmpDir,finalDir,info):
+      return {'file':fileName,
+              'bytes':nBytes,
+              'tmpPath':tmpDir + '/' + fileName,
+              'finalDir':finalDir,
+              'info':info or {}}
+
+   def add(self,entry):
+      with self.lock:
+         self.entries.append(entry)
+      return entry
+
+   def stage(self,localPath,tmpDir,finalDir,info=None):
+      return self.add(self.upload(localPath,tmpDir,finalDir,info))
+
+   def stageStream(self,fileName,tmpDir,finalDir,produce,info=None):
+      return self.add(self.uploadStream(fileName,tmpDir,finalDir,produce,info))
+
+   def verify(self,entries):
+      # Split entries into those whose remote size matches the local
+      # file and those that are missing or truncated.
+      sizes = self.transport.sizes([entry['tmpPath'] for entry in entries])
+      good = []
+      bad = []
+      for entry in entries:
+         if sizes.get(entry['tmpPath']) == entry['bytes']:
+            good.append(entry)
+         else:
+            bad.append(entry)
+      return good,bad
+
+   def promote(self):
+      # Verify, then move every good entry into its final directory
+      # with one remote command per directory. Bad entries are removed
+      # from the temporary directory. Returns (good, bad); files staged
+      # meanwhile go to the next batch.
+      with self.lock:
+         entries = self.entries
+         self.entries = []
+      if len(entries) == 0:
+         return [],[]
+      good,bad = self.verify(entries)
+      byDir = {}
+      for entry in good:
+         byDir.setdefault(entry['finalDir'],[]).append(entry['tmpPath'])
+      for finalDir,paths in byDir.items():
+         self.transport.promote(paths,finalDir)
+      self.transport.remove([entry['tmpPath'] for entry in bad])
+      self.writeManifest(good,bad)
+      return good,bad
+
+   def writeManifest(self,good,bad):
+      if self.manifestDir is None:
+         return None
+      if not os.path.isdir(self.manifestDir):
+         os.makedirs(self.manifestDir)
+      dNow = datetime.datetime.utcnow()
+      batchId = dNow.strftime('%Y%m%d%H%M%S%f') + '_' + str(os.getpid())
+      manifest = {'batch':batchId,
+                  'promoted':dNow.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                  'files':good,
+                  'rejected':bad}
+      manifestPath = os.path.join(self.manifestDir,'publish_' + batchId + '.json')
+      with open(manifestPath,'w') as fh:
+         json.dump(manifest,fh,indent=1,sort_keys=True)
+      return manifestPath
@@ -0,0 +1,181 @@
+# Partial downloads of NetCDF4/HDF5 files over HTTP. The file's HDF5
+# structure is read remotely with Range requests, giving the byte
+# ranges holding each variable's (chunked, compressed) data. Only
+# the bytes outside the data of the variables we drop are fetched
+# and written at their original offsets into a sparse local file, so
+# every piece of metadata and every kept variable is intact while
+# the skipped variables are left as holes. The result must only be
+# read for the kept variables, i.e. by compressMod.compressNWM,
+# which drops compressMod.varsSkip.
+# Needs h5py 2.10 or later (HDF5 1.10.5 chunk queries). Without it
+# callers fall back to a full download.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import os
+import time
+
+from metricsMod import metrics
+
+class RangeUnsupported(Exception):
+   # Partial download not possible for this file or installation.
+   pass
+
+class RangeReader(object):
+   # Read-only file object over HTTP Range requests, fetching whole
+   # blocks and caching them. Used to read a remote file's metadata.
+
+   def __init__(self,http,url,size,blockSize=64*1024,timeout=300):
+      self.http = http
+      self.url = url
+      self.size = size
+      self.blockSize = blockSize
+      self.timeout = timeout
+      self.blocks = {}
+      self.pos = 0
+      self.nRequests = 0
+      self.nBytes = 0
+
+   def block(self,index):
+      if index not in self.blocks:
+         start = index*self.blockSize
+         end = min(self.size,start + self.blockSize) - 1
+         self.blocks[index] = getRange(self.http,self.url,start,end,self.timeout)
+         self.nRequests += 1
+         self.nBytes += len(self.blocks[index])
+      return self.blocks[index]
+
+   def read(self,n=-1):
+      if n is None or n < 0:
+         n = self.size - self.pos
+      n = max(0,min(n,self.size - self.pos))
+      parts = []
+      while n > 0:
+         index,offset = divmod(self.pos,self.blockSize)
+         part = self.block(index)[offset:offset + n]
+         if len(part) == 0:
+            break
+         parts.append(part)
+         self.pos += len(part)
+         n -= len(part)
+      return b''.join(parts)
+
+   def readinto(self,buf):
+      data = self.read(len(buf))
+      buf[:len(data)] = data
+      return len(data)
+
+   def seek(self,offset,whence=0):
+      if whence == 1:
+         offset += self.pos
+      elif whence == 2:
+         offset += self.size
+      self.pos = offset
+      return self.pos
+
+   def tell(self):
+      return self.pos
+
+   def seekable(self):
+      return True
+
+   def readable(self):
+      return True
+
+   def writable(self):
+      return False
+
+def getRange(http,url,start,end,timeout=300):
+   # Bytes start..end (inclusive) of a URL.
+   resp = http.get(url,headers={'Range':'bytes=%d-%d' % (start,end)},timeout=timeout)
+   resp.raise_for_status()
+   if resp.status_code != 206:
+      raise RangeUnsupported('Server ignored the Range request: ' + url)
+   return resp.content
+
+def remoteSize(http,url,timeout=300):
+   # Size of a remote file, or RangeUnsupported if the server does
+   # not advertise byte ranges.
+   resp = http.head(url,timeout=timeout,allow_redirects=True)
+   resp.raise_for_status()
+   if resp.headers.get('Accept-Ranges','').lower() != 'bytes' or 'Content-Length' not in resp.headers:
+      raise RangeUnsupported('Byte ranges not supported: ' + url)
+   return int(resp.headers['Content-Length'])
+
+def variableRanges(fileObj,varNames):
+   # (offset, length) of every stored chunk of the named variables.
+   try:
+      import h5py
+   except ImportError:
+      raise RangeUnsupported('h5py is not installed')
+   ranges = []
+   with h5py.File(fileObj,'r') as h5:
+      for varName in varNames:
+         if varName not in h5:
+            continue
+         dsId = h5[varName].id
+         if h5[varName].chunks is None:
+            offset = dsId.get_offset()
+            if offset is not None:
+               ranges.append((offset,dsId.get_storage_size()))
+            continue
+         if not hasattr(dsId,'get_num_chunks'):
+            raise RangeUnsupported('h5py is too old to list chunks')
+         for index in range(dsId.get_num_chunks()):
+            info = dsId.get_chunk_info(index)
+            ranges.append((info.byte_offset,info.size))
+   return ranges
+
+def keepRanges(skipRanges,size,minGap=256*1024):
+   # Complement of skipRanges within [0, size) as inclusive
+   # (start, end) pairs. Skipped runs shorter than minGap are fetched
+   # anyway to save requests.
+   keep = []
+   pos = 0
+   for offset,length in sorted(skipRanges):
+      if offset - pos > 0:
+         keep.append([pos,offset - 1])
+      pos = max(pos,offset + length)
+   if pos < size:
+      keep.append([pos,size - 1])
+   merged = []
+   for start,end in keep:
+      if len(merged) > 0 and start - merged[-1][1] - 1 < minGap:
+         merged[-1][1] = end
+      else:
+         merged.append([start,end])
+   return [tuple(entry) for entry in merged]
+
+def fetchPartial(http,url,outPath,skipVars,timeout=300):
+   # Download url to outPath without the data of skipVars. Returns
+   # (bytes fetched, including the structure reads, and file size). Raises RangeUnsupported when a
+   # partial download is not possible, leaving nothing behind.
+   tStart = time.time()
+   size = remoteSize(http,url,timeout)
+   reader = RangeReader(http,url,size,timeout=timeout)
+   try:
+      skipRanges = variableRanges(reader,skipVars)
+   except (IOError,OSError,ValueError,KeyError) as e:
+      raise RangeUnsupported('Unable to read HDF5 structure of ' + url + ': ' + str(e))
+   metrics.record('http_range_index',time.time() - tStart,reader.nBytes)
+   nBytes = 0
+   tmpPath = outPath + '.part'
+   try:
+      with open(tmpPath,'wb') as fh:
+         fh.truncate(size)
+         for start,end in keepRanges(skipRanges,size):
+            data = getRange(http,url,start,end,timeout)
+            if len(data) != end - start + 1:
+               raise IOError('Short range read from ' + url)
+            fh.seek(start)
+            fh.write(data)
+            nBytes += len(data)
+   except Exception:
+      if os.path.isfile(tmpPath):
+         os.remove(tmpPath)
+      raise
+   os.rename(tmpPath,outPath)
+   metrics.record('http_range_fetch',time.time() - tStart,nBytes)
+   return nBytes + reader.nBytes,size
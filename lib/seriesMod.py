@@ -0,0 +1,208 @@
+# Reach-major time-series store. Every channel_rt hour ingested is
+# also written into one NetCDF4 file per product and cycle, with
+# variables laid out (feature_id, time) and chunked so that a chunk
+# holds every forecast hour of a block of reaches. A hydrograph for
+# one reach then reads a single chunk instead of one element from
+# each of the cycle's files. Hours are written as they arrive (in
+# groups, see SeriesWriter), so a store is usable while its cycle is
+# still coming in; the 'present' variable says which hours it holds. Values use compressMod's packed
+# integer encoding (scale_factor, add_offset, fill value and
+# valid_range), so they match the published COMPRESS files.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# netCDF4 and numpy are imported inside the functions that use them,
+# as in compressMod.
+import datetime
+import fcntl
+import os
+import re
+
+from metricsMod import metrics
+
+# Reaches per chunk. Reading one reach's series reads (and inflates)
+# reachChunk x forecast hours values.
+reachChunk = 2048
+
+def seriesName(product,cycle):
+   # Store file name of a product's cycle (YYYYMMDDHH).
+   return 'nwm.' + cycle + '.' + product['range'] + '.' + product['kind'] + '.SERIES.nc'
+
+namePattern = re.compile(r'^nwm\.(\d{10})\..*\.SERIES\.nc$')
+
+def seriesPath(seriesDir,product,cycle):
+   return os.path.join(seriesDir,product['name'],seriesName(product,cycle))
+
+def create(path,product,cycle,featureIds,varNames):
+   # Empty store for a cycle, every value set to the fill value.
+   import netCDF4
+   import numpy as np
+   import compressMod
+   nHours = len(product['hours'])
+   tmpPath = path + '.part'
+   out = netCDF4.Dataset(tmpPath,'w',format=compressMod.outNCType)
+   try:
+      out.createDimension('feature_id',len(featureIds))
+      out.createDimension('time',nHours)
+      var = out.createVariable('feature_id',featureIds.dtype,('feature_id',))
+      var[:] = featureIds
+      var = out.createVariable('time','i4',('time',))
+      var.units = 'hours since ' + datetime.datetime.strptime(cycle,'%Y%m%d%H').strftime('%Y-%m-%d %H:%M:%S')
+      var.long_name = 'forecast hour'
+      var[:] = np.array(product['hours'],dtype='i4')
+      var = out.createVariable('present','i1',('time',))
+      var.long_name = '1 where the forecast hour has been written'
+      var[:] = np.zeros(nHours,dtype='i1')
+      chunks = (min(reachChunk,len(featureIds)),nHours)
+      for varName in varNames:
+         scale = compressMod.varScaleFactors[varName]
+         var = out.createVariable(varName,compressMod.vardTypeComp[varName],('feature_id','time'),\
+                                  fill_value=-9999/scale,zlib=True,complevel=compressMod.compLevel,\
+                                  chunksizes=chunks)
+         var.scale_factor = scale
+         var.add_offset = compressMod.varOffsets[varName]
+         if varName in compressMod.validRange:
+            var.valid_range = np.array(compressMod.validRange[varName])/scale
+      out.product = product['name']
+      out.model_initialization_time = cycle[:8] + '_' + cycle[8:] + ':00:00'
+   finally:
+      out.close()
+   os.rename(tmpPath,path)
+
+def pack(ncvar,varName):
+   # Values of a variable in compressMod's packed integer encoding:
+   # (value - add_offset)/scale_factor truncated to an integer, and
+   # -9999/scale_factor where missing.
+   import numpy as np
+   import compressMod
+   scale = compressMod.varScaleFactors[varName]
+   values = np.ma.masked_invalid(np.ma.asarray(ncvar[:],dtype='f8')).ravel()
+   packed = np.ma.filled((values - compressMod.varOffsets[varName])/scale,-9999/scale)
+   return packed.astype(compressMod.vardTypeComp[varName])
+
+def columns(source,varNames):
+   # (feature ids, {variable: packed values}) of a channel_rt file,
+   # a path or (name, buffer) pair (see compressMod.openInput).
+   import numpy as np
+   import compressMod
+   nc = compressMod.openInput(source)
+   try:
+      featureIds = np.asarray(nc.variables['feature_id'][:])
+      return featureIds,dict([(varName,pack(nc.variables[varName],varName)) for varName in varNames \
+                              if varName in nc.variables])
+   finally:
+      nc.close()
+
+def write(path,product,cycle,featureIds,hours):
+   # Write forecast hours ({hour: {variable: packed values}}) into a
+   # cycle's store, creating it on first use. Every chunk is inflated
+   # and rewritten once per call, however many hours are written, so
+   # hours are best written in groups (see SeriesWriter). Writers of
+   # the same store are serialized with a lock file.
+   import netCDF4
+   import numpy as np
+   if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+   indexes = dict([(product['hours'].index(fHour),fHour) for fHour in hours.keys()])
+   lo = min(indexes.keys())
+   hi = max(indexes.keys()) + 1
+   varNames = sorted(set([varName for values in hours.values() for varName in values.keys()]))
+   with open(path + '.lock','a') as lockFh:
+      fcntl.flock(lockFh,fcntl.LOCK_EX)
+      if not os.path.isfile(path):
+         create(path,product,cycle,featureIds,varNames)
+      out = netCDF4.Dataset(path,'a')
+      try:
+         if len(out.dimensions['feature_id']) != len(featureIds):
+            raise ValueError('%s has %d reaches, the store %d' % (product['name'],len(featureIds),\
+                                                                 len(out.dimensions['feature_id'])))
+         for varName in varNames:
+            var = out.variables[varName]
+            var.set_auto_maskandscale(False)
+            # One contiguous block of hours, keeping the hours in it
+            # that are not being written.
+            if hi - lo == len(indexes):
+               block = np.empty((len(featureIds),hi - lo),dtype=var.dtype)
+            else:
+               block = var[:,lo:hi]
+            for index,fHour in indexes.items():
+               block[:,index - lo] = hours[fHour][varName]
+            var[:,lo:hi] = block
+         present = out.variables['present']
+         for index in indexes.keys():
+            present[index] = 1
+      finally:
+         out.close()
+
+class SeriesWriter(object):
+   # Collects the hours ingested for each store and writes them in
+   # groups: when a store has flushHours hours waiting, and for every
+   # store on flush() (the engine flushes at the end of each pass).
+
+   def __init__(self,seriesDir,varNames,flushHours=8):
+      self.seriesDir = seriesDir
+      self.varNames = varNames
+      self.flushHours = flushHours
+      # {path: (product, cycle, feature ids, {hour: {variable: values}})}
+      self.pending = {}
+
+   def add(self,product,cycle,fHour,source):
+      with metrics.timer('series_read',product['name']):
+         featureIds,values = columns(source,self.varNames)
+      path = seriesPath(self.seriesDir,product,cycle)
+      entry = self.pending.setdefault(path,(product,cycle,featureIds,{}))
+      entry[3][fHour] = values
+      if len(entry[3]) >= self.flushHours:
+         self.flushStore(path)
+
+   def flushStore(self,path):
+      product,cycle,featureIds,hours = self.pending.pop(path)
+      with metrics.timer('series_write',product['name']) as timer:
+         write(path,product,cycle,featureIds,hours)
+         timer.bytes = sum([column.nbytes for values in hours.values() for column in values.values()])
+
+   def flush(self):
+      # Write every waiting hour. Returns the number of hours written.
+      nHours = 0
+      for path in list(self.pending.keys()):
+         nHours += len(self.pending[path][3])
+         self.flushStore(path)
+      return nHours
+
+def read(path,position,varName='streamflow'):
+   # (forecast hours, values) of the series of the reach at a position
+   # in the channel_rt arrays (e.g. from spatialMod.PointIndex.nearest),
+   # unpacked, leaving out hours not written yet.
+   import netCDF4
+   nc = netCDF4.Dataset(path,'r')
+   try:
+      nc.variables['present'].set_auto_mask(False)
+      present = nc.variables['present'][:] == 1
+      values = nc.variables[varName][position,:]
+      return nc.variables['time'][:][present],values[present]
+   finally:
+      nc.close()
+
+def prune(seriesDir,maxAgeDays,now=None):
+   # Remove stores of cycles older than maxAgeDays. Returns the number
+   # of stores removed.
+   if now is None:
+      now = datetime.datetime.utcnow()
+   cutoff = (now - datetime.timedelta(days=maxAgeDays)).strftime('%Y%m%d%H')
+   nRemoved = 0
+   if not os.path.isdir(seriesDir):
+      return 0
+   for name in os.listdir(seriesDir):
+      productDir = os.path.join(seriesDir,name)
+      if not os.path.isdir(productDir):
+         continue
+      for fileName in os.listdir(productDir):
+         match = namePattern.match(fileName.replace('.lock',''))
+         if match is None or match.group(1) >= cutoff:
+            continue
+         os.remove(os.path.join(productDir,fileName))
+         if not fileName.endswith('.lock'):
+            nRemoved += 1
+   return nRemoved
@@ -0,0 +1,179 @@
+# Output sinks. A sink is a writable destination for one file that
+# is committed by close() and thrown away by abort(), so a producer
+# (a download, the compressor) can write straight to wherever the
+# file is going: a local file, a remote file over SSH, memory, or
+# several of these.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+
+from pipelineMod import reraise
+
+class FileSink(object):
+   # Local file, written under a temporary name and renamed into
+   # place on close.
+
+   def __init__(self,path):
+      self.path = path
+      self.tmpPath = path + '.part'
+      self.fh = open(self.tmpPath,'wb')
+      self.bytes = 0
+
+   def write(self,data):
+      self.fh.write(data)
+      self.bytes += len(data)
+
+   def close(self):
+      self.fh.close()
+      os.rename(self.tmpPath,self.path)
+      return self.bytes
+
+   def abort(self):
+      self.fh.close()
+      if os.path.isfile(self.tmpPath):
+         os.remove(self.tmpPath)
+
+class PipeSink(object):
+   # Standard input of a command, e.g. ssh host 'cat > file'.
+
+   def __init__(self,cmd):
+      self.cmd = cmd
+      self.devnull = open(os.devnull,'w')
+      try:
+         self.proc = subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=self.devnull)
+      except Exception:
+         self.devnull.close()
+         raise
+      self.bytes = 0
+
+   def write(self,data):
+      self.proc.stdin.write(data)
+      self.bytes += len(data)
+
+   def close(self):
+      try:
+         self.proc.stdin.close()
+         status = self.proc.wait()
+      finally:
+         self.devnull.close()
+      if status != 0:
+         raise IOError('Command failed writing output: ' + ' '.join(self.cmd))
+      return self.bytes
+
+   def abort(self):
+      try:
+         self.proc.stdin.close()
+      except Exception:
+         pass
+      if self.proc.poll() is None:
+         self.proc.kill()
+      self.proc.wait()
+      self.devnull.close()
+
+class TeeSink(object):
+   # Writes to several sinks at once. On close the sinks are committed
+   # in order; if one fails, it and the sinks after it are aborted, so
+   # a failure leaves at most the sinks before it committed.
+
+   def __init__(self,sinks):
+      self.sinks = sinks
+      self.bytes = 0
+
+   def write(self,data):
+      for sink in self.sinks:
+         sink.write(data)
+      self.bytes += len(data)
+
+   def close(self):
+      for index,sink in enumerate(self.sinks):
+         try:
+            sink.close()
+         except Exception:
+            excInfo = sys.exc_info()
+            for rest in self.sinks[index:]:
+               try:
+                  rest.abort()
+               except Exception:
+                  pass
+            reraise(*excInfo)
+      return self.bytes
+
+   def abort(self):
+      for sink in self.sinks:
+         sink.abort()
+
+class BufferSink(object):
+   # Keeps a file in memory, spilling to an unlinked temporary file in
+   # spillDir once it grows past spillBytes. After close, buffer is
+   # the contents as a bytearray, or a read-only numpy.memmap of the
+   # spill file; either can be opened with netCDF4's in-memory support.
+
+   def __init__(self,spillBytes=None,spillDir=None):
+      self.spillBytes = spillBytes
+      self.spillDir = spillDir
+      self.data = bytearray()
+      self.spill = None
+      self.buffer = None
+      self.bytes = 0
+
+   def write(self,data):
+      if self.spill is None and self.spillBytes is not None and self.bytes + len(data) > self.spillBytes:
+         self.spill = tempfile.TemporaryFile(dir=self.spillDir)
+         self.spill.write(self.data)
+         self.data = None
+      if self.spill is not None:
+         self.spill.write(data)
+      else:
+         self.data += data
+      self.bytes += len(data)
+
+   def close(self):
+      if self.spill is not None:
+         import numpy
+         self.spill.flush()
+         self.buffer = numpy.memmap(self.spill,dtype='uint8',mode='r')
+         self.spill.close()
+      else:
+         self.buffer = self.data
+      self.data = None
+      return self.bytes
+
+   def abort(self):
+      if self.spill is not None:
+         self.spill.close()
+      self.data = None
+
+class HashSink(object):
+   # Passes data through to another sink, computing its SHA-256 on
+   # the way. onClose(hexDigest) is called once the sink commits, and
+   # onWrite(), if given, after each block written.
+
+   def __init__(self,sink,onClose=None,onWrite=None):
+      self.sink = sink
+      self.onClose = onClose
+      self.onWrite = onWrite
+      self.hash = hashlib.sha256()
+      self.bytes = 0
+
+   def write(self,data):
+      self.hash.update(data)
+      self.sink.write(data)
+      self.bytes += len(data)
+      if self.onWrite is not None:
+         self.onWrite()
+
+   def close(self):
+      nBytes = self.sink.close()
+      if self.onClose is not None:
+         self.onClose(self.hash.hexdigest())
+      return nBytes
+
+   def abort(self):
+      self.sink.abort()
@@ -0,0 +1,393 @@
+# Upstream sources for NWM output. Each source keeps its
+# connection open across files and caches directory listings for
+# the current pass, so a run covering many products, cycles and
+# forecast hours lists each upstream directory once instead of
+# reconnecting and re-listing for every file.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# ftplib and requests are imported by the source that uses them, so
+# an FTP-only run never loads the HTTP stack.
+import calendar
+import json
+import logging
+import os
+import re
+import socket
+import time
+
+import sinkMod
+from metricsMod import metrics
+
+log = logging.getLogger('inspector')
+
+# One entry of an Apache/NOMADS directory index: link target, then
+# optionally the modification time and size, either as <pre> text or
+# in table cells.
+indexEntry = re.compile(r'<a href="([^"/?]+)">[^<]*</a>(?:\s|</?td[^>]*>)*' + \
+                        r'(\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}|\d{4}-\d{2}-\d{2} \d{2}:\d{2})?' + \
+                        r'(?::\d{2})?(?:\s|</?td[^>]*>)*([\d.]+[KMGT]?|-)?',re.IGNORECASE)
+sizeUnits = {'':1,'K':1024,'M':1024**2,'G':1024**3,'T':1024**4}
+
+def indexTime(stamp):
+   # Epoch seconds of an index timestamp (UTC on NOMADS), or None.
+   for fmt in ['%d-%b-%Y %H:%M','%Y-%m-%d %H:%M']:
+      try:
+         return calendar.timegm(time.strptime(stamp,fmt))
+      except (TypeError,ValueError):
+         pass
+   return None
+
+def indexSize(size):
+   # Bytes of an index size column (approximate for 72M and the like).
+   if size is None or size == '-':
+      return None
+   unit = size[-1].upper() if size[-1].isalpha() else ''
+   return int(float(size.rstrip('KMGTkmgt'))*sizeUnits[unit])
+
+def parseIndex(lines,suffix='nc'):
+   # Parse a directory index page, given as an iterable of lines (e.g.
+   # a streamed response), into {file name: (bytes, modified)} for the
+   # files ending in suffix. One regular expression pass per line.
+   entries = {}
+   # Many files share a timestamp; strptime dominates otherwise.
+   times = {}
+   for line in lines:
+      if 'href' not in line:
+         continue
+      for match in indexEntry.finditer(line):
+         name,stamp,size = match.groups()
+         if name.endswith(suffix):
+            if stamp not in times:
+               times[stamp] = indexTime(stamp)
+            entries[name] = (indexSize(size),times[stamp])
+   return entries
+
+def fetchIndex(http,url,cached=None,timeout=300):
+   # Directory index of url as {file name: (bytes, modified)}, with
+   # the validators to revalidate it next time. cached is a previous
+   # result ({'entries','etag','lastModified'}); the server is asked
+   # with If-None-Match / If-Modified-Since and a 304 reuses it
+   # without downloading or parsing the page. Returns the new cache
+   # entry, or None for a missing directory.
+   headers = {}
+   if cached is not None:
+      if cached.get('etag'):
+         headers['If-None-Match'] = cached['etag']
+      if cached.get('lastModified'):
+         headers['If-Modified-Since'] = cached['lastModified']
+   resp = http.get(url.rstrip('/') + '/',headers=headers,timeout=timeout,stream=True)
+   try:
+      if resp.status_code == 404:
+         return None
+      if resp.status_code == 304 and cached is not None:
+         metrics.record('http_index_unchanged',0.0)
+         return cached
+      resp.raise_for_status()
+      if resp.encoding is None:
+         resp.encoding = 'utf-8'
+      entries = parseIndex(resp.iter_lines(decode_unicode=True))
+   finally:
+      resp.close()
+   return {'entries':entries,
+           'etag':resp.headers.get('ETag'),
+           'lastModified':resp.headers.get('Last-Modified')}
+
+def ftpErrors():
+   # Transient FTP errors worth reconnecting and retrying on.
+   from ftplib import error_temp, error_reply
+   return (socket.error,EOFError,error_temp,error_reply)
+
+class FtpSource(object):
+   # Anonymous FTP source (NCEP production output).
+
+   def __init__(self,host,timeout=300,tries=10,retryWait=5):
+      self.host = host
+      self.timeout = timeout
+      self.tries = tries
+      self.retryWait = retryWait
+      self.ftp = None
+      self.listings = {}
+
+   def connect(self):
+      # (Re)connect and log in, retrying on failure.
+      from ftplib import FTP
+      self.disconnect()
+      for attempt in range(self.tries):
+         try:
+            self.ftp = FTP(self.host,timeout=self.timeout)
+            self.ftp.login()
+            return self.ftp
+         except ftpErrors():
+            self.ftp = None
+            time.sleep(self.retryWait)
+      raise IOError('Unable to connect to FTP server: ' + self.host)
+
+   def disconnect(self):
+      if self.ftp is not None:
+         try:
+            self.ftp.quit()
+         except Exception:
+            pass
+      self.ftp = None
+
+   def session(self):
+      if self.ftp is None:
+         self.connect()
+      return self.ftp
+
+   def keepAlive(self):
+      # Ping an idle connection so it survives between daemon passes.
+      # A dead connection is dropped and reopened on next use.
+      if self.ftp is None:
+         return
+      try:
+         self.ftp.voidcmd('NOOP')
+      except Exception:
+         self.ftp = None
+
+   def listDir(self,remoteDir):
+      # Set of file names in a remote directory, cached for the pass.
+      # A directory that does not exist yet (new day around 00 UTC)
+      # lists as empty.
+      from ftplib import error_perm
+      if remoteDir in self.listings:
+         return self.listings[remoteDir]
+      tStart = time.time()
+      for attempt in range(self.tries):
+         try:
+            names = self.session().nlst(remoteDir)
+            break
+         except error_perm:
+            names = []
+            break
+         except ftpErrors():
+            metrics.retry('ftp_list')
+            self.connect()
+      else:
+         raise IOError('Unable to list FTP directory: ' + remoteDir)
+      metrics.record('ftp_list',time.time() - tStart)
+      listing = set([os.path.basename(name) for name in names])
+      self.listings[remoteDir] = listing
+      return listing
+
+   def exists(self,remoteDir,fileName):
+      return fileName in self.listDir(remoteDir)
+
+   def modified(self,remoteDir,fileName):
+      # Upstream modification (publication) time of a file as epoch
+      # seconds, from MDTM. None if the server does not report it.
+      import calendar
+      for attempt in range(self.tries):
+         try:
+            resp = self.session().sendcmd('MDTM ' + remoteDir + '/' + fileName)
+            break
+         except ftpErrors():
+            self.connect()
+         except Exception:
+            return None
+      else:
+         return None
+      try:
+         stamp = time.strptime(resp.split()[1][:14],'%Y%m%d%H%M%S')
+      except (IndexError,ValueError):
+         return None
+      return calendar.timegm(stamp)
+
+   def fetch(self,remoteDir,fileName,outPath):
+      # Download a file over the open connection. Returns bytes written.
+      return self.fetchTo(remoteDir,fileName,lambda: sinkMod.FileSink(outPath))
+
+   def fetchTo(self,remoteDir,fileName,openSink):
+      # Stream a file into a sink from openSink(), opening a fresh
+      # sink for each attempt. Returns bytes written.
+      tStart = time.time()
+      for attempt in range(self.tries):
+         sink = openSink()
+         try:
+            self.session().retrbinary('RETR ' + remoteDir + '/' + fileName,sink.write)
+         except ftpErrors():
+            sink.abort()
+            metrics.retry('ftp_fetch')
+            self.connect()
+            continue
+         except Exception:
+            sink.abort()
+            raise
+         nBytes = sink.close()
+         metrics.record('ftp_fetch',time.time() - tStart,nBytes)
+         return nBytes
+      raise IOError('Unable to retrieve: ' + remoteDir + '/' + fileName)
+
+   def resetListings(self):
+      self.listings = {}
+
+   def close(self):
+      self.disconnect()
+
+class HttpSource(object):
+   # HTTP directory index source (para NOMADS output).
+
+   def __init__(self,timeout=300,tries=3,retryWait=5):
+      import requests
+      self.timeout = timeout
+      self.tries = tries
+      self.retryWait = retryWait
+      self.http = requests.Session()
+      self.listings = {}
+      # Parsed directory indexes and their validators, kept across
+      # passes for conditional requests (see fetchIndex).
+      self.indexes = {}
+
+   def keepAlive(self):
+      # Pooled HTTP connections are re-established on demand.
+      pass
+
+   def listDir(self,remoteDir):
+      # Set of .nc file names in a directory index, cached for the pass.
+      # Later passes revalidate the index instead of re-reading it.
+      import requests
+      remoteDir = remoteDir.rstrip('/')
+      if remoteDir in self.listings:
+         return self.listings[remoteDir]
+      tStart = time.time()
+      for attempt in range(self.tries):
+         try:
+            index = fetchIndex(self.http,remoteDir,self.indexes.get(remoteDir),self.timeout)
+            if index is None:
+               self.indexes.pop(remoteDir,None)
+               listing = set()
+            else:
+               self.indexes[remoteDir] = index
+               listing = set(index['entries'].keys())
+            break
+         except requests.RequestException:
+            metrics.retry('http_list')
+            time.sleep(self.retryWait)
+      else:
+         raise IOError('Unable to connect to: ' + remoteDir + ' and retrieve listing')
+      metrics.record('http_list',time.time() - tStart)
+      self.listings[remoteDir] = listing
+      return listing
+
+   def exists(self,remoteDir,fileName):
+      return fileName in self.listDir(remoteDir)
+
+   def size(self,remoteDir,fileName):
+      # Approximate size in bytes from the directory index, or None.
+      if not self.exists(remoteDir,fileName):
+         return None
+      return self.indexes[remoteDir.rstrip('/')]['entries'][fileName][0]
+
+   def seedIndexes(self,cache):
+      # Start from indexes saved by an earlier run (see
+      # saveListingCache), so the first listing of each directory is a
+      # conditional request too.
+      for remoteDir,entry in cache.items():
+         if entry.get('etag') or entry.get('lastModified'):
+            self.indexes[remoteDir] = {'entries':dict([(name,(None,None)) for name in entry['files']]),
+                                       'etag':entry.get('etag'),
+                                       'lastModified':entry.get('lastModified')}
+
+   def modified(self,remoteDir,fileName):
+      # Upstream modification (publication) time of a file as epoch
+      # seconds, from the Last-Modified header of a HEAD request.
+      import requests
+      from email.utils import parsedate_tz, mktime_tz
+      url = remoteDir.rstrip('/') + '/' + fileName
+      try:
+         resp = self.http.head(url,timeout=self.timeout)
+      except requests.RequestException:
+         return None
+      stamp = resp.headers.get('Last-Modified')
+      if resp.status_code != 200 or stamp is None or parsedate_tz(stamp) is None:
+         return None
+      return mktime_tz(parsedate_tz(stamp))
+
+   def fetch(self,remoteDir,fileName,outPath):
+      # Stream a file to disk over the shared session. Returns bytes written.
+      return self.fetchTo(remoteDir,fileName,lambda: sinkMod.FileSink(outPath))
+
+   def fetchTo(self,remoteDir,fileName,openSink):
+      # Stream a file into a sink from openSink(), opening a fresh
+      # sink for each attempt. Returns bytes written.
+      import requests
+      url = remoteDir.rstrip('/') + '/' + fileName
+      tStart = time.time()
+      for attempt in range(self.tries):
+         sink = openSink()
+         try:
+            resp = self.http.get(url,stream=True,timeout=self.timeout)
+            resp.raise_for_status()
+            for chunk in resp.iter_content(chunk_size=1024*1024):
+               sink.write(chunk)
+         except (requests.RequestException,socket.error):
+            sink.abort()
+            metrics.retry('http_fetch')
+            time.sleep(self.retryWait)
+            continue
+         except Exception:
+            sink.abort()
+            raise
+         nBytes = sink.close()
+         metrics.record('http_fetch',time.time() - tStart,nBytes)
+         return nBytes
+      raise IOError('Unable to retrieve file: ' + url)
+
+   def fetchPartial(self,remoteDir,fileName,outPath,skipVars):
+      # Download a NetCDF4 file without the data of skipVars (see
+      # rangeMod). Returns bytes fetched, or None if the file or this
+      # installation does not allow it and a full fetch is needed.
+      import requests
+      import rangeMod
+      url = remoteDir.rstrip('/') + '/' + fileName
+      for attempt in range(self.tries):
+         try:
+            return rangeMod.fetchPartial(self.http,url,outPath,skipVars,self.timeout)[0]
+         except rangeMod.RangeUnsupported as e:
+            log.info('Downloading %s whole: %s',url,e)
+            return None
+         except (requests.RequestException,socket.error):
+            metrics.retry('http_range_fetch')
+            time.sleep(self.retryWait)
+      raise IOError('Unable to retrieve file: ' + url)
+
+   def resetListings(self):
+      self.listings = {}
+
+   def close(self):
+      self.http.close()
+
+def loadListingCache(path):
+   # Upstream listings saved by the engine for the dry-run planner:
+   # {remoteDir: {'time': epoch, 'files': [...]}}, plus 'etag' and
+   # 'lastModified' for HTTP indexes.
+   try:
+      with open(path,'r') as fh:
+         return json.load(fh)
+   except (IOError,OSError,ValueError):
+      return {}
+
+def saveListingCache(path,listings,indexes=None):
+   # Merge listings ({remoteDir: set of names}) from the current pass
+   # into the cache, dropping directories not listed for two days.
+   # Validators of HTTP indexes ({remoteDir: fetchIndex result}) are
+   # kept with them.
+   cache = loadListingCache(path)
+   now = time.time()
+   for remoteDir,names in listings.items():
+      cache[remoteDir.rstrip('/')] = {'time':now,'files':sorted(names)}
+      index = (indexes or {}).get(remoteDir.rstrip('/'))
+      if index is not None:
+         cache[remoteDir.rstrip('/')]['etag'] = index.get('etag')
+         cache[remoteDir.rstrip('/')]['lastModified'] = index.get('lastModified')
+   cache = dict([(remoteDir,entry) for remoteDir,entry in cache.items() if now - entry['time'] < 2*86400])
+   outDir = os.path.dirname(path)
+   if outDir != '' and not os.path.isdir(outDir):
+      os.makedirs(outDir)
+   tmpPath = path + '.' + str(os.getpid())
+   with open(tmpPath,'w') as fh:
+      json.dump(cache,fh)
+   os.rename(tmpPath,path)
@@ -0,0 +1,277 @@
+# Spatial point-query indexes over the geospatial metadata templates,
+# so hydroInspector can find the reach or grid cell nearest a clicked
+# location without scanning the template coordinates. Built once per
+# template and published next to the data:
+#   channel points (channel_rt, reservoir): a grid hash, i.e. the
+#   points bucketed by latitude/longitude cell and sorted by cell, so
+#   a query only looks at the points of the cells around it
+#   (<template>.index.npz).
+#   LCC grids (land, terrain_rt, fe): the projection parameters and
+#   the affine x/y layout of the grid, so a query projects the
+#   location and rounds to a row and column (<template>.index.json).
+# Each published file gets a small lookup sidecar naming the index
+# that applies to it (see sidecar).
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# netCDF4 and numpy are imported inside the functions that use them,
+# as in compressMod.
+import hashlib
+import json
+import math
+import os
+
+from metricsMod import metrics
+
+# Earth radius (m) used by WRF-Hydro when the template does not give one.
+earthRadius = 6370000.0
+# Template types indexed as points, the rest are LCC grids.
+pointTypes = ['channel_rt','reservoir']
+
+def haversine(lat1,lon1,lat2,lon2):
+   # Great circle distance in km. Arguments may be numpy arrays.
+   import numpy as np
+   lat1,lon1,lat2,lon2 = [np.radians(value) for value in (lat1,lon1,lat2,lon2)]
+   a = np.sin((lat2 - lat1)/2.0)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2.0)**2
+   return 2.0*earthRadius/1000.0*np.arcsin(np.sqrt(np.minimum(a,1.0)))
+
+class PointIndex(object):
+   # Grid hash over points. Points are sorted by cell; cellStart[c]
+   # is the position in order of the first point of cell c, so the
+   # points of cell c are order[cellStart[c]:cellStart[c + 1]].
+
+   def __init__(self,lat,lon,featureId=None,cellSize=0.1):
+      import numpy as np
+      self.lat = np.asarray(lat,dtype='float32')
+      self.lon = np.asarray(lon,dtype='float32')
+      self.featureId = featureId
+      self.cellSize = cellSize
+      self.lat0 = float(np.floor(self.lat.min()/cellSize)*cellSize)
+      self.lon0 = float(np.floor(self.lon.min()/cellSize)*cellSize)
+      self.nLat = int((self.lat.max() - self.lat0)//cellSize) + 1
+      self.nLon = int((self.lon.max() - self.lon0)//cellSize) + 1
+      cells = self.cells(self.lat,self.lon)
+      self.order = np.argsort(cells,kind='mergesort').astype('int32')
+      counts = np.bincount(cells,minlength=self.nLat*self.nLon)
+      self.cellStart = np.concatenate([[0],np.cumsum(counts)]).astype('int32')
+
+   def cells(self,lat,lon):
+      import numpy as np
+      row = np.clip(((lat - self.lat0)//self.cellSize).astype('int64'),0,self.nLat - 1)
+      col = np.clip(((lon - self.lon0)//self.cellSize).astype('int64'),0,self.nLon - 1)
+      return row*self.nLon + col
+
+   def ring(self,row,col,radius):
+      # Positions (into lat/lon) of the points in the cells radius
+      # cells away from (row, col).
+      import numpy as np
+      parts = []
+      for cellRow in range(row - radius,row + radius + 1):
+         if cellRow < 0 or cellRow >= self.nLat:
+            continue
+         if abs(cellRow - row) == radius:
+            cols = range(col - radius,col + radius + 1)
+         else:
+            cols = [col - radius,col + radius]
+         for cellCol in cols:
+            if cellCol < 0 or cellCol >= self.nLon:
+               continue
+            cell = cellRow*self.nLon + cellCol
+            parts.append(self.order[self.cellStart[cell]:self.cellStart[cell + 1]])
+      if len(parts) == 0:
+         return np.zeros(0,dtype='int32')
+      return np.concatenate(parts)
+
+   def nearest(self,lat,lon,maxKm=50.0):
+      # (position, distance in km) of the point nearest a location, or
+      # None if there is none within maxKm. Rings of cells are searched
+      # outward until no unsearched cell can hold a closer point.
+      row = int((lat - self.lat0)//self.cellSize)
+      col = int((lon - self.lon0)//self.cellSize)
+      best = None
+      radius = 0
+      kmPerCell = self.cellSize*math.pi/180.0*earthRadius/1000.0
+      maxRadius = max(self.nLat,self.nLon)
+      while radius <= maxRadius:
+         # Closest any point in this ring or beyond can be: the location
+         # may lie anywhere in its own cell.
+         coslat = max(0.0,math.cos(math.radians(min(90.0,abs(lat) + (radius + 1)*self.cellSize))))
+         bound = max(0,radius - 1)*kmPerCell*coslat
+         if bound > maxKm or (best is not None and bound > best[1]):
+            break
+         found = self.ring(row,col,radius)
+         if len(found) > 0:
+            dist = haversine(lat,lon,self.lat[found],self.lon[found])
+            index = int(dist.argmin())
+            if best is None or dist[index] < best[1]:
+               best = (int(found[index]),float(dist[index]))
+         radius += 1
+      if best is None or best[1] > maxKm:
+         return None
+      return best
+
+   def save(self,path):
+      import numpy as np
+      arrays = {'lat':self.lat,'lon':self.lon,'order':self.order,'cellStart':self.cellStart,\
+                'grid':np.array([self.lat0,self.lon0,self.cellSize,self.nLat,self.nLon],dtype='float64')}
+      if self.featureId is not None:
+         arrays['feature_id'] = self.featureId
+      # numpy appends .npz to names without it.
+      with open(path,'wb') as fh:
+         np.savez_compressed(fh,**arrays)
+
+   @classmethod
+   def load(cls,path):
+      import numpy as np
+      data = np.load(path)
+      index = cls.__new__(cls)
+      index.lat = data['lat']
+      index.lon = data['lon']
+      index.order = data['order']
+      index.cellStart = data['cellStart']
+      index.featureId = data['feature_id'] if 'feature_id' in data.files else None
+      lat0,lon0,cellSize,nLat,nLon = data['grid']
+      index.lat0,index.lon0,index.cellSize = float(lat0),float(lon0),float(cellSize)
+      index.nLat,index.nLon = int(nLat),int(nLon)
+      return index
+
+class GridIndex(object):
+   # Lambert conformal conic grid with regularly spaced x/y. Rows and
+   # columns are those of the model output arrays: row 0 is the
+   # southernmost row, whatever order the template stores y in.
+
+   def __init__(self,params):
+      # params: the CF grid mapping attributes plus x0, dx, nx, y0, dy
+      # and ny of the grid cell centers (see fromTemplate).
+      self.params = params
+      phi1,phi2 = [math.radians(value) for value in params['standard_parallel']]
+      self.lon0 = math.radians(params['longitude_of_central_meridian'])
+      phi0 = math.radians(params['latitude_of_projection_origin'])
+      self.radius = params.get('earth_radius',earthRadius)
+      if abs(phi1 - phi2) < 1e-10:
+         self.n = math.sin(phi1)
+      else:
+         self.n = math.log(math.cos(phi1)/math.cos(phi2))/\
+                  math.log(math.tan(math.pi/4 + phi2/2)/math.tan(math.pi/4 + phi1/2))
+      self.F = math.cos(phi1)*math.tan(math.pi/4 + phi1/2)**self.n/self.n
+      self.rho0 = self.radius*self.F/math.tan(math.pi/4 + phi0/2)**self.n
+
+   def project(self,lat,lon):
+      # Projected (x, y) in m of a location.
+      rho = self.radius*self.F/math.tan(math.pi/4 + math.radians(lat)/2)**self.n
+      theta = self.n*(math.radians(lon) - self.lon0)
+      return rho*math.sin(theta) + self.params.get('false_easting',0.0),\
+             self.rho0 - rho*math.cos(theta) + self.params.get('false_northing',0.0)
+
+   def cell(self,lat,lon):
+      # (row, column) of the grid cell holding a location, or None
+      # outside the grid.
+      x,y = self.project(lat,lon)
+      params = self.params
+      col = int(round((x - params['x0'])/params['dx']))
+      row = int(round((y - params['y0'])/params['dy']))
+      if col < 0 or col >= params['nx'] or row < 0 or row >= params['ny']:
+         return None
+      return row,col
+
+   def save(self,path):
+      with open(path,'w') as fh:
+         json.dump(self.params,fh,indent=1,sort_keys=True)
+
+   @classmethod
+   def load(cls,path):
+      with open(path) as fh:
+         return cls(json.load(fh))
+
+def jsonValue(value):
+   # netCDF attribute value as plain JSON types.
+   if hasattr(value,'tolist'):
+      return value.tolist()
+   return value
+
+def fromTemplate(metaPath,nwmType):
+   # Build the index of a geospatial metadata template.
+   import netCDF4
+   import numpy as np
+   with metrics.timer('spatial_index',nwmType):
+      geo = netCDF4.Dataset(metaPath,'r')
+      try:
+         if nwmType in pointTypes:
+            names = [name for name in ['latitude','lat'] if name in geo.variables]
+            latName = names[0]
+            lonName = 'longitude' if latName == 'latitude' else 'lon'
+            featureId = None
+            for name in ['feature_id','link','lake_id']:
+               if name in geo.variables:
+                  featureId = np.asarray(geo.variables[name][:])
+                  break
+            return PointIndex(np.asarray(geo.variables[latName][:]),np.asarray(geo.variables[lonName][:]),\
+                              featureId)
+         crsName = [name for name,ncvar in geo.variables.items() if 'grid_mapping_name' in ncvar.ncattrs()][0]
+         crs = geo.variables[crsName]
+         if crs.getncattr('grid_mapping_name') != 'lambert_conformal_conic':
+            raise ValueError('Unsupported grid mapping in ' + metaPath + ': ' + crs.getncattr('grid_mapping_name'))
+         params = dict([(name,jsonValue(crs.getncattr(name))) for name in crs.ncattrs() \
+                        if name in ['grid_mapping_name','standard_parallel','longitude_of_central_meridian',\
+                                    'latitude_of_projection_origin','false_easting','false_northing',\
+                                    'earth_radius']])
+         if not isinstance(params['standard_parallel'],list):
+            params['standard_parallel'] = [params['standard_parallel']]*2
+         for axis in ['x','y']:
+            values = np.asarray(geo.variables[axis][:],dtype='float64')
+            params[axis + '0'] = float(values.min())
+            params['d' + axis] = float(abs(values[1] - values[0]))
+            params['n' + axis] = len(values)
+         return GridIndex(params)
+      finally:
+         geo.close()
+
+def indexName(metaPath,nwmType):
+   # File name of the index built from a template.
+   base = os.path.splitext(os.path.basename(metaPath))[0]
+   if nwmType in pointTypes:
+      return base + '.index.npz'
+   return base + '.index.json'
+
+def ensureIndex(metaPath,nwmType,indexDir):
+   # Path of the index of a template in indexDir, built if missing or
+   # older than the template.
+   indexPath = os.path.join(indexDir,indexName(metaPath,nwmType))
+   if os.path.isfile(indexPath) and os.path.getmtime(indexPath) >= os.path.getmtime(metaPath):
+      return indexPath
+   if not os.path.isdir(indexDir):
+      os.makedirs(indexDir)
+   tmpPath = indexPath + '.part'
+   fromTemplate(metaPath,nwmType).save(tmpPath)
+   os.rename(tmpPath,indexPath)
+   return indexPath
+
+def loadIndex(indexPath):
+   if indexPath.endswith('.npz'):
+      return PointIndex.load(indexPath)
+   return GridIndex.load(indexPath)
+
+def fileDigest(path):
+   # SHA-256 of a file, for sidecars to pin the index they refer to.
+   digest = hashlib.sha256()
+   with open(path,'rb') as fh:
+      for block in iter(lambda: fh.read(1024*1024),b''):
+         digest.update(block)
+   return digest.hexdigest()
+
+def sidecar(fileName,nwmType,indexPath,indexDigest,initTime=None,validTime=None):
+   # Contents of the lookup sidecar (<file>.lookup.json) published with
+   # a file: which index resolves a location to a position in its
+   # arrays, and the index version it was published against.
+   info = {'file':fileName,
+           'nwmType':nwmType,
+           'index':os.path.basename(indexPath),
+           'indexSha256':indexDigest,
+           'kind':'points' if nwmType in pointTypes else 'grid'}
+   if initTime is not None:
+      info['initTime'] = initTime.strftime('%Y-%m-%dT%H:%M:%SZ')
+   if validTime is not None:
+      info['validTime'] = validTime.strftime('%Y-%m-%dT%H:%M:%SZ')
+   return json.dumps(info,sort_keys=True).encode('utf-8')
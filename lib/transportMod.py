@@ -0,0 +1,232 @@
+# Transports used to publish files to the hydroInspector web host.
+# SshTransport runs every upload, chmod and move over a single
+# multiplexed SSH connection (OpenSSH ControlMaster), so publishing a
+# whole cycle costs one handshake instead of three per file. The
+# master is left running for a while after the process exits
+# (ControlPersist), so back to back cron runs reuse it as well.
+# LocalTransport writes to a local directory tree instead and is
+# meant for testing the workflow without a web host.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import os
+import shutil
+import subprocess
+import time
+
+import sinkMod
+from metricsMod import metrics
+
+try:
+   from shlex import quote
+except ImportError:
+   from pipes import quote
+
+class SshTransport(object):
+
+   def __init__(self,host,user=None,controlPath=None,persist=600,connectTimeout=60):
+      if user is not None:
+         host = user + '@' + host
+      self.host = host
+      if controlPath is None:
+         controlPath = os.path.join(os.path.expanduser('~'),'.ssh','inspector-%r@%h:%p')
+      self.controlPath = controlPath
+      self.persist = persist
+      self.connectTimeout = connectTimeout
+
+   def options(self):
+      # Options shared by ssh and scp: attach to the master if one is
+      # running, start one otherwise.
+      return ['-o','ControlMaster=auto',
+              '-o','ControlPath=' + self.controlPath,
+              '-o','ControlPersist=' + str(self.persist),
+              '-o','ConnectTimeout=' + str(self.connectTimeout),
+              '-o','BatchMode=yes',
+              '-o','LogLevel=QUIET']
+
+   def connect(self):
+      # Open the master connection ahead of the first transfer.
+      controlDir = os.path.dirname(self.controlPath)
+      if not os.path.isdir(controlDir):
+         os.makedirs(controlDir,0o700)
+      if not self.connected():
+         subprocess.check_call(['ssh'] + self.options() + ['-f','-N',self.host])
+
+   def connected(self):
+      with open(os.devnull,'w') as devnull:
+         return subprocess.call(['ssh','-o','ControlPath=' + self.controlPath,'-O','check',self.host],\
+                                stdout=devnull,stderr=subprocess.STDOUT) == 0
+
+   def run(self,cmd):
+      # Run a list of remote commands, joined with &&, in one round trip.
+      remote = ' && '.join([' '.join([quote(arg) for arg in args]) for args in cmd])
+      with metrics.timer('ssh_command'):
+         subprocess.check_call(['ssh'] + self.options() + [self.host,remote])
+
+   def put(self,localPath,remoteDir):
+      with metrics.timer('scp_put') as timer:
+         subprocess.check_call(['scp','-q'] + self.options() + [localPath,self.host + ':' + remoteDir + '/'])
+         timer.bytes = os.path.getsize(localPath)
+
+   def openSink(self,remotePath):
+      # Sink streaming straight into a remote file over the master
+      # connection, without a local copy.
+      return sinkMod.PipeSink(['ssh'] + self.options() + [self.host,'cat > ' + quote(remotePath)])
+
+   def chmod(self,remotePath,mode):
+      self.run([['chmod','%o' % mode,remotePath]])
+
+   def move(self,remotePath,remoteDir):
+      self.run([['mv',remotePath,remoteDir + '/']])
+
+   def copy(self,srcPath,dstPath):
+      # Copy a file already on the web host; nothing crosses the network.
+      self.run([['cp',srcPath,dstPath]])
+
+   def publish(self,localPath,tmpDir,finalDir,mode=0o777):
+      # Upload to tmpDir, then make readable and atomically move into
+      # finalDir with a single remote command.
+      tmpPath = tmpDir + '/' + os.path.basename(localPath)
+      self.put(localPath,tmpDir)
+      self.run([['chmod','%o' % mode,tmpPath],['mv',tmpPath,finalDir + '/']])
+
+   def sizes(self,remotePaths):
+      # Sizes in bytes of remote files, keyed by path. Files that do
+      # not exist are left out.
+      if len(remotePaths) == 0:
+         return {}
+      # stat exits non-zero if any file is missing; report what exists.
+      remote = 'stat -c "%s %n" ' + ' '.join([quote(path) for path in remotePaths]) + ' 2>/dev/null; true'
+      with metrics.timer('ssh_command'):
+         out = subprocess.check_output(['ssh'] + self.options() + [self.host,remote]).decode('utf-8')
+      sizes = {}
+      for line in out.splitlines():
+         size,path = line.split(' ',1)
+         sizes[path] = int(size)
+      return sizes
+
+   def stale(self,remoteDir,maxAge):
+      # Paths of the files in a remote directory last modified more
+      # than maxAge seconds ago.
+      remote = 'find ' + quote(remoteDir) + ' -maxdepth 1 -type f -mmin +' + str(int(maxAge//60)) + \
+               ' 2>/dev/null; true'
+      with metrics.timer('ssh_command'):
+         out = subprocess.check_output(['ssh'] + self.options() + [self.host,remote]).decode('utf-8')
+      return [line for line in out.splitlines() if line != '']
+
+   def promote(self,remotePaths,finalDir,mode=0o777):
+      # chmod and move many files into finalDir with one remote command.
+      if len(remotePaths) == 0:
+         return
+      self.run([['chmod','%o' % mode] + list(remotePaths),['mv'] + list(remotePaths) + [finalDir + '/']])
+
+   def remove(self,remotePaths):
+      if len(remotePaths) == 0:
+         return
+      self.run([['rm','-f'] + list(remotePaths)])
+
+   def keepAlive(self):
+      # ControlPersist keeps the master alive between uses.
+      pass
+
+   def close(self):
+      # The master is left running for the next run; see ControlPersist.
+      pass
+
+   def shutdown(self):
+      # Stop the master connection.
+      with open(os.devnull,'w') as devnull:
+         subprocess.call(['ssh','-o','ControlPath=' + self.controlPath,'-O','exit',self.host],\
+                         stdout=devnull,stderr=subprocess.STDOUT)
+
+class LocalTransport(object):
+   # Remote paths are mapped under a local root directory.
+
+   def __init__(self,root):
+      self.root = root
+
+   def localPath(self,remotePath):
+      return os.path.join(self.root,remotePath.lstrip('/'))
+
+   def connect(self):
+      pass
+
+   def put(self,localPath,remoteDir):
+      outDir = self.localPath(remoteDir)
+      if not os.path.isdir(outDir):
+         os.makedirs(outDir)
+      shutil.copy(localPath,outDir)
+
+   def openSink(self,remotePath):
+      outDir = os.path.dirname(self.localPath(remotePath))
+      if not os.path.isdir(outDir):
+         os.makedirs(outDir)
+      return sinkMod.FileSink(self.localPath(remotePath))
+
+   def chmod(self,remotePath,mode):
+      os.chmod(self.localPath(remotePath),mode)
+
+   def move(self,remotePath,remoteDir):
+      outDir = self.localPath(remoteDir)
+      if not os.path.isdir(outDir):
+         os.makedirs(outDir)
+      os.rename(self.localPath(remotePath),os.path.join(outDir,os.path.basename(remotePath)))
+
+   def copy(self,srcPath,dstPath):
+      outDir = os.path.dirname(self.localPath(dstPath))
+      if not os.path.isdir(outDir):
+         os.makedirs(outDir)
+      shutil.copyfile(self.localPath(srcPath),self.localPath(dstPath))
+
+   def publish(self,localPath,tmpDir,finalDir,mode=0o777):
+      tmpPath = tmpDir + '/' + os.path.basename(localPath)
+      self.put(localPath,tmpDir)
+      self.chmod(tmpPath,mode)
+      self.move(tmpPath,finalDir)
+
+   def sizes(self,remotePaths):
+      sizes = {}
+      for path in remotePaths:
+         if os.path.isfile(self.localPath(path)):
+            sizes[path] = os.path.getsize(self.localPath(path))
+      return sizes
+
+   def stale(self,remoteDir,maxAge):
+      outDir = self.localPath(remoteDir)
+      if not os.path.isdir(outDir):
+         return []
+      cutoff = time.time() - maxAge
+      return [remoteDir.rstrip('/') + '/' + fileName for fileName in sorted(os.listdir(outDir)) \
+              if os.path.isfile(os.path.join(outDir,fileName)) and \
+              os.path.getmtime(os.path.join(outDir,fileName)) < cutoff]
+
+   def promote(self,remotePaths,finalDir,mode=0o777):
+      for path in remotePaths:
+         self.chmod(path,mode)
+         self.move(path,finalDir)
+
+   def remove(self,remotePaths):
+      for path in remotePaths:
+         if os.path.isfile(self.localPath(path)):
+            os.remove(self.localPath(path))
+
+   def keepAlive(self):
+      pass
+
+   def close(self):
+      pass
+
+   def shutdown(self):
+      pass
+
+def webTransport(config):
+   # Transport to the web host described by the workflow config:
+   # 'ssh' (default), or 'local' to write under config['webRoot'].
+   kind = config.get('webTransport','ssh')
+   if kind == 'ssh':
+      return SshTransport(config['webHost'],user=config.get('webUser'))
+   elif kind == 'local':
+      return LocalTransport(config['webRoot'])
+   raise ValueError('Unknown web transport: ' + kind)
@@ -0,0 +1,136 @@
+# Python program to pull NWM output for any subset of the products
+# in the catalog (lib/catalogMod.py) in a single process, process
+# them, then push them to hydro-c1-web for display on hydroInspector.
+# Replaces running each process_*_Inspector driver separately.
+
+# Usage:
+#   python process_Inspector.py                       (every product)
+#   python process_Inspector.py --products short_land,short_land_para
+#   python process_Inspector.py --range short_range --stream para
+#   python process_Inspector.py --list
+#   python process_Inspector.py --plan [--verbose]   (dry run, nothing downloaded)
+#   python process_Inspector.py --shared-dir /shared/inspector --node n1 --shard 1/3
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import logging
+import os
+import sys
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+# Import custom libraries for this workflow
+import catalogMod
+import engineMod
+import inspectorMod
+import leaseMod
+
+parser = argparse.ArgumentParser(description='Ingest NWM products for hydroInspector.')
+parser.add_argument('--products',default=None,help='Comma separated product names (see --list).')
+parser.add_argument('--range',default=None,dest='rangeName',choices=sorted(catalogMod.ranges.keys()))
+parser.add_argument('--stream',default=None,choices=sorted(catalogMod.streams.keys()))
+parser.add_argument('--tag',default='All',help='Name used for the lock file and email titles.')
+parser.add_argument('--list',action='store_true',help='List catalog products and exit.')
+parser.add_argument('--plan',action='store_true',\
+                    help='Report pending work from the ledger and cached listings, then exit.')
+parser.add_argument('--verbose',action='store_true',help='With --plan, list every missing item.')
+parser.add_argument('--shared-dir',default=None,dest='sharedDir',\
+                    help='Ledger and leases directory shared with other ingest nodes.')
+parser.add_argument('--node',default=None,help='Name of this ingest node (default: host name).')
+parser.add_argument('--shard',default=None,help='I/N: take shard I of N first when sharing work.')
+args = parser.parse_args()
+
+if args.sharedDir is not None:
+   catalogMod.useSharedDir(args.sharedDir)
+if args.node is not None:
+   catalogMod.config['nodeId'] = args.node
+shard = None
+if args.shard is not None:
+   try:
+      shard = engineMod.parseShard(args.shard)
+   except ValueError as e:
+      parser.error(str(e))
+
+if args.list:
+   for product in catalogMod.selectProducts():
+      print('%-22s %-15s %-10s %-5s %s' % (product['name'],product['range'],product['kind'],\
+                                          product['stream'],product['remoteDir']))
+   sys.exit(0)
+
+names = None
+if args.products is not None:
+   names = [name.strip() for name in args.products.split(',') if name.strip() != '']
+try:
+   products = catalogMod.selectProducts(names,rangeName=args.rangeName,stream=args.stream)
+except KeyError as e:
+   parser.error(str(e))
+
+if args.plan:
+   import latencyMod
+   import ledgerMod
+   import planMod
+   import sourceMod
+   ledger = ledgerMod.Ledger(catalogMod.config['ledgerPath'],journalMode=catalogMod.config['ledgerJournal'])
+   listings = sourceMod.loadListingCache(catalogMod.config['listingCache'])
+   entries = planMod.plan(products,ledger,latencyMod.LatencyModel(ledger),listings)
+   ledger.close()
+   print('%-22s %6s %7s %9s %7s %7s %10s %9s %8s' % ('product','window','missing','available','unknown',\
+                                                   'not yet','est MB','est min','list age'))
+   totals = [0,0,0,0,0,0.0,0.0]
+   for entry in entries:
+      estMB = (entry['estBytes'] or 0)/1e6
+      estMin = (entry['estSeconds'] or 0)/60.0
+      age = '-' if entry['listingAge'] is None else '%dm' % (entry['listingAge']/60)
+      print('%-22s %6d %7d %9d %7d %7d %10.1f %9.1f %8s' % (entry['product'],entry['window'],\
+            len(entry['missing']),len(entry['available']),len(entry['unknown']),len(entry['notYet']),\
+            estMB,estMin,age))
+      counts = [entry['window'],len(entry['missing']),len(entry['available']),len(entry['unknown']),\
+                len(entry['notYet']),estMB,estMin]
+      totals = [total + count for total,count in zip(totals,counts)]
+      if args.verbose:
+         for label in ['available','unknown','notYet']:
+            for cycle,fHour in entry[label]:
+               print('   %s f%03d %s' % (cycle,fHour,label))
+   print('%-22s %6d %7d %9d %7d %7d %10.1f %9.1f' % tuple(['total'] + totals))
+   print('available: in the last listing; unknown: not listed, may be published; not yet: before its')
+   print('expected publication time. Estimates use mean bytes/seconds per item over the last 7 days.')
+   sys.exit(0)
+
+logging.basicConfig(level=logging.INFO,format='%(asctime)s %(levelname)s %(message)s')
+
+# Establish workflow variables
+errTitle = 'Error_Process_Inspector_' + args.tag
+warningTitle = 'Warning_Process_Inspector_' + args.tag
+email = catalogMod.config['email']
+
+# Get PID from this process
+pid = os.getpid()
+
+# Work is claimed per product/cycle/forecast hour through leases, so
+# overlapping runs split the remaining items between them. The lock
+# file is per process and only marks this run as active; those left
+# behind by crashed runs are removed.
+inspectorMod.cleanLocks(catalogMod.config['lockDir'] + '/Process_Inspector_' + args.tag + '_*.LOCK')
+lockFile = catalogMod.config['lockDir'] + '/Process_Inspector_' + args.tag + '_' + str(pid) + '.LOCK'
+inspectorMod.createLock(lockFile,pid,warningTitle,email)
+
+# Clear leases left behind by crashed runs.
+leases = leaseMod.LeaseManager(catalogMod.config['leaseDir'],node=catalogMod.config['nodeId'])
+leases.clean()
+
+engine = engineMod.IngestEngine(products,errTitle,lockFile,email,leases=leases)
+engine.shard = shard
+try:
+   # Remove what crashed runs left behind; journaled items resume.
+   engine.collectGarbage()
+   engine.runOnce()
+finally:
+   engine.close()
+engine.reportFailures()
+
+# Delete lock file
+inspectorMod.deleteFile(lockFile,errTitle,email,lockFile)
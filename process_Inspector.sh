@@ -0,0 +1,17 @@
+#!/bin/sh
+
+# Top level script that calls Python for processing of every
+# catalog product for hydro-inspector in a single process.
+# Extra arguments (e.g. --range short_range) are passed through.
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# Source bash environment
+. $HOME/.profile
+
+cd /d4/karsten/NWM_INSPECTOR/inspector_processing
+python process_Inspector.py "$@"
+
+exit 0
@@ -0,0 +1,117 @@
+# Long running ingest daemon. Loads the libraries once, keeps
+# upstream connections and the completion ledger open, and polls for new
+# NWM output on a short interval so files are published within
+# seconds of appearing, instead of waiting for the next cron slot.
+# Takes the same product selection arguments as process_Inspector.py.
+# With --discover, each pass lists every upstream directory once and
+# only works on files that are new since the previous pass.
+
+# Usage:
+#   python process_Inspector_Daemon.py --interval 60
+#   python process_Inspector_Daemon.py --range short_range --tag Short
+#   python process_Inspector_Daemon.py --discover
+#   python process_Inspector_Daemon.py --shared-dir /shared/inspector --node n2 --shard 2/3
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import logging
+import logging.handlers
+import os
+import signal
+import sys
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+# Import custom libraries for this workflow
+import catalogMod
+import discoveryMod
+import engineMod
+import inspectorMod
+
+parser = argparse.ArgumentParser(description='Resident NWM ingest daemon for hydroInspector.')
+parser.add_argument('--products',default=None,help='Comma separated product names.')
+parser.add_argument('--range',default=None,dest='rangeName',choices=sorted(catalogMod.ranges.keys()))
+parser.add_argument('--stream',default=None,choices=sorted(catalogMod.streams.keys()))
+parser.add_argument('--tag',default='Daemon',help='Name used for the lock file and email titles.')
+parser.add_argument('--interval',type=int,default=60,help='Seconds between idle polls.')
+parser.add_argument('--report-interval',type=int,default=3600,dest='reportInterval',\
+                    help='Minimum seconds between failure summary emails.')
+parser.add_argument('--discover',action='store_true',\
+                    help='Drive passes from new upstream files instead of the product windows.')
+parser.add_argument('--shared-dir',default=None,dest='sharedDir',\
+                    help='Ledger and leases directory shared with other ingest nodes.')
+parser.add_argument('--node',default=None,help='Name of this ingest node (default: host name).')
+parser.add_argument('--shard',default=None,help='I/N: take shard I of N first when sharing work.')
+parser.add_argument('--log',default=catalogMod.config['baseDir'] + '/logs/inspector_daemon.log',\
+                    help='Log file (reopened if rotated).')
+args = parser.parse_args()
+
+if args.sharedDir is not None:
+   catalogMod.useSharedDir(args.sharedDir)
+if args.node is not None:
+   catalogMod.config['nodeId'] = args.node
+shard = None
+if args.shard is not None:
+   try:
+      shard = engineMod.parseShard(args.shard)
+   except ValueError as e:
+      parser.error(str(e))
+
+names = None
+if args.products is not None:
+   names = [name.strip() for name in args.products.split(',') if name.strip() != '']
+try:
+   products = catalogMod.selectProducts(names,rangeName=args.rangeName,stream=args.stream)
+except KeyError as e:
+   parser.error(str(e))
+
+logDir = os.path.dirname(args.log)
+if logDir != '' and not os.path.isdir(logDir):
+   os.makedirs(logDir)
+handler = logging.handlers.WatchedFileHandler(args.log)
+handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logging.getLogger().addHandler(handler)
+logging.getLogger().setLevel(logging.INFO)
+
+# Establish workflow variables
+errTitle = 'Error_Process_Inspector_' + args.tag
+warningTitle = 'Warning_Process_Inspector_' + args.tag
+lockFile = catalogMod.config['lockDir'] + '/Process_Inspector_' + args.tag + '.LOCK'
+email = catalogMod.config['email']
+
+# Get PID from this process
+pid = os.getpid()
+
+# Create lock file for this process
+inspectorMod.createLock(lockFile,pid,warningTitle,email)
+
+engine = engineMod.IngestEngine(products,errTitle,lockFile,email)
+engine.shard = shard
+if args.discover:
+   engine.discovery = discoveryMod.Discovery()
+
+def requestStop(signum,frame):
+   # Finish the file in progress, then exit cleanly.
+   logging.info('Received signal %d, stopping after current item',signum)
+   engine.stopRequested = True
+
+signal.signal(signal.SIGTERM,requestStop)
+signal.signal(signal.SIGINT,requestStop)
+
+logging.info('Daemon started, PID %d, %d product(s)',pid,len(products))
+try:
+   engine.serve(interval=args.interval,reportInterval=args.reportInterval)
+except Exception as e:
+   logging.exception('Daemon aborted')
+   engine.close()
+   errMsg = 'ERROR: Ingest daemon aborted: ' + str(e)
+   inspectorMod.errOut(errMsg,errTitle,email,lockFile)
+engine.close()
+logging.info('Daemon stopped')
+
+# Delete lock file
+inspectorMod.deleteFile(lockFile,errTitle,email,lockFile)
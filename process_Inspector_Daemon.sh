@@ -0,0 +1,37 @@
+#!/bin/sh
+
+# Watchdog for the resident ingest daemon. Safe to run from cron
+# every few minutes: starts the daemon only if it is not already
+# running, clearing a lock left behind by a daemon that died.
+# Extra arguments (e.g. --range short_range --tag Short) are passed
+# through; the lock file name follows --tag (default Daemon).
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+# Source bash environment
+. $HOME/.profile
+
+tag=Daemon
+prev=
+for arg in "$@"; do
+   if [ "$prev" = "--tag" ]; then
+      tag=$arg
+   fi
+   prev=$arg
+done
+lockFile=$HOME/tmp/Process_Inspector_${tag}.LOCK
+
+if [ -f $lockFile ]; then
+   pid=`cat $lockFile`
+   if kill -0 $pid 2>/dev/null; then
+      exit 0
+   fi
+   rm -f $lockFile
+fi
+
+cd /d4/karsten/NWM_INSPECTOR/inspector_processing
+nohup python process_Inspector_Daemon.py "$@" > /dev/null 2>&1 &
+
+exit 0
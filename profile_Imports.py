@@ -0,0 +1,90 @@
+# Import-time profile of the workflow libraries. Each module is
+# imported in a fresh interpreter, reporting the wall time of the
+# import and which heavy third party/standard modules it pulled in.
+# Use it to keep the startup path of cron-launched drivers lean:
+# a driver that finds nothing to do should only pay for os/sys.
+
+# Usage:
+#   python profile_Imports.py
+#   python profile_Imports.py --modules inspectorMod,engineMod --repeat 5
+#   python profile_Imports.py --detail engineMod   (Python 3.7+, -X importtime)
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+libDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib')
+
+defaultModules = ['inspectorMod','compressMod','catalogMod','sourceMod','engineMod']
+
+# Modules that are expensive to load and should only appear on the
+# code path that actually needs them.
+heavyModules = ['netCDF4','numpy','bs4','requests','urllib3','smtplib','email.mime',\
+                'ftplib','multiprocessing','ssl','logging.handlers']
+
+probe = """
+import json, sys, time
+sys.path.insert(0, %r)
+before = set(sys.modules)
+tStart = time.time()
+import %s
+elapsed = time.time() - tStart
+loaded = sorted(set(sys.modules) - before)
+print(json.dumps({'seconds': elapsed, 'loaded': loaded}))
+"""
+
+def profileModule(modName,repeat):
+   # Best of repeat imports, each in a new interpreter.
+   best = None
+   for count in range(repeat):
+      out = subprocess.check_output([sys.executable,'-c',probe % (libDir,modName)])
+      result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+      if best is None or result['seconds'] < best['seconds']:
+         best = result
+   heavy = [mod for mod in heavyModules if mod in best['loaded']]
+   return best['seconds'],len(best['loaded']),heavy
+
+def importTimeDetail(modName,top):
+   # Per module cumulative import times from -X importtime.
+   proc = subprocess.Popen([sys.executable,'-X','importtime','-c','import ' + modName],\
+                           cwd=libDir,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+   out,err = proc.communicate()
+   rows = []
+   for line in err.decode('utf-8').splitlines():
+      if not line.startswith('import time:') or 'cumulative' in line:
+         continue
+      fields = line[len('import time:'):].split('|')
+      rows.append((int(fields[1]),fields[2].rstrip()))
+   rows.sort(reverse=True)
+   return rows[:top]
+
+parser = argparse.ArgumentParser(description='Report import-time cost of workflow modules.')
+parser.add_argument('--modules',default=','.join(defaultModules))
+parser.add_argument('--repeat',type=int,default=3,help='Imports per module; the fastest is reported.')
+parser.add_argument('--detail',default=None,help='Module to break down with -X importtime.')
+parser.add_argument('--top',type=int,default=20)
+args = parser.parse_args()
+
+print('%-14s %10s %8s  %s' % ('module','ms','modules','heavy imports at load'))
+for modName in args.modules.split(','):
+   try:
+      seconds,nLoaded,heavy = profileModule(modName,args.repeat)
+   except subprocess.CalledProcessError:
+      print('%-14s %10s' % (modName,'FAILED'))
+      continue
+   print('%-14s %10.1f %8d  %s' % (modName,seconds*1000.0,nLoaded,', '.join(heavy) or '-'))
+
+if args.detail is not None:
+   if sys.version_info < (3,7):
+      print('-X importtime requires Python 3.7 or newer.')
+      sys.exit(1)
+   print('')
+   print('%12s  %s' % ('cumulative us','module'))
+   for cumulative,name in importTimeDetail(args.detail,args.top):
+      print('%12d  %s' % (cumulative,name))
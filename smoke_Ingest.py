@@ -0,0 +1,244 @@
+# Smoke test of the download paths that are off by default: partial
+# HTTP downloads (config['partialFetch'], lib/rangeMod.py) and
+# in-memory decode (config['decodeInMemory']). A synthetic land file
+# is served from a local HTTP server that honours Range requests, and
+# pushed through the ingest engine, publishing to a LocalTransport,
+# once per path with a product compressed by compressNWM. Each path's
+# published file must hold the same data as a plain download to disk.
+# Without h5py 2.10 or later, partialFetch can only take its fallback
+# to a whole download, which is reported.
+
+# Usage:
+#   python smoke_Ingest.py
+#   python smoke_Ingest.py --scale 0.25 --work-dir /tmp/smoke --keep
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import datetime
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+try:
+   from SimpleHTTPServer import SimpleHTTPRequestHandler
+   from BaseHTTPServer import HTTPServer
+   from SocketServer import ThreadingMixIn
+except ImportError:
+   from http.server import SimpleHTTPRequestHandler, HTTPServer
+   from socketserver import ThreadingMixIn
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+parser = argparse.ArgumentParser(description='Smoke test partial HTTP downloads and in-memory decode.')
+parser.add_argument('--scale',type=float,default=0.1,\
+                    help='Fraction of full CONUS dimensions for the synthetic land grid.')
+parser.add_argument('--work-dir',default=None,dest='workDir',help='Scratch directory. Default is a temporary directory.')
+parser.add_argument('--keep',action='store_true',help='Keep the scratch directory.')
+args = parser.parse_args()
+
+import netCDF4
+import numpy as np
+
+import benchMod
+import catalogMod
+import engineMod
+
+logging.basicConfig(level=logging.WARNING,format='%(asctime)s %(levelname)s %(message)s')
+
+class RangeHandler(SimpleHTTPRequestHandler):
+   # Serves the upstream directory, answering a single byte range
+   # (Range: bytes=START-END) with 206 Partial Content.
+
+   def translate_path(self,path):
+      relPath = os.path.relpath(SimpleHTTPRequestHandler.translate_path(self,path),os.getcwd())
+      return os.path.join(self.server.root,relPath)
+
+   def end_headers(self):
+      self.send_header('Accept-Ranges','bytes')
+      SimpleHTTPRequestHandler.end_headers(self)
+
+   def send_head(self):
+      self.rangeBytes = None
+      match = re.match(r'^bytes=(\d+)-(\d*)$',self.headers.get('Range') or '')
+      path = self.translate_path(self.path)
+      if match is None or not os.path.isfile(path):
+         return SimpleHTTPRequestHandler.send_head(self)
+      size = os.path.getsize(path)
+      start = int(match.group(1))
+      end = size - 1
+      if match.group(2) != '':
+         end = min(int(match.group(2)),size - 1)
+      if start > end:
+         self.send_error(416,'Requested range not satisfiable')
+         return None
+      fileIn = open(path,'rb')
+      fileIn.seek(start)
+      self.rangeBytes = end - start + 1
+      self.send_response(206)
+      self.send_header('Content-Type','application/octet-stream')
+      self.send_header('Content-Range','bytes %d-%d/%d' % (start,end,size))
+      self.send_header('Content-Length',str(self.rangeBytes))
+      self.end_headers()
+      return fileIn
+
+   def copyfile(self,source,outputfile):
+      if self.rangeBytes is None:
+         return SimpleHTTPRequestHandler.copyfile(self,source,outputfile)
+      remaining = self.rangeBytes
+      while remaining > 0:
+         data = source.read(min(remaining,64*1024))
+         if not data:
+            break
+         outputfile.write(data)
+         remaining -= len(data)
+
+   def log_message(self,format,*args):
+      pass
+
+class UpstreamServer(ThreadingMixIn,HTTPServer):
+   daemon_threads = True
+
+   def __init__(self,root):
+      HTTPServer.__init__(self,('127.0.0.1',0),RangeHandler)
+      self.root = root
+
+def readVars(path):
+   # {variable: values} of a published file.
+   idIn = netCDF4.Dataset(path,'r')
+   try:
+      return dict([(varName,np.ma.asarray(var[:])) for varName,var in idIn.variables.items()])
+   finally:
+      idIn.close()
+
+def sameData(base,other):
+   # Names of the variables whose values or masks differ between two
+   # readVars results.
+   differ = sorted(set(base.keys()) ^ set(other.keys()))
+   for varName in sorted(set(base.keys()) & set(other.keys())):
+      if not np.array_equal(np.ma.getmaskarray(base[varName]),np.ma.getmaskarray(other[varName])) or \
+         not np.ma.allequal(base[varName],other[varName]):
+         differ.append(varName)
+   return differ
+
+def runCase(name,flags,product,dCycle,fHour,workDir):
+   # Publish one item through a fresh engine with the given config
+   # flags. Returns (item, published path, engine).
+   caseDir = os.path.join(workDir,name)
+   os.makedirs(os.path.join(caseDir,'complete'))
+   config = catalogMod.config
+   config.update({'ledgerPath':caseDir + '/ledger.db',
+                  'listingCache':caseDir + '/listings.json',
+                  'manifestDir':caseDir + '/manifests',
+                  'leaseDir':caseDir + '/leases',
+                  'metricsDir':caseDir + '/metrics',
+                  'indexDir':caseDir + '/index',
+                  'seriesDir':caseDir + '/series',
+                  'spillDir':caseDir,
+                  'webTransport':'local',
+                  'webRoot':caseDir + '/web',
+                  'dedupStreams':[],
+                  'spatialIndex':False,
+                  'seriesStore':False})
+   config.update(flags)
+   product = dict(product)
+   product['completeDir'] = caseDir + '/complete'
+   item = engineMod.WorkItem(product,dCycle,fHour)
+   engine = engineMod.IngestEngine([product],'Error_Smoke_Ingest',caseDir + '/smoke.LOCK',config['email'])
+   try:
+      engine.runItems([item],dCycle + datetime.timedelta(hours=fHour + 3))
+   finally:
+      engine.close()
+   return item,os.path.join(caseDir,'web',product['webDirFinal'].lstrip('/'),item.fileCompress),engine
+
+workDir = args.workDir
+if workDir is None:
+   workDir = tempfile.mkdtemp(prefix='smoke_ingest_')
+elif not os.path.isdir(workDir):
+   os.makedirs(workDir)
+
+server = None
+failed = False
+try:
+   # Upstream: a synthetic land file with variables both kept and
+   # skipped (compressMod.varsSkip) by compressNWM.
+   dCycle = datetime.datetime(2017,8,15,0)
+   fHour = 1
+   upstreamDir = os.path.join(workDir,'upstream')
+   shape = benchMod.scaledDims('land',args.scale)
+   varList = benchMod.synthVars['land']
+   metaPath = os.path.join(workDir,'land_meta.nc')
+   benchMod.makeMetaFile('land',metaPath,shape)
+
+   server = UpstreamServer(upstreamDir)
+   thread = threading.Thread(target=server.serve_forever,name='upstream')
+   thread.daemon = True
+   thread.start()
+
+   product = dict(catalogMod.products['short_land'])
+   product.update({'name':'smoke_land',
+                   'source':'http',
+                   'remoteDir':'http://127.0.0.1:%d/nwm.{ymd}/short_range' % server.server_address[1],
+                   'steps':['compressNWM'],
+                   'metaPath':metaPath})
+   item = engineMod.WorkItem(product,dCycle,fHour)
+   remotePath = os.path.join(upstreamDir,'nwm.' + dCycle.strftime('%Y%m%d'),'short_range',item.remoteFile)
+   os.makedirs(os.path.dirname(remotePath))
+   benchMod.makeSyntheticFile('land',remotePath,shape,varList)
+   size = os.path.getsize(remotePath)
+   print('Upstream %s, %.1f MB' % (item.remoteFile,size/1e6))
+
+   cases = [('disk',{'partialFetch':False,'decodeInMemory':False}),
+            ('partial',{'partialFetch':True,'decodeInMemory':False}),
+            ('memory',{'partialFetch':False,'decodeInMemory':True})]
+   base = None
+   for name,flags in cases:
+      item,outPath,engine = runCase(name,flags,product,dCycle,fHour,workDir)
+      if not os.path.isfile(outPath):
+         print('%-8s FAIL nothing published: %s' % (name,'; '.join(engine.failures)))
+         failed = True
+         continue
+      if name == 'partial':
+         if engine.rangeSupport():
+            path = 'partial, %.1f of %.1f MB' % (item.nBytes/1e6,size/1e6)
+            if item.nBytes >= size:
+               print('%-8s FAIL h5py is usable but the file was downloaded whole' % name)
+               failed = True
+         else:
+            path = 'whole, h5py unavailable (fallback)'
+      elif name == 'memory':
+         path = 'in memory' if engine.inMemory(item) else 'on disk'
+         if not engine.inMemory(item):
+            print('%-8s FAIL the download was not kept in memory' % name)
+            failed = True
+      else:
+         path = 'on disk'
+      data = readVars(outPath)
+      if base is None:
+         base = data
+         print('%-8s ok   %s, %d variable(s) published' % (name,path,len(data)))
+         continue
+      differ = sameData(base,data)
+      if len(differ) > 0:
+         print('%-8s FAIL %s, differs from disk in: %s' % (name,path,', '.join(differ)))
+         failed = True
+      else:
+         print('%-8s ok   %s, same data as disk' % (name,path))
+finally:
+   if server is not None:
+      server.shutdown()
+      server.server_close()
+   if args.keep:
+      print('Scratch directory kept: ' + workDir)
+   else:
+      shutil.rmtree(workDir,ignore_errors=True)
+
+if failed:
+   sys.exit(1)
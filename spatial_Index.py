@@ -0,0 +1,76 @@
+# Build and query the spatial indexes of the geospatial metadata
+# templates (lib/spatialMod.py). The ingest engine builds and
+# publishes them on first use; this tool rebuilds them ahead of time
+# (e.g. after a template changes) and answers point queries, to check
+# an index against what hydroInspector shows.
+
+# Usage:
+#   python spatial_Index.py build [--types channel_rt,land]
+#   python spatial_Index.py query --type channel_rt --lat 40.01 --lon -105.27
+
+# Logan Karsten
+# National Center for Atmospheric Research
+# Research Applications Laboratory
+
+import argparse
+import os
+import sys
+import time
+
+# Append path to include custom libraries for this workflow
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'lib'))
+
+# Import custom libraries for this workflow
+import catalogMod
+import spatialMod
+
+parser = argparse.ArgumentParser(description='Build and query hydroInspector spatial indexes.')
+parser.add_argument('command',choices=['build','query'])
+parser.add_argument('--types',default=None,help='build: comma separated template types (default all).')
+parser.add_argument('--type',default='channel_rt',dest='nwmType',choices=sorted(catalogMod.metaFiles.keys()),\
+                    help='query: template type to query.')
+parser.add_argument('--lat',type=float,default=None)
+parser.add_argument('--lon',type=float,default=None)
+parser.add_argument('--max-km',type=float,default=50.0,dest='maxKm',help='query: search radius for points.')
+args = parser.parse_args()
+
+indexDir = catalogMod.config['indexDir']
+
+if args.command == 'build':
+   types = sorted(catalogMod.metaFiles.keys())
+   if args.types is not None:
+      types = [name.strip() for name in args.types.split(',') if name.strip() != '']
+   for nwmType in types:
+      metaPath = catalogMod.metaFiles[nwmType]
+      indexPath = os.path.join(indexDir,spatialMod.indexName(metaPath,nwmType))
+      # Force a rebuild.
+      if os.path.isfile(indexPath):
+         os.remove(indexPath)
+      tStart = time.time()
+      spatialMod.ensureIndex(metaPath,nwmType,indexDir)
+      print('%-11s %s %.1f MB %.1f s' % (nwmType,indexPath,os.path.getsize(indexPath)/1e6,time.time() - tStart))
+
+elif args.command == 'query':
+   if args.lat is None or args.lon is None:
+      parser.error('query needs --lat and --lon')
+   metaPath = catalogMod.metaFiles[args.nwmType]
+   index = spatialMod.loadIndex(spatialMod.ensureIndex(metaPath,args.nwmType,indexDir))
+   tStart = time.time()
+   if args.nwmType in spatialMod.pointTypes:
+      found = index.nearest(args.lat,args.lon,args.maxKm)
+      seconds = time.time() - tStart
+      if found is None:
+         print('No point within %.1f km' % args.maxKm)
+      else:
+         position,dist = found
+         featureId = '-' if index.featureId is None else str(index.featureId[position])
+         print('position %d feature_id %s at %.5f %.5f, %.3f km away' % \
+               (position,featureId,index.lat[position],index.lon[position],dist))
+   else:
+      found = index.cell(args.lat,args.lon)
+      seconds = time.time() - tStart
+      if found is None:
+         print('Outside the grid')
+      else:
+         print('row %d column %d (y, x of the output arrays)' % found)
+   print('query took %.2f ms' % (seconds*1000.0))